@@ -1,14 +1,27 @@
 import os
+import time
 import logging
 from fastapi import FastAPI, Request, HTTPException, Header, Depends
 from fastapi.responses import JSONResponse
-import httpx
-from linebot import LineBotApi, WebhookHandler
+import redis.asyncio as aioredis
+from linebot import WebhookParser
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import (
     MessageEvent, TextMessage, ImageMessage, TextSendMessage
 )
 
+from app.services.dedup import EventDeduplicator
+from app.services.event_worker import EventWorkerPool
+from app.services.line_client import AsyncLineClient
+from app.services.rate_limiter import RateLimiter, BucketConfig
+from app.services.upstream import (
+    UpstreamClient, RetryBudget, CircuitBreaker, DeadlineExceeded, BUSY_STATUS_CODE
+)
+from app.utils.metrics import metrics
+from app.utils.sse import iter_sse_events
+from app.utils.streaming_upload import StreamingMultipartUpload, ImageTooLargeError
+from app.utils.text_segments import TextSegmenter, pack_messages
+
 # 配置日誌
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 LOG_FILE = os.getenv("LOG_FILE", "/app/logs/api_gateway.log")
@@ -33,142 +46,461 @@ LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET", "")
 USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://user_service:8001")
 CHAT_SERVICE_URL = os.getenv("CHAT_SERVICE_URL", "http://chat_service:8002")
 IMAGE_SERVICE_URL = os.getenv("IMAGE_SERVICE_URL", "http://image_service:8003")
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "0.5"))
+DEDUP_LOCAL_CAPACITY = int(os.getenv("DEDUP_LOCAL_CAPACITY", "10000"))
+DEDUP_TTL = int(os.getenv("DEDUP_TTL", "600"))  # 秒
+
+# 上游服務連線設定
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "false").lower() == "true"  # 需安裝h2套件
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "2"))
+UPSTREAM_RETRY_BUDGET_RATIO = float(os.getenv("UPSTREAM_RETRY_BUDGET_RATIO", "0.2"))
+UPSTREAM_BREAKER_FAILURES = int(os.getenv("UPSTREAM_BREAKER_FAILURES", "5"))
+UPSTREAM_BREAKER_RESET = float(os.getenv("UPSTREAM_BREAKER_RESET", "30"))
+UPSTREAM_MAX_BUSY_WAIT = float(os.getenv("UPSTREAM_MAX_BUSY_WAIT", "10"))  # 上游429時最多等待的秒數
+
+# 限流設定 (RATE: 每秒補充的令牌數, BURST: 桶容量, 設為0表示停用)
+RATE_LIMIT_TEXT_USER_RATE = float(os.getenv("RATE_LIMIT_TEXT_USER_RATE", "0.5"))
+RATE_LIMIT_TEXT_USER_BURST = float(os.getenv("RATE_LIMIT_TEXT_USER_BURST", "5"))
+RATE_LIMIT_TEXT_GLOBAL_RATE = float(os.getenv("RATE_LIMIT_TEXT_GLOBAL_RATE", "50"))
+RATE_LIMIT_TEXT_GLOBAL_BURST = float(os.getenv("RATE_LIMIT_TEXT_GLOBAL_BURST", "100"))
+RATE_LIMIT_IMAGE_USER_RATE = float(os.getenv("RATE_LIMIT_IMAGE_USER_RATE", "0.1"))
+RATE_LIMIT_IMAGE_USER_BURST = float(os.getenv("RATE_LIMIT_IMAGE_USER_BURST", "3"))
+RATE_LIMIT_IMAGE_GLOBAL_RATE = float(os.getenv("RATE_LIMIT_IMAGE_GLOBAL_RATE", "10"))
+RATE_LIMIT_IMAGE_GLOBAL_BURST = float(os.getenv("RATE_LIMIT_IMAGE_GLOBAL_BURST", "20"))
+EVENT_WORKERS = int(os.getenv("EVENT_WORKERS", "8"))
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "1000"))
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(10 * 1024 * 1024)))
+IMAGE_CHUNK_SIZE = int(os.getenv("IMAGE_CHUNK_SIZE", str(64 * 1024)))
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "1.0"))  # 秒，0表示不等待
+COALESCE_MAX_WAIT = float(os.getenv("COALESCE_MAX_WAIT", "3.0"))
+COALESCE_MAX_MESSAGES = int(os.getenv("COALESCE_MAX_MESSAGES", "10"))
+REPLY_DEADLINE_SECONDS = float(os.getenv("REPLY_DEADLINE_SECONDS", "50"))  # reply token有效時間
+CHAT_STREAMING = os.getenv("CHAT_STREAMING", "true").lower() == "true"  # 使用 /chat/stream 逐段接收回應
+CHAT_STREAM_PART_CHARS = int(os.getenv("CHAT_STREAM_PART_CHARS", "1000"))  # 長回應分段的目標字數
+CHAT_STREAM_PUSH_PARTS = os.getenv("CHAT_STREAM_PUSH_PARTS", "false").lower() == "true"  # 第一段先回覆，其餘以push送出
 
 # LINE SDK初始化
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
+line_client = AsyncLineClient(LINE_CHANNEL_ACCESS_TOKEN)
+parser = WebhookParser(LINE_CHANNEL_SECRET)
 
 app = FastAPI(title="Line Bot API Gateway")
 
-# HTTP客戶端
-http_client = httpx.AsyncClient(timeout=30.0)
+def build_upstream(name, base_url, env_prefix, max_connections, timeout, route_timeouts):
+    """依環境變數建立上游客戶端，每個上游有獨立的連線池與斷路器"""
+    return UpstreamClient(
+        name,
+        base_url,
+        max_connections=int(os.getenv(f"{env_prefix}_MAX_CONNECTIONS", str(max_connections))),
+        max_keepalive=int(os.getenv(f"{env_prefix}_MAX_KEEPALIVE", str(max_connections // 2))),
+        http2=UPSTREAM_HTTP2,
+        timeout=float(os.getenv(f"{env_prefix}_TIMEOUT", str(timeout))),
+        route_timeouts=route_timeouts,
+        max_retries=UPSTREAM_MAX_RETRIES,
+        retry_budget=RetryBudget(ratio=UPSTREAM_RETRY_BUDGET_RATIO),
+        breaker=CircuitBreaker(
+            failure_threshold=UPSTREAM_BREAKER_FAILURES,
+            reset_timeout=UPSTREAM_BREAKER_RESET
+        ),
+        max_busy_wait=UPSTREAM_MAX_BUSY_WAIT
+    )
+
+# 各上游服務的HTTP客戶端
+user_upstream = build_upstream("user", USER_SERVICE_URL, "USER_SERVICE", 50, 5.0, {
+    "/users/update_activity": float(os.getenv("USER_ACTIVITY_TIMEOUT", "2")),
+})
+chat_upstream = build_upstream("chat", CHAT_SERVICE_URL, "CHAT_SERVICE", 100, 30.0, {
+    "/chat/process": float(os.getenv("CHAT_PROCESS_TIMEOUT", "30")),
+    # 串流時逾時套用於每次讀取，即等待下一段文字的最長時間
+    "/chat/stream": float(os.getenv("CHAT_STREAM_READ_TIMEOUT", "30")),
+})
+image_upstream = build_upstream("image", IMAGE_SERVICE_URL, "IMAGE_SERVICE", 20, 60.0, {
+    "/images/analyze": float(os.getenv("IMAGE_ANALYZE_TIMEOUT", "60")),
+})
+
+# Redis連接 (連線延遲到第一次使用時建立)
+redis_client = aioredis.Redis(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    socket_timeout=REDIS_SOCKET_TIMEOUT,
+    socket_connect_timeout=REDIS_SOCKET_TIMEOUT
+)
+
+# 重送事件去重
+deduplicator = EventDeduplicator(redis_client, local_capacity=DEDUP_LOCAL_CAPACITY, ttl=DEDUP_TTL)
+
+# 每用戶與全域限流，文字與圖片分開計算
+rate_limiter = RateLimiter(redis_client, {
+    "text": {
+        "user": BucketConfig(RATE_LIMIT_TEXT_USER_RATE, RATE_LIMIT_TEXT_USER_BURST),
+        "global": BucketConfig(RATE_LIMIT_TEXT_GLOBAL_RATE, RATE_LIMIT_TEXT_GLOBAL_BURST),
+    },
+    "image": {
+        "user": BucketConfig(RATE_LIMIT_IMAGE_USER_RATE, RATE_LIMIT_IMAGE_USER_BURST),
+        "global": BucketConfig(RATE_LIMIT_IMAGE_GLOBAL_RATE, RATE_LIMIT_IMAGE_GLOBAL_BURST),
+    },
+})
+
+# 圖片上傳大小分佈
+image_bytes_histogram = metrics.histogram("image_upload_bytes")
+
+# 超過reply token期限而放棄的事件
+deadline_shed_counter = metrics.counter("deadline_shed_total")
+
+# 串流回應：送出請求到收到第一段文字、到送出第一則LINE訊息的時間
+chat_stream_ttft = metrics.histogram("chat_stream_ttft_seconds")
+chat_stream_first_reply = metrics.histogram("chat_stream_first_reply_seconds")
+chat_stream_parts = metrics.histogram("chat_stream_parts")
+chat_stream_early_errors = metrics.counter("chat_stream_early_errors_total")
+
+# 對話服務滿載且無法在期限內重試
+chat_busy_counter = metrics.counter("chat_busy_total")
+
+RATE_LIMITED_REPLY = "您傳送訊息的速度太快了，請稍候再試。"
+BUSY_REPLY = "目前使用人數眾多，請稍後再試。"
+
+async def reply_with_text(reply_token, text):
+    """回覆文字訊息，失敗時僅記錄錯誤"""
+    try:
+        await line_client.reply_message(reply_token, TextSendMessage(text=text))
+    except Exception as e:
+        logger.error(f"回覆LINE訊息失敗: {e}")
+
+async def reply_with_texts(reply_token, texts):
+    """以一次回覆送出多則文字訊息，失敗時僅記錄錯誤"""
+    try:
+        await line_client.reply_message(reply_token, [TextSendMessage(text=text) for text in texts])
+    except Exception as e:
+        logger.error(f"回覆LINE訊息失敗: {e}")
+
+async def push_texts(user_id, texts):
+    """推送多則文字訊息，失敗時僅記錄錯誤"""
+    try:
+        await line_client.push_message(user_id, [TextSendMessage(text=text) for text in texts])
+    except Exception as e:
+        logger.error(f"推送LINE訊息失敗: {e}")
+
+def parse_model_command(text):
+    """簡單的命令解析，用戶可以通過特定命令指定AI模型"""
+    if text.startswith("/gemini "):
+        return "gemini", text[8:].strip()  # 去除命令前綴
+    if text.startswith("/openai "):
+        return "openai", text[8:].strip()  # 去除命令前綴
+    return None, text  # 未指定時由對話服務依延遲與錯誤率選擇
+
+def event_user_key(event):
+    """事件依來源用戶排序處理"""
+    source = getattr(event, "source", None)
+    return getattr(source, "user_id", None)
+
+def event_coalesce_group(event):
+    """同一用戶、同一AI提供者的連續文字訊息可合併處理"""
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+        model_provider, _ = parse_model_command(event.message.text)
+        return f"text:{model_provider or 'auto'}"
+    return None
+
+async def admit(kind, events):
+    """限流檢查，超過限制時回覆固定訊息而不呼叫下游服務"""
+    event = events[-1]
+    decision = await rate_limiter.acquire(kind, event.source.user_id)
+    if decision.allowed:
+        return True
+    
+    logger.info(f"用戶 {event.source.user_id} 超過{kind}限流，{decision.retry_after:.1f} 秒後可再使用")
+    if decision.notify:
+        await reply_with_text(event.reply_token, RATE_LIMITED_REPLY)
+    return False
+
+async def dispatch_events(events):
+    """依事件類型分派給對應的處理函式"""
+    event = events[0]
+    if isinstance(event, MessageEvent):
+        if isinstance(event.message, TextMessage):
+            if await admit("text", events):
+                await handle_text_message(events)
+            return
+        if isinstance(event.message, ImageMessage):
+            if await admit("image", events):
+                await handle_image_message(event)
+            return
+    logger.debug(f"忽略不支援的事件類型: {type(event).__name__}")
+
+# 事件工作者池：同一用戶依序處理，連續文字訊息在視窗內合併
+event_pool = EventWorkerPool(
+    dispatch_events,
+    workers=EVENT_WORKERS,
+    max_queue_size=EVENT_QUEUE_SIZE,
+    name="webhook_events",
+    key_func=event_user_key,
+    group_func=event_coalesce_group,
+    debounce=COALESCE_WINDOW,
+    max_debounce=COALESCE_MAX_WAIT,
+    max_batch_size=COALESCE_MAX_MESSAGES
+)
 
 @app.get("/")
 async def health_check():
     return {"status": "ok", "service": "api_gateway"}
 
+@app.get("/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
 @app.post("/webhook")
 async def line_webhook(request: Request, x_line_signature: str = Header(None)):
     # 獲取請求體
     body = await request.body()
     body_decode = body.decode("utf-8")
     
-    # 驗證LINE請求簽名
+    # 驗證LINE請求簽名並解析事件
     try:
-        handler.handle(body_decode, x_line_signature)
+        events = parser.parse(body_decode, x_line_signature)
     except InvalidSignatureError:
         logger.error("Invalid signature")
         raise HTTPException(status_code=400, detail="Invalid signature")
     
+    # 過濾LINE重送的重複事件
+    events = await deduplicator.filter_new(events)
+    
+    # 放入佇列後立即回應，由工作者非同步處理
+    if not event_pool.submit_many(events):
+        logger.warning(f"事件佇列已滿，拒絕 {len(events)} 個事件")
+        await deduplicator.forget(events)
+        raise HTTPException(status_code=503, detail="Event queue is full")
+    
     return JSONResponse(content={"status": "ok"})
 
-@handler.add(MessageEvent, message=TextMessage)
-async def handle_text_message(event):
-    """處理文本消息"""
+def reply_deadline(event):
+    """依事件時間戳計算reply token的截止時間(Unix時間)"""
+    return event.timestamp / 1000 + REPLY_DEADLINE_SECONDS
+
+async def update_user_activity(user_id, deadline=None):
+    """更新用戶活躍狀態，失敗時不影響訊息處理"""
+    try:
+        await user_upstream.post(
+            "/users/update_activity",
+            idempotent=True,
+            deadline=deadline,
+            json={"line_user_id": user_id}
+        )
+    except Exception as e:
+        logger.warning(f"更新用戶活躍狀態失敗: {e}")
+
+async def handle_text_message(events):
+    """處理文本消息，連續的多則訊息合併成一次對話請求"""
+    event = events[-1]  # 使用最新的reply token回覆
     user_id = event.source.user_id
-    text = event.message.text
+    deadline = reply_deadline(event)
+    
+    # 判斷是否要使用特定AI提供者 (同一批訊息的提供者相同)
+    texts = []
+    for text_event in events:
+        model_provider, text = parse_model_command(text_event.message.text)
+        texts.append(text)
+    text = "\n".join(texts)
     
     try:
         # 1. 更新用戶活躍狀態
-        await http_client.post(
-            f"{USER_SERVICE_URL}/users/update_activity",
-            json={"line_user_id": user_id}
-        )
-        
-        # 判斷是否要使用特定AI提供者
-        model_provider = "openai"  # 預設使用OpenAI
-        
-        # 簡單的命令解析，用戶可以通過特定命令指定AI模型
-        if text.startswith("/gemini "):
-            model_provider = "gemini"
-            text = text[8:].strip()  # 去除命令前綴
-        elif text.startswith("/openai "):
-            model_provider = "openai"
-            text = text[8:].strip()  # 去除命令前綴
+        await update_user_activity(user_id, deadline)
         
         # 2. 發送文本到對話服務
-        response = await http_client.post(
-            f"{CHAT_SERVICE_URL}/chat/process",
-            json={
-                "line_user_id": user_id, 
-                "message": text,
-                "model_provider": model_provider
-            }
-        )
-        
-        if response.status_code == 200:
-            result = response.json()
-            # 構建回覆訊息，包含提供者資訊
-            reply_text = f"{result['response']}\n\n[由 {result['provider']} 提供]"
-            
-            # 發送回覆到LINE
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=reply_text)
-            )
+        payload = {
+            "line_user_id": user_id, 
+            "message": text,
+            "model_provider": model_provider
+        }
+        if CHAT_STREAMING:
+            await stream_chat_reply(event, payload, deadline)
         else:
-            logger.error(f"Error from chat service: {response.status_code} - {response.text}")
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="很抱歉，處理訊息時發生錯誤。")
-            )
+            await request_chat_reply(event, payload, deadline)
             
+    except DeadlineExceeded as e:
+        deadline_shed_counter.inc()
+        logger.warning(f"Reply deadline passed before processing text message: {e}")
     except Exception as e:
         logger.error(f"Error processing text message: {str(e)}")
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="很抱歉，處理訊息時發生錯誤。")
-        )
+        await reply_with_text(event.reply_token, "很抱歉，處理訊息時發生錯誤。")
+
+async def request_chat_reply(event, payload, deadline):
+    """等待完整回應後回覆 (LLM呼叫非冪等，只在連線失敗時重試)"""
+    user_id = payload["line_user_id"]
+    response = await chat_upstream.post("/chat/process", deadline=deadline, json=payload)
+    
+    if response.status_code == 200:
+        result = response.json()
+        # 構建回覆訊息，包含提供者資訊
+        reply_text = f"{result['response']}\n\n[由 {result['provider']} 提供]"
+        
+        # 發送回覆到LINE
+        await reply_with_text(event.reply_token, reply_text)
+    elif response.status_code == 504 and time.time() >= deadline:
+        # reply token已過期，無法回覆
+        deadline_shed_counter.inc()
+        logger.warning(f"Chat request for {user_id} missed the reply deadline")
+    elif response.status_code == BUSY_STATUS_CODE:
+        # 已依Retry-After重試仍滿載
+        chat_busy_counter.inc()
+        logger.warning(f"Chat service busy for {user_id}: {response.headers.get('Retry-After')}s")
+        await reply_with_text(event.reply_token, BUSY_REPLY)
+    else:
+        logger.error(f"Error from chat service: {response.status_code} - {response.text}")
+        await reply_with_text(event.reply_token, "很抱歉，處理訊息時發生錯誤。")
+
+async def stream_chat_reply(event, payload, deadline):
+    """
+    逐段接收對話服務的串流回應
+
+    在第一段文字前發生錯誤時立即回覆，不必等待逾時；長回應依段落切成多則訊息。
+    啟用CHAT_STREAM_PUSH_PARTS時第一段完成即以reply token送出，其餘段落以push送出。
+    """
+    user_id = payload["line_user_id"]
+    provider = payload["model_provider"]
+    segmenter = TextSegmenter(CHAT_STREAM_PART_CHARS)
+    pending = []
+    replied = False
+    received = False
+    started = time.perf_counter()
+    
+    async def send(segments):
+        nonlocal replied
+        if not replied:
+            chat_stream_first_reply.observe(time.perf_counter() - started)
+            replied = True
+            await reply_with_texts(event.reply_token, pack_messages(segments))
+        else:
+            await push_texts(user_id, pack_messages(segments))
+    
+    async with chat_upstream.stream("POST", "/chat/stream", deadline=deadline, json=payload) as response:
+        if response.status_code != 200:
+            await response.aread()
+            if response.status_code == 504 and time.time() >= deadline:
+                deadline_shed_counter.inc()
+                logger.warning(f"Chat request for {user_id} missed the reply deadline")
+                return
+            if response.status_code == BUSY_STATUS_CODE:
+                chat_busy_counter.inc()
+                logger.warning(f"Chat service busy for {user_id}: {response.headers.get('Retry-After')}s")
+                await reply_with_text(event.reply_token, BUSY_REPLY)
+                return
+            logger.error(f"Error from chat service: {response.status_code} - {response.text}")
+            await reply_with_text(event.reply_token, "很抱歉，處理訊息時發生錯誤。")
+            return
+        
+        completed = False
+        async for name, data in iter_sse_events(response.aiter_lines()):
+            if name == "delta":
+                if not received:
+                    chat_stream_ttft.observe(time.perf_counter() - started)
+                    received = True
+                pending.extend(segmenter.feed(data["text"]))
+                if CHAT_STREAM_PUSH_PARTS and pending:
+                    await send(pending)
+                    pending = []
+            elif name == "done":
+                provider = data.get("provider", provider)
+                completed = True
+                break
+            elif name == "error":
+                if data.get("status") == 504 and time.time() >= deadline:
+                    deadline_shed_counter.inc()
+                    logger.warning(f"Chat stream for {user_id} missed the reply deadline")
+                    return
+                if data.get("status") == BUSY_STATUS_CODE and not replied:
+                    # 提供者限流，已無法在串流中重試
+                    chat_busy_counter.inc()
+                    logger.warning(f"Chat providers busy for {user_id}: {data.get('detail')}")
+                    await reply_with_text(event.reply_token, BUSY_REPLY)
+                    return
+                if not received:
+                    chat_stream_early_errors.inc()
+                logger.error(f"Error from chat stream: {data.get('detail')}")
+                break
+    
+    if not completed:
+        # 已送出部分內容時補上說明，否則直接回覆錯誤
+        error_text = "很抱歉，處理訊息時發生錯誤。"
+        if replied:
+            await push_texts(user_id, [error_text])
+        else:
+            await reply_with_text(event.reply_token, error_text)
+        return
+    
+    pending.extend(segmenter.flush())
+    footer = f"[由 {provider} 提供]"
+    if pending:
+        pending[-1] = f"{pending[-1]}\n\n{footer}"
+    else:
+        pending = [footer]
+    chat_stream_parts.observe(len(pending))
+    await send(pending)
 
-@handler.add(MessageEvent, message=ImageMessage)
 async def handle_image_message(event):
     """處理圖像消息"""
     user_id = event.source.user_id
     message_id = event.message.id
+    deadline = reply_deadline(event)
     
     try:
-        # 1. 從LINE獲取圖像內容
-        message_content = line_bot_api.get_message_content(message_id)
-        image_data = b''
-        for chunk in message_content.iter_content():
-            image_data += chunk
-        
-        # 2. 發送圖像到圖像處理服務
-        files = {"image": ("image.jpg", image_data, "image/jpeg")}
-        data = {"line_user_id": user_id}
-        
-        response = await http_client.post(
-            f"{IMAGE_SERVICE_URL}/images/analyze",
-            files=files,
-            data=data
-        )
+        # 1. 從LINE串流下載圖像，同時直接轉送到圖像處理服務
+        async with line_client.stream_message_content(message_id, IMAGE_CHUNK_SIZE) as (content, chunks):
+            declared_size = content.headers.get("content-length")
+            if declared_size and int(declared_size) > MAX_IMAGE_BYTES:
+                raise ImageTooLargeError(MAX_IMAGE_BYTES)
+            
+            upload = StreamingMultipartUpload(
+                chunks,
+                fields={"line_user_id": user_id},
+                file_field="image",
+                filename="image.jpg",
+                file_content_type=content.headers.get("content-type", "image/jpeg"),
+                max_bytes=MAX_IMAGE_BYTES
+            )
+            
+            # 2. 發送圖像到圖像處理服務
+            # 串流請求體無法重送，不重試
+            response = await image_upstream.post(
+                "/images/analyze",
+                retry=False,
+                deadline=deadline,
+                content=upload,
+                headers={"Content-Type": upload.content_type}
+            )
+        image_bytes_histogram.observe(upload.size)
         
         if response.status_code == 200:
             result = response.json()
             # 發送回覆到LINE
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=result["analysis"])
-            )
+            await reply_with_text(event.reply_token, result["analysis"])
+        elif response.status_code == 504 and time.time() >= deadline:
+            deadline_shed_counter.inc()
+            logger.warning(f"Image request for {user_id} missed the reply deadline")
         else:
             logger.error(f"Error from image service: {response.status_code} - {response.text}")
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="很抱歉，處理圖片時發生錯誤。")
-            )
+            await reply_with_text(event.reply_token, "很抱歉，處理圖片時發生錯誤。")
             
+    except DeadlineExceeded as e:
+        deadline_shed_counter.inc()
+        logger.warning(f"Reply deadline passed before processing image message: {e}")
+    except ImageTooLargeError as e:
+        logger.warning(f"Image too large from {user_id}: {e}")
+        await reply_with_text(event.reply_token, "很抱歉，圖片檔案過大，請壓縮後再傳送。")
     except Exception as e:
         logger.error(f"Error processing image message: {str(e)}")
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="很抱歉，處理圖片時發生錯誤。")
-        )
+        await reply_with_text(event.reply_token, "很抱歉，處理圖片時發生錯誤。")
 
 @app.on_event("startup")
 async def startup_event():
+    await event_pool.start()
     logger.info("API Gateway starting up")
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    await http_client.aclose()
+    await event_pool.stop()
+    await user_upstream.aclose()
+    await chat_upstream.aclose()
+    await image_upstream.aclose()
+    await line_client.aclose()
+    await redis_client.close()
     logger.info("API Gateway shutting down") 
\ No newline at end of file
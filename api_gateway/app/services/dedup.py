@@ -0,0 +1,103 @@
+import logging
+from collections import OrderedDict
+from typing import List, Optional
+
+from app.utils.metrics import metrics
+
+# 配置日誌
+logger = logging.getLogger(__name__)
+
+
+class EventDeduplicator:
+    """
+    以LINE webhookEventId過濾重送事件
+
+    先查詢行程內的LRU，再以Redis SET NX + TTL 在多個閘道副本間搶占事件ID，
+    每個事件只需O(1)操作。Redis無法連線時退回只使用本機LRU。
+    """
+
+    def __init__(
+        self,
+        redis_client=None,
+        local_capacity: int = 10000,
+        ttl: int = 600,
+        key_prefix: str = "webhook_event:"
+    ):
+        self.redis_client = redis_client
+        self.local_capacity = local_capacity
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+
+        metrics.gauge("webhook_dedup_local_size", lambda: len(self._seen))
+        self._duplicates = metrics.counter("webhook_duplicates_total")
+        self._local_hits = metrics.counter("webhook_duplicates_local_total")
+        self._redeliveries = metrics.counter("webhook_redeliveries_total")
+        self._redis_errors = metrics.counter("webhook_dedup_redis_errors_total")
+
+    @staticmethod
+    def event_id(event) -> Optional[str]:
+        return getattr(event, "webhook_event_id", None)
+
+    def _remember(self, event_id: str):
+        self._seen[event_id] = None
+        self._seen.move_to_end(event_id)
+        while len(self._seen) > self.local_capacity:
+            self._seen.popitem(last=False)
+
+    async def filter_new(self, events: list) -> list:
+        """回傳尚未處理過的事件，並將其標記為已見過"""
+        candidates = []
+        for event in events:
+            delivery_context = getattr(event, "delivery_context", None)
+            if delivery_context is not None and getattr(delivery_context, "is_redelivery", False):
+                self._redeliveries.inc()
+
+            event_id = self.event_id(event)
+            if event_id is None:
+                candidates.append((None, event))
+                continue
+            if event_id in self._seen:
+                self._seen.move_to_end(event_id)
+                self._local_hits.inc()
+                self._duplicates.inc()
+                continue
+            candidates.append((event_id, event))
+
+        ids = [event_id for event_id, _ in candidates if event_id is not None]
+        claimed = {event_id: True for event_id in ids}
+        if ids and self.redis_client is not None:
+            try:
+                # 一次往返搶占整批事件ID
+                pipe = self.redis_client.pipeline(transaction=False)
+                for event_id in ids:
+                    pipe.set(f"{self.key_prefix}{event_id}", 1, nx=True, ex=self.ttl)
+                results = await pipe.execute()
+                claimed = {event_id: bool(result) for event_id, result in zip(ids, results)}
+            except Exception as e:
+                self._redis_errors.inc()
+                logger.warning(f"Redis去重失敗，僅使用本機快取: {e}")
+
+        new_events = []
+        for event_id, event in candidates:
+            if event_id is None:
+                new_events.append(event)
+                continue
+            self._remember(event_id)
+            if claimed.get(event_id, True):
+                new_events.append(event)
+            else:
+                self._duplicates.inc()
+        return new_events
+
+    async def forget(self, events: List[object]):
+        """事件未被接受時釋放其ID，讓LINE重送時可以再次處理"""
+        ids = [event_id for event_id in map(self.event_id, events) if event_id is not None]
+        for event_id in ids:
+            self._seen.pop(event_id, None)
+        if ids and self.redis_client is not None:
+            try:
+                await self.redis_client.delete(*[f"{self.key_prefix}{event_id}" for event_id in ids])
+            except Exception as e:
+                self._redis_errors.inc()
+                logger.warning(f"釋放事件ID失敗: {e}")
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from app.utils.metrics import metrics
+
+# 配置日誌
+logger = logging.getLogger(__name__)
+
+
+class EventWorkerPool:
+    """
+    以有界佇列接收webhook事件，並由固定數量的asyncio工作者處理
+
+    事件依 key_func 的結果(例如LINE用戶ID)放入各自的信箱：同一個鍵的事件
+    依序處理，不同鍵之間平行處理。group_func 回傳相同群組的連續事件會在
+    debounce 視窗內合併成一批交給 handler。
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[List[object]], Awaitable[None]],
+        workers: int = 8,
+        max_queue_size: int = 1000,
+        name: str = "events",
+        key_func: Optional[Callable[[object], Optional[str]]] = None,
+        group_func: Optional[Callable[[object], Optional[str]]] = None,
+        debounce: float = 0.0,
+        max_debounce: float = 2.0,
+        max_batch_size: int = 10
+    ):
+        self.handler = handler
+        self.workers = workers
+        self.name = name
+        self.max_queue_size = max_queue_size
+        self.key_func = key_func
+        self.group_func = group_func
+        self.debounce = debounce
+        self.max_debounce = max(max_debounce, debounce)
+        self.max_batch_size = max_batch_size
+
+        self._mailboxes: Dict[str, Deque[Tuple[float, Optional[str], object]]] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._ready_keys: Set[str] = set()
+        self._running: Set[str] = set()
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._pending = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks: List[asyncio.Task] = []
+        self._busy = 0
+
+        # 佇列指標
+        metrics.gauge(f"{name}_queue_depth", lambda: self._pending)
+        metrics.gauge(f"{name}_active_keys", lambda: len(self._mailboxes))
+        metrics.gauge(f"{name}_workers_busy", lambda: self._busy)
+        metrics.gauge(f"{name}_workers_total", lambda: len(self._tasks))
+        self._accepted = metrics.counter(f"{name}_accepted_total")
+        self._rejected = metrics.counter(f"{name}_rejected_total")
+        self._failed = metrics.counter(f"{name}_failed_total")
+        self._coalesced = metrics.counter(f"{name}_coalesced_total")
+        self._batch_size = metrics.histogram(f"{name}_batch_size")
+        self._wait_time = metrics.histogram(f"{name}_queue_wait_seconds")
+        self._process_time = metrics.histogram(f"{name}_processing_seconds")
+
+    def free_slots(self) -> int:
+        """佇列剩餘容量"""
+        if self.max_queue_size <= 0:
+            return 1 << 30
+        return self.max_queue_size - self._pending
+
+    def submit_many(self, events: list) -> bool:
+        """
+        將一批事件放入佇列
+
+        容量不足時整批拒絕，避免LINE重送時部分事件被重複處理
+        """
+        if len(events) > self.free_slots():
+            self._rejected.inc(len(events))
+            return False
+
+        enqueued_at = time.monotonic()
+        touched = []
+        for event in events:
+            key = self.key_func(event) if self.key_func else None
+            if key is None:
+                key = f"_event:{id(event)}"
+            group = self.group_func(event) if self.group_func else None
+            mailbox = self._mailboxes.setdefault(key, deque())
+            mailbox.append((enqueued_at, group, event))
+            self._pending += 1
+            if key not in touched:
+                touched.append(key)
+
+        self._idle.clear()
+        for key in touched:
+            self._schedule(key)
+        self._accepted.inc(len(events))
+        return True
+
+    def _schedule(self, key: str):
+        """決定信箱何時可被工作者處理：立即或等待debounce視窗結束"""
+        if key in self._running or key in self._ready_keys:
+            return
+        mailbox = self._mailboxes.get(key)
+        if not mailbox:
+            return
+
+        head_at, head_group, _ = mailbox[0]
+        waiting = (
+            self.debounce > 0
+            and head_group is not None
+            and len(mailbox) < self.max_batch_size
+            and all(group == head_group for _, group, _ in mailbox)
+        )
+        if not waiting:
+            self._mark_ready(key)
+            return
+
+        # 每收到新訊息就重新計時，但總等待時間不超過 max_debounce
+        now = time.monotonic()
+        last_at = mailbox[-1][0]
+        due = min(last_at + self.debounce, head_at + self.max_debounce)
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        if due <= now:
+            self._mark_ready(key)
+            return
+        loop = asyncio.get_running_loop()
+        self._timers[key] = loop.call_later(due - now, self._mark_ready, key)
+
+    def _mark_ready(self, key: str):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        if key in self._ready_keys or key in self._running:
+            return
+        self._ready_keys.add(key)
+        self._ready.put_nowait(key)
+
+    def _take_batch(self, key: str) -> List[Tuple[float, Optional[str], object]]:
+        """取出信箱開頭可合併的連續事件"""
+        mailbox = self._mailboxes[key]
+        batch = [mailbox.popleft()]
+        group = batch[0][1]
+        if group is not None:
+            while mailbox and len(batch) < self.max_batch_size and mailbox[0][1] == group:
+                batch.append(mailbox.popleft())
+        return batch
+
+    async def start(self):
+        """啟動工作者"""
+        if self._tasks:
+            return
+        for index in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(index)))
+        logger.info(f"事件工作者已啟動: {self.workers} 個, 佇列上限: {self.max_queue_size}")
+
+    async def stop(self, timeout: Optional[float] = 10.0):
+        """略過debounce等待，處理完剩餘事件後停止工作者"""
+        for key in list(self._timers):
+            self._mark_ready(key)
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"停止時仍有 {self._pending} 個事件未處理")
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info("事件工作者已停止")
+
+    async def _worker(self, index: int):
+        while True:
+            key = await self._ready.get()
+            self._ready_keys.discard(key)
+            self._running.add(key)
+            batch = self._take_batch(key)
+            self._pending -= len(batch)
+
+            started_at = time.monotonic()
+            for enqueued_at, _, _ in batch:
+                self._wait_time.observe(started_at - enqueued_at)
+            self._batch_size.observe(len(batch))
+            if len(batch) > 1:
+                self._coalesced.inc(len(batch) - 1)
+
+            self._busy += 1
+            try:
+                await self.handler([event for _, _, event in batch])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._failed.inc()
+                logger.error(f"工作者 {index} 處理事件時出錯: {e}")
+            finally:
+                self._busy -= 1
+                self._process_time.observe(time.monotonic() - started_at)
+                self._running.discard(key)
+                if self._mailboxes.get(key):
+                    self._schedule(key)
+                else:
+                    self._mailboxes.pop(key, None)
+                if self._pending == 0 and not self._running:
+                    self._idle.set()
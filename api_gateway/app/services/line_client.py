@@ -0,0 +1,149 @@
+import os
+import time
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Union
+
+import httpx
+
+from app.utils.metrics import metrics
+
+# 配置日誌
+logger = logging.getLogger(__name__)
+
+# LINE Messaging API設定
+LINE_API_BASE_URL = os.getenv("LINE_API_BASE_URL", "https://api.line.me")
+LINE_DATA_API_BASE_URL = os.getenv("LINE_DATA_API_BASE_URL", "https://api-data.line.me")
+
+# 連線池與逾時設定
+LINE_MAX_CONNECTIONS = int(os.getenv("LINE_MAX_CONNECTIONS", "100"))
+LINE_MAX_KEEPALIVE = int(os.getenv("LINE_MAX_KEEPALIVE", "20"))
+LINE_KEEPALIVE_EXPIRY = float(os.getenv("LINE_KEEPALIVE_EXPIRY", "30"))
+LINE_CONNECT_TIMEOUT = float(os.getenv("LINE_CONNECT_TIMEOUT", "3"))
+LINE_POOL_TIMEOUT = float(os.getenv("LINE_POOL_TIMEOUT", "5"))
+LINE_REPLY_TIMEOUT = float(os.getenv("LINE_REPLY_TIMEOUT", "5"))
+LINE_CONTENT_TIMEOUT = float(os.getenv("LINE_CONTENT_TIMEOUT", "20"))
+
+Message = Union[Dict[str, Any], Any]
+
+
+class LineApiError(Exception):
+    """LINE API回傳錯誤狀態碼"""
+
+    def __init__(self, status_code: int, body: str):
+        super().__init__(f"LINE API error {status_code}: {body}")
+        self.status_code = status_code
+        self.body = body
+
+
+class AsyncLineClient:
+    """共用keep-alive連線池的非同步LINE Messaging API客戶端"""
+
+    def __init__(
+        self,
+        access_token: str,
+        api_base_url: str = LINE_API_BASE_URL,
+        data_api_base_url: str = LINE_DATA_API_BASE_URL,
+        max_connections: int = LINE_MAX_CONNECTIONS,
+        max_keepalive: int = LINE_MAX_KEEPALIVE,
+        keepalive_expiry: float = LINE_KEEPALIVE_EXPIRY,
+        reply_timeout: float = LINE_REPLY_TIMEOUT,
+        content_timeout: float = LINE_CONTENT_TIMEOUT
+    ):
+        self.api_base_url = api_base_url.rstrip("/")
+        self.data_api_base_url = data_api_base_url.rstrip("/")
+        self.reply_timeout = httpx.Timeout(
+            reply_timeout, connect=LINE_CONNECT_TIMEOUT, pool=LINE_POOL_TIMEOUT
+        )
+        self.content_timeout = httpx.Timeout(
+            content_timeout, connect=LINE_CONNECT_TIMEOUT, pool=LINE_POOL_TIMEOUT
+        )
+        self._client = httpx.AsyncClient(
+            headers={"Authorization": f"Bearer {access_token}"},
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive,
+                keepalive_expiry=keepalive_expiry
+            ),
+            timeout=self.reply_timeout
+        )
+        self._latency = {
+            name: metrics.histogram(f"line_api_{name}_seconds")
+            for name in ("reply", "push", "content")
+        }
+        self._errors = metrics.counter("line_api_errors_total")
+
+    @staticmethod
+    def _serialize_messages(messages: Union[Message, List[Message]]) -> List[Dict[str, Any]]:
+        """將SDK的SendMessage物件或字典轉為API格式"""
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        return [
+            message.as_json_dict() if hasattr(message, "as_json_dict") else message
+            for message in messages
+        ]
+
+    def _check(self, response: httpx.Response):
+        if response.status_code >= 400:
+            self._errors.inc()
+            raise LineApiError(response.status_code, response.text)
+
+    async def reply_message(self, reply_token: str, messages: Union[Message, List[Message]]):
+        """使用reply token回覆訊息"""
+        with self._latency["reply"].time():
+            response = await self._client.post(
+                f"{self.api_base_url}/v2/bot/message/reply",
+                json={
+                    "replyToken": reply_token,
+                    "messages": self._serialize_messages(messages)
+                },
+                timeout=self.reply_timeout
+            )
+        self._check(response)
+
+    async def push_message(self, to: str, messages: Union[Message, List[Message]]):
+        """主動推送訊息給用戶"""
+        with self._latency["push"].time():
+            response = await self._client.post(
+                f"{self.api_base_url}/v2/bot/message/push",
+                json={
+                    "to": to,
+                    "messages": self._serialize_messages(messages)
+                },
+                timeout=self.reply_timeout
+            )
+        self._check(response)
+
+    async def get_message_content(self, message_id: str) -> bytes:
+        """下載訊息內容(圖片等)"""
+        with self._latency["content"].time():
+            response = await self._client.get(
+                f"{self.data_api_base_url}/v2/bot/message/{message_id}/content",
+                timeout=self.content_timeout
+            )
+        self._check(response)
+        return response.content
+
+    @asynccontextmanager
+    async def stream_message_content(self, message_id: str, chunk_size: Optional[int] = None):
+        """
+        以串流方式下載訊息內容
+
+        產生 (回應, 區塊迭代器)，呼叫端逐塊讀取而不需將整個檔案放入記憶體
+        """
+        started = time.perf_counter()
+        try:
+            async with self._client.stream(
+                "GET",
+                f"{self.data_api_base_url}/v2/bot/message/{message_id}/content",
+                timeout=self.content_timeout
+            ) as response:
+                if response.status_code >= 400:
+                    await response.aread()
+                    self._check(response)
+                yield response, response.aiter_bytes(chunk_size)
+        finally:
+            self._latency["content"].observe(time.perf_counter() - started)
+
+    async def aclose(self):
+        await self._client.aclose()
@@ -0,0 +1,193 @@
+import time
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+from app.utils.metrics import metrics
+
+# 配置日誌
+logger = logging.getLogger(__name__)
+
+# 原子性檢查並扣除多個令牌桶：任一桶不足則全部不扣
+# KEYS: 桶的鍵, ARGV[1]: 消耗量, ARGV[2i]/ARGV[2i+1]: 第i個桶的每秒補充量/容量
+TOKEN_BUCKET_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local cost = tonumber(ARGV[1])
+local tokens = {}
+local wait = 0
+for i = 1, #KEYS do
+    local rate = tonumber(ARGV[2 * i])
+    local capacity = tonumber(ARGV[2 * i + 1])
+    local state = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+    local current = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    current = math.min(capacity, current + math.max(0, now - ts) * rate / 1000)
+    tokens[i] = current
+    if current < cost then
+        local needed = math.ceil((cost - current) * 1000 / rate)
+        if needed > wait then
+            wait = needed
+        end
+    end
+end
+if wait > 0 then
+    return {0, wait}
+end
+for i = 1, #KEYS do
+    local rate = tonumber(ARGV[2 * i])
+    local capacity = tonumber(ARGV[2 * i + 1])
+    redis.call('HSET', KEYS[i], 'tokens', tostring(tokens[i] - cost), 'ts', tostring(now))
+    redis.call('PEXPIRE', KEYS[i], math.ceil(capacity * 1000 / rate) + 1000)
+end
+return {1, 0}
+"""
+
+
+@dataclass
+class BucketConfig:
+    """令牌桶設定：rate為每秒補充量，capacity為可累積的突發量"""
+    rate: float
+    capacity: float
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0 and self.capacity > 0
+
+
+@dataclass
+class RateLimitDecision:
+    allowed: bool
+    retry_after: float = 0.0
+    notify: bool = False  # 是否需要回覆用戶已超過限制
+
+
+class LocalTokenBucket:
+    """行程內的令牌桶，Redis不可用時使用"""
+
+    def __init__(self, config: BucketConfig):
+        self.config = config
+        self.tokens = config.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        elapsed = max(0.0, now - self.updated_at)
+        self.tokens = min(self.config.capacity, self.tokens + elapsed * self.config.rate)
+        self.updated_at = now
+
+    def wait_time(self, cost: float, now: float) -> float:
+        self._refill(now)
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.config.rate
+
+    def consume(self, cost: float):
+        self.tokens -= cost
+
+
+class RateLimiter:
+    """
+    以Redis Lua腳本實作的每用戶與全域令牌桶限流
+
+    被拒絕的鍵會在本機記錄解除時間，期間內的請求直接在行程內拒絕，
+    不需再往返Redis；Redis不可用時改用本機令牌桶。
+    """
+
+    def __init__(
+        self,
+        redis_client,
+        buckets: Dict[str, Dict[str, BucketConfig]],
+        key_prefix: str = "rate_limit:",
+        local_capacity: int = 10000
+    ):
+        self.redis_client = redis_client
+        self.buckets = buckets
+        self.key_prefix = key_prefix
+        self.local_capacity = local_capacity
+        self._script = redis_client.register_script(TOKEN_BUCKET_SCRIPT) if redis_client is not None else None
+        self._blocked_until: "OrderedDict[str, float]" = OrderedDict()
+        self._local_buckets: "OrderedDict[str, LocalTokenBucket]" = OrderedDict()
+
+        self._allowed = metrics.counter("rate_limit_allowed_total")
+        self._rejected = metrics.counter("rate_limit_rejected_total")
+        self._fast_rejected = metrics.counter("rate_limit_fast_rejected_total")
+        self._redis_errors = metrics.counter("rate_limit_redis_errors_total")
+        self._latency = metrics.histogram("rate_limit_check_seconds")
+
+    def _bucket_keys(self, kind: str, line_user_id: str) -> List[Tuple[str, BucketConfig]]:
+        configs = self.buckets.get(kind, {})
+        keys = []
+        user_config = configs.get("user")
+        if user_config is not None and user_config.enabled:
+            keys.append((f"{self.key_prefix}{kind}:user:{line_user_id}", user_config))
+        global_config = configs.get("global")
+        if global_config is not None and global_config.enabled:
+            keys.append((f"{self.key_prefix}{kind}:global", global_config))
+        return keys
+
+    def _block(self, block_key: str, retry_after: float):
+        """記錄封鎖解除時間，期間內的請求走快速路徑"""
+        self._blocked_until[block_key] = time.monotonic() + retry_after
+        self._blocked_until.move_to_end(block_key)
+        while len(self._blocked_until) > self.local_capacity:
+            self._blocked_until.popitem(last=False)
+
+    def _check_local(self, keys: List[Tuple[str, BucketConfig]], cost: float) -> float:
+        now = time.monotonic()
+        buckets = []
+        for key, config in keys:
+            bucket = self._local_buckets.get(key)
+            if bucket is None:
+                bucket = LocalTokenBucket(config)
+                self._local_buckets[key] = bucket
+            self._local_buckets.move_to_end(key)
+            buckets.append(bucket)
+        while len(self._local_buckets) > self.local_capacity:
+            self._local_buckets.popitem(last=False)
+
+        wait = max(bucket.wait_time(cost, now) for bucket in buckets)
+        if wait == 0:
+            for bucket in buckets:
+                bucket.consume(cost)
+        return wait
+
+    async def acquire(self, kind: str, line_user_id: str, cost: float = 1.0) -> RateLimitDecision:
+        """檢查並消耗令牌"""
+        keys = self._bucket_keys(kind, line_user_id)
+        if not keys:
+            return RateLimitDecision(allowed=True)
+
+        # 快速路徑：仍在封鎖期間內直接拒絕
+        block_key = f"{kind}:{line_user_id}"
+        blocked_until = self._blocked_until.get(block_key)
+        now = time.monotonic()
+        if blocked_until is not None:
+            if blocked_until > now:
+                self._fast_rejected.inc()
+                self._rejected.inc()
+                return RateLimitDecision(allowed=False, retry_after=blocked_until - now)
+            del self._blocked_until[block_key]
+
+        with self._latency.time():
+            try:
+                if self._script is None:
+                    raise RuntimeError("Redis未設定")
+                args = [cost]
+                for _, config in keys:
+                    args.extend([config.rate, config.capacity])
+                allowed, wait_ms = await self._script(keys=[key for key, _ in keys], args=args)
+                wait = 0.0 if allowed else int(wait_ms) / 1000
+            except Exception as e:
+                self._redis_errors.inc()
+                logger.debug(f"Redis限流失敗，改用本機令牌桶: {e}")
+                wait = self._check_local(keys, cost)
+
+        if wait > 0:
+            self._rejected.inc()
+            self._block(block_key, wait)
+            # 每個封鎖期間只在第一次拒絕時通知用戶
+            return RateLimitDecision(allowed=False, retry_after=wait, notify=True)
+
+        self._allowed.inc()
+        return RateLimitDecision(allowed=True)
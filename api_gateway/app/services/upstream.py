@@ -0,0 +1,434 @@
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+import httpx
+
+from app.utils.metrics import metrics
+
+# 配置日誌
+logger = logging.getLogger(__name__)
+
+# 可安全重試的狀態碼 (僅限冪等請求)
+RETRYABLE_STATUS_CODES = {502, 503, 504}
+
+# 上游滿載，請求尚未被處理，依Retry-After重試
+BUSY_STATUS_CODE = 429
+
+# 請求尚未送達上游的錯誤，任何請求皆可重試
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+# 傳給上游的絕對截止時間(Unix時間，秒)
+DEADLINE_HEADER = "X-Request-Deadline"
+
+
+class DeadlineExceeded(Exception):
+    """請求的截止時間已過，不再呼叫上游"""
+
+
+class CircuitOpenError(Exception):
+    """斷路器開啟，直接拒絕對上游的呼叫"""
+
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(f"Circuit open for {upstream}, retry after {retry_after:.1f}s")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class RetryBudget:
+    """
+    重試預算：時間窗內的重試次數不得超過 min_retries + ratio * 請求數
+
+    避免上游故障時重試放大流量
+    """
+
+    def __init__(self, ratio: float = 0.2, min_retries: int = 3, window: float = 10.0):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self._requests = deque()
+        self._retries = deque()
+
+    def _trim(self, now: float):
+        for events in (self._requests, self._retries):
+            while events and events[0] < now - self.window:
+                events.popleft()
+
+    def record_request(self):
+        self._requests.append(time.monotonic())
+
+    def try_withdraw(self) -> bool:
+        now = time.monotonic()
+        self._trim(now)
+        if len(self._retries) >= self.min_retries + self.ratio * len(self._requests):
+            return False
+        self._retries.append(now)
+        return True
+
+
+class CircuitBreaker:
+    """
+    連續失敗達門檻後開啟斷路器，冷卻時間過後以半開狀態放行少量探測請求
+
+    探測請求因取消或與上游健康無關的例外結束、沒有記錄成功或失敗時，
+    需以release歸還名額，否則名額用盡後斷路器會一直停在半開狀態。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0, half_open_max_calls: int = 1):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._half_open_calls = 0
+        # 每次進入半開狀態加一，上一輪的探測歸還名額時不影響新的一輪
+        self._generation = 0
+
+    def retry_after(self) -> float:
+        return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN:
+            if self.retry_after() > 0:
+                return False
+            self.state = self.HALF_OPEN
+            self._half_open_calls = 0
+            self._generation += 1
+        if self.state == self.HALF_OPEN:
+            if self._half_open_calls >= self.half_open_max_calls:
+                return False
+            self._half_open_calls += 1
+        return True
+
+    def probe(self) -> Optional[int]:
+        """allow()放行後呼叫，半開狀態下回傳這次探測的代號"""
+        return self._generation if self.state == self.HALF_OPEN else None
+
+    def release(self, probe: Optional[int]):
+        """歸還探測名額；已記錄成功或失敗(狀態已離開半開)時不做任何事"""
+        if probe is not None and self.state == self.HALF_OPEN and probe == self._generation:
+            self._half_open_calls = max(0, self._half_open_calls - 1)
+
+    def record_success(self):
+        self._failures = 0
+        if self.state != self.CLOSED:
+            self.state = self.CLOSED
+            logger.info("斷路器已關閉")
+
+    def record_failure(self):
+        self._failures += 1
+        if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"斷路器開啟，連續失敗 {self._failures} 次")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+    @property
+    def state_code(self) -> int:
+        return {self.CLOSED: 0, self.HALF_OPEN: 1, self.OPEN: 2}[self.state]
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析Retry-After標頭(秒數或HTTP日期)，無法解析時回傳None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class UpstreamClient:
+    """
+    單一上游服務的HTTP客戶端
+
+    每個上游擁有獨立的連線池、逾時設定、重試預算與斷路器，
+    一個上游變慢時不會拖累其他上游的連線。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        base_url: str,
+        max_connections: int = 100,
+        max_keepalive: int = 20,
+        http2: bool = False,
+        timeout: float = 30.0,
+        connect_timeout: float = 2.0,
+        pool_timeout: float = 2.0,
+        route_timeouts: Optional[Dict[str, float]] = None,
+        max_retries: int = 2,
+        backoff_base: float = 0.1,
+        backoff_max: float = 1.0,
+        retry_budget: Optional[RetryBudget] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        max_busy_wait: float = 10.0
+    ):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.pool_timeout = pool_timeout
+        self.route_timeouts = route_timeouts or {}
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_busy_wait = max_busy_wait
+        self.retry_budget = retry_budget or RetryBudget()
+        self.breaker = breaker or CircuitBreaker()
+
+        if http2 and not _http2_available():
+            logger.warning(f"{name}: 未安裝h2套件，改用HTTP/1.1")
+            http2 = False
+
+        self._client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive
+            ),
+            timeout=self._timeout(timeout)
+        )
+        self._in_flight = 0
+
+        prefix = f"upstream_{name}"
+        metrics.gauge(f"{prefix}_in_flight", lambda: self._in_flight)
+        metrics.gauge(f"{prefix}_pool_utilization", lambda: round(self._in_flight / self.max_connections, 3))
+        metrics.gauge(f"{prefix}_breaker_state", lambda: self.breaker.state_code)
+        self._requests = metrics.counter(f"{prefix}_requests_total")
+        self._failures = metrics.counter(f"{prefix}_failures_total")
+        self._retries = metrics.counter(f"{prefix}_retries_total")
+        self._budget_exhausted = metrics.counter(f"{prefix}_retry_budget_exhausted_total")
+        self._busy = metrics.counter(f"{prefix}_busy_total")
+        self._short_circuited = metrics.counter(f"{prefix}_short_circuited_total")
+        self._deadline_exceeded = metrics.counter(f"{prefix}_deadline_exceeded_total")
+        self._latency = metrics.histogram(f"{prefix}_latency_seconds")
+
+    def _timeout(self, seconds: float) -> httpx.Timeout:
+        return httpx.Timeout(seconds, connect=self.connect_timeout, pool=self.pool_timeout)
+
+    def _backoff(self, attempt: int) -> float:
+        """Full jitter指數退避"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _busy_wait(self, response: httpx.Response, deadline: Optional[float]) -> Optional[float]:
+        """上游回應429時依Retry-After決定等待秒數，超過上限或截止時間則不重試"""
+        wait = parse_retry_after(response.headers.get("Retry-After"))
+        if wait is None:
+            wait = self.backoff_max
+        # 加上抖動，避免多個副本同時重試
+        wait += random.uniform(0, wait * 0.2)
+        if wait > self.max_busy_wait:
+            return None
+        if deadline is not None and time.time() + wait >= deadline:
+            return None
+        return wait
+
+    def _apply_deadline(self, path, route, timeout, deadline, kwargs) -> Optional[float]:
+        """依路由設定與截止時間決定逾時，並加上截止時間標頭"""
+        if timeout is None:
+            timeout = self.route_timeouts.get(route or path)
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self._deadline_exceeded.inc()
+                raise DeadlineExceeded(f"{self.name} {path}")
+            timeout = remaining if timeout is None else min(timeout, remaining)
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), DEADLINE_HEADER: f"{deadline:.3f}"}
+        if timeout is not None:
+            kwargs["timeout"] = self._timeout(timeout)
+        return timeout
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        route: Optional[str] = None,
+        timeout: Optional[float] = None,
+        idempotent: bool = False,
+        retry: bool = True,
+        deadline: Optional[float] = None,
+        **kwargs
+    ) -> httpx.Response:
+        """
+        發送請求到上游
+
+        route: 用於查詢路由逾時設定的名稱，預設為path
+        idempotent: 為True時5xx回應也會重試，否則只重試連線失敗
+            429回應表示上游尚未處理，任何請求都會依Retry-After重試
+        retry: 串流請求體無法重送時應設為False
+        deadline: 絕對截止時間(Unix時間)，會以標頭傳給上游並限制逾時與重試
+        """
+        timeout = self._apply_deadline(path, route, timeout, deadline, kwargs)
+
+        probe = self._admit()
+        self.retry_budget.record_request()
+        self._requests.inc()
+        attempt = 0
+        while True:
+            wait = None
+            started = time.perf_counter()
+            self._in_flight += 1
+            try:
+                response = await self._client.request(method, f"{self.base_url}{path}", **kwargs)
+            except httpx.TransportError as e:
+                self._failures.inc()
+                self.breaker.record_failure()
+                can_retry = isinstance(e, CONNECT_ERRORS) or idempotent
+                if not self._should_retry(retry and can_retry, attempt):
+                    raise
+                logger.warning(f"{self.name} {path} 連線失敗，重試中: {e}")
+            else:
+                if response.status_code == BUSY_STATUS_CODE:
+                    # 上游主動拒絕代表仍然健康，不計入斷路器
+                    self.breaker.record_success()
+                    self._busy.inc()
+                    wait = self._busy_wait(response, deadline)
+                    if wait is None or not self._should_retry(retry, attempt):
+                        return response
+                    logger.warning(f"{self.name} {path} 滿載，{wait:.1f} 秒後重試")
+                elif response.status_code < 500:
+                    self.breaker.record_success()
+                    return response
+                elif response.status_code == 504 and deadline is not None and time.time() >= deadline:
+                    # 上游因截止時間放棄處理，不代表上游不健康
+                    self._deadline_exceeded.inc()
+                    return response
+                else:
+                    self._failures.inc()
+                    self.breaker.record_failure()
+                    can_retry = idempotent and response.status_code in RETRYABLE_STATUS_CODES
+                    if not self._should_retry(retry and can_retry, attempt):
+                        return response
+                    logger.warning(f"{self.name} {path} 回應 {response.status_code}，重試中")
+            finally:
+                self._in_flight -= 1
+                self._latency.observe(time.perf_counter() - started)
+                # 探測請求被取消或因其他例外結束時歸還名額
+                self.breaker.release(probe)
+
+            attempt += 1
+            self._retries.inc()
+            await asyncio.sleep(wait if wait is not None else self._backoff(attempt))
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._deadline_exceeded.inc()
+                    raise DeadlineExceeded(f"{self.name} {path}")
+                kwargs["timeout"] = self._timeout(min(timeout, remaining))
+            probe = self._admit()
+
+    def _admit(self) -> Optional[int]:
+        """斷路器開啟時拋出CircuitOpenError，放行時回傳探測代號"""
+        if not self.breaker.allow():
+            self._short_circuited.inc()
+            raise CircuitOpenError(self.name, self.breaker.retry_after())
+        return self.breaker.probe()
+
+    def _should_retry(self, retryable: bool, attempt: int) -> bool:
+        if not retryable or attempt >= self.max_retries:
+            return False
+        if not self.retry_budget.try_withdraw():
+            self._budget_exhausted.inc()
+            return False
+        return True
+
+    @asynccontextmanager
+    async def stream(
+        self,
+        method: str,
+        path: str,
+        route: Optional[str] = None,
+        timeout: Optional[float] = None,
+        deadline: Optional[float] = None,
+        retry: bool = True,
+        **kwargs
+    ):
+        """
+        串流回應：標頭到達後即交給呼叫端逐段讀取
+
+        回應開始後無法重送，只有上游回應429(尚未處理)時依Retry-After重試，
+        請求體為串流時應設retry=False；逾時套用於每次讀取。
+        5xx回應與讀取中斷會計入斷路器。
+        """
+        timeout = self._apply_deadline(path, route, timeout, deadline, kwargs)
+
+        probe = self._admit()
+        self.retry_budget.record_request()
+        self._requests.inc()
+        attempt = 0
+        while True:
+            wait = None
+            started = time.perf_counter()
+            self._in_flight += 1
+            try:
+                async with self._client.stream(method, f"{self.base_url}{path}", **kwargs) as response:
+                    # 串流請求的延遲以收到回應標頭為準
+                    self._latency.observe(time.perf_counter() - started)
+                    if response.status_code == BUSY_STATUS_CODE:
+                        self.breaker.record_success()
+                        self._busy.inc()
+                        wait = self._busy_wait(response, deadline)
+                        if wait is not None and not self._should_retry(retry, attempt):
+                            wait = None
+                    elif response.status_code < 500:
+                        self.breaker.record_success()
+                    elif response.status_code == 504 and deadline is not None and time.time() >= deadline:
+                        self._deadline_exceeded.inc()
+                    else:
+                        self._failures.inc()
+                        self.breaker.record_failure()
+                    if wait is None:
+                        yield response
+                        return
+            except httpx.TransportError:
+                self._failures.inc()
+                self.breaker.record_failure()
+                raise
+            finally:
+                self._in_flight -= 1
+                # 探測請求被取消或呼叫端讀取時拋出其他例外，結束時歸還名額
+                self.breaker.release(probe)
+
+            logger.warning(f"{self.name} {path} 滿載，{wait:.1f} 秒後重試")
+            attempt += 1
+            self._retries.inc()
+            await asyncio.sleep(wait)
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._deadline_exceeded.inc()
+                    raise DeadlineExceeded(f"{self.name} {path}")
+                kwargs["timeout"] = self._timeout(min(timeout, remaining))
+            probe = self._admit()
+
+    async def get(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", path, **kwargs)
+
+    async def aclose(self):
+        await self._client.aclose()
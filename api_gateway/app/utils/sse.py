@@ -0,0 +1,30 @@
+import json
+from typing import Any, AsyncIterator, Dict, Tuple
+
+
+async def iter_sse_events(lines: AsyncIterator[str]) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    """
+    解析server-sent events，逐一產生 (事件名稱, JSON資料)
+
+    只支援本服務使用的子集：event與data欄位、以空行分隔事件。
+    """
+    event = "message"
+    data = []
+    async for line in lines:
+        if not line:
+            if data:
+                yield event, json.loads("\n".join(data))
+            event = "message"
+            data = []
+            continue
+        if line.startswith(":"):
+            continue
+        name, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if name == "event":
+            event = value
+        elif name == "data":
+            data.append(value)
+    if data:
+        yield event, json.loads("\n".join(data))
@@ -0,0 +1,84 @@
+import hashlib
+import secrets
+from typing import AsyncIterator, Dict, Optional
+
+
+class ImageTooLargeError(Exception):
+    """上傳內容超過允許的大小"""
+
+    def __init__(self, limit: int):
+        super().__init__(f"Image exceeds {limit} bytes")
+        self.limit = limit
+
+
+class StreamingMultipartUpload:
+    """
+    將來源區塊直接串接成multipart/form-data請求體
+
+    上傳過程中逐塊計算SHA-256並檢查大小上限，記憶體用量只與區塊大小有關。
+    由於HTTP標頭必須在請求體之前送出，雜湊值以最後一個表單欄位
+    (digest_field) 附在檔案之後傳給下游服務。
+    """
+
+    def __init__(
+        self,
+        chunks: AsyncIterator[bytes],
+        fields: Dict[str, str],
+        file_field: str,
+        filename: str,
+        file_content_type: str,
+        max_bytes: int,
+        digest_field: str = "image_sha256"
+    ):
+        self.chunks = chunks
+        self.fields = fields
+        self.file_field = file_field
+        self.filename = filename
+        self.file_content_type = file_content_type
+        self.max_bytes = max_bytes
+        self.digest_field = digest_field
+        self.boundary = secrets.token_hex(16)
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+        self._consumed = False
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    @property
+    def hexdigest(self) -> Optional[str]:
+        """串流結束後的SHA-256雜湊值"""
+        if not self._consumed:
+            return None
+        return self._sha256.hexdigest()
+
+    def _field_part(self, name: str, value: str) -> bytes:
+        return (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+            f"{value}\r\n"
+        ).encode("utf-8")
+
+    async def __aiter__(self):
+        for name, value in self.fields.items():
+            yield self._field_part(name, value)
+
+        yield (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{self.file_field}"; filename="{self.filename}"\r\n'
+            f"Content-Type: {self.file_content_type}\r\n\r\n"
+        ).encode("utf-8")
+
+        async for chunk in self.chunks:
+            if not chunk:
+                continue
+            self.size += len(chunk)
+            if self.size > self.max_bytes:
+                raise ImageTooLargeError(self.max_bytes)
+            self._sha256.update(chunk)
+            yield chunk
+
+        self._consumed = True
+        yield b"\r\n" + self._field_part(self.digest_field, self._sha256.hexdigest())
+        yield f"--{self.boundary}--\r\n".encode("utf-8")
@@ -0,0 +1,68 @@
+from typing import List
+
+# LINE單則文字訊息的字數上限與單次回覆的訊息數上限
+LINE_TEXT_LIMIT = 5000
+LINE_REPLY_MESSAGE_LIMIT = 5
+
+# 優先在段落、換行、句尾切分
+_BOUNDARIES = ("\n\n", "\n", "。", "！", "？", "!", "?", ". ")
+
+
+class TextSegmenter:
+    """
+    將串流文字切成適合分段傳送的訊息
+
+    累積到target_chars後在最近的段落或句尾切開；找不到切點且超過
+    max_chars時強制切分。
+    """
+
+    def __init__(self, target_chars: int = 1000, max_chars: int = LINE_TEXT_LIMIT):
+        self.target_chars = min(target_chars, max_chars)
+        self.max_chars = max_chars
+        self._buffer = ""
+
+    def _cut_position(self) -> int:
+        window = self._buffer[:self.max_chars]
+        for boundary in _BOUNDARIES:
+            position = window.rfind(boundary, self.target_chars // 2)
+            if position != -1:
+                return position + len(boundary)
+        if len(self._buffer) < self.max_chars:
+            return -1
+        # 已達字數上限：退而求其次使用較前面的切點，都沒有才強制切分
+        for boundary in _BOUNDARIES:
+            position = window.rfind(boundary, 1)
+            if position != -1:
+                return position + len(boundary)
+        return self.max_chars
+
+    def feed(self, text: str) -> List[str]:
+        """加入新文字，回傳已完成的段落"""
+        self._buffer += text
+        segments = []
+        while len(self._buffer) >= self.target_chars:
+            position = self._cut_position()
+            if position == -1:
+                break
+            segment = self._buffer[:position].strip()
+            self._buffer = self._buffer[position:]
+            if segment:
+                segments.append(segment)
+        return segments
+
+    def flush(self) -> List[str]:
+        """串流結束時取出剩餘文字"""
+        segment = self._buffer.strip()
+        self._buffer = ""
+        return [segment] if segment else []
+
+
+def pack_messages(segments: List[str], limit: int = LINE_REPLY_MESSAGE_LIMIT, max_chars: int = LINE_TEXT_LIMIT) -> List[str]:
+    """段落數超過單次回覆上限時，將尾端段落合併，超出字數上限的部分截斷"""
+    if len(segments) <= limit:
+        return segments
+    head = segments[:limit - 1]
+    tail = "\n\n".join(segments[limit - 1:])
+    if len(tail) > max_chars:
+        tail = tail[:max_chars - 1] + "…"
+    return head + [tail]
@@ -0,0 +1,95 @@
+"""
+本機模擬的LINE Messaging API伺服器，用於離線壓測
+
+啟動方式:
+    python -m benchmarks.fake_line_api --port 9100 --latency-ms 20
+
+閘道設定:
+    LINE_API_BASE_URL=http://127.0.0.1:9100
+    LINE_DATA_API_BASE_URL=http://127.0.0.1:9100
+"""
+import os
+import asyncio
+import argparse
+import logging
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+logger = logging.getLogger(__name__)
+
+# 模擬延遲與內容大小
+FAKE_LINE_LATENCY_MS = float(os.getenv("FAKE_LINE_LATENCY_MS", "20"))
+FAKE_LINE_CONTENT_BYTES = int(os.getenv("FAKE_LINE_CONTENT_BYTES", str(512 * 1024)))
+CONTENT_CHUNK_SIZE = 64 * 1024
+
+app = FastAPI(title="Fake LINE Messaging API")
+app.state.stats = {"reply": 0, "push": 0, "content": 0}
+
+
+async def _simulate_latency():
+    if FAKE_LINE_LATENCY_MS > 0:
+        await asyncio.sleep(FAKE_LINE_LATENCY_MS / 1000)
+
+
+@app.post("/v2/bot/message/reply")
+async def reply(request: Request):
+    payload = await request.json()
+    await _simulate_latency()
+    app.state.stats["reply"] += 1
+    if not payload.get("replyToken"):
+        return JSONResponse(status_code=400, content={"message": "Invalid reply token"})
+    return {}
+
+
+@app.post("/v2/bot/message/push")
+async def push(request: Request):
+    await request.json()
+    await _simulate_latency()
+    app.state.stats["push"] += 1
+    return {}
+
+
+@app.get("/v2/bot/message/{message_id}/content")
+async def content(message_id: str):
+    await _simulate_latency()
+    app.state.stats["content"] += 1
+
+    async def body():
+        remaining = FAKE_LINE_CONTENT_BYTES
+        chunk = b"\xff" * CONTENT_CHUNK_SIZE
+        while remaining > 0:
+            size = min(remaining, CONTENT_CHUNK_SIZE)
+            yield chunk[:size]
+            remaining -= size
+
+    return StreamingResponse(
+        body(),
+        media_type="image/jpeg",
+        headers={"Content-Length": str(FAKE_LINE_CONTENT_BYTES)}
+    )
+
+
+@app.get("/stats")
+async def stats():
+    return app.state.stats
+
+
+def main():
+    global FAKE_LINE_LATENCY_MS, FAKE_LINE_CONTENT_BYTES
+
+    arg_parser = argparse.ArgumentParser(description="Fake LINE Messaging API server")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=9100)
+    arg_parser.add_argument("--latency-ms", type=float, default=FAKE_LINE_LATENCY_MS)
+    arg_parser.add_argument("--content-bytes", type=int, default=FAKE_LINE_CONTENT_BYTES)
+    args = arg_parser.parse_args()
+
+    FAKE_LINE_LATENCY_MS = args.latency_ms
+    FAKE_LINE_CONTENT_BYTES = args.content_bytes
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
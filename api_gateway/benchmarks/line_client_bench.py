@@ -0,0 +1,124 @@
+"""
+非同步LINE客戶端吞吐量壓測
+
+在本機啟動模擬LINE API伺服器，比較AsyncLineClient與同步LineBotApi
+(在事件迴圈中直接呼叫)的回覆吞吐量與延遲。
+
+執行方式 (於 api_gateway 目錄):
+    python -m benchmarks.line_client_bench --requests 2000 --concurrency 100
+"""
+import time
+import asyncio
+import argparse
+import threading
+
+import uvicorn
+
+from benchmarks import fake_line_api
+from app.services.line_client import AsyncLineClient
+
+
+def start_fake_server(port: int) -> uvicorn.Server:
+    """在背景執行緒啟動模擬LINE API伺服器"""
+    config = uvicorn.Config(fake_line_api.app, host="127.0.0.1", port=port, log_level="warning")
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def summarize(name: str, latencies: list, elapsed: float, errors: int):
+    latencies = sorted(latencies)
+
+    def pct(q):
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(q * (len(latencies) - 1)))] * 1000
+
+    total = len(latencies) + errors
+    print(
+        f"{name:<22} requests={total:<6} errors={errors:<4} "
+        f"throughput={total / elapsed:8.1f} req/s  "
+        f"p50={pct(0.50):7.2f}ms p95={pct(0.95):7.2f}ms p99={pct(0.99):7.2f}ms"
+    )
+
+
+async def run_async_client(base_url: str, requests: int, concurrency: int):
+    client = AsyncLineClient(
+        "benchmark-token",
+        api_base_url=base_url,
+        data_api_base_url=base_url,
+        max_connections=concurrency,
+        max_keepalive=concurrency
+    )
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(index):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await client.reply_message(f"token-{index}", {"type": "text", "text": "hello"})
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - started
+    await client.aclose()
+    summarize("AsyncLineClient", latencies, elapsed, errors)
+
+
+async def run_sync_client(base_url: str, requests: int, concurrency: int):
+    from linebot import LineBotApi
+    from linebot.models import TextSendMessage
+
+    api = LineBotApi("benchmark-token", endpoint=base_url)
+    latencies = []
+    errors = 0
+
+    async def one(index):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            # 與舊版閘道相同：在協程中直接呼叫同步API
+            api.reply_message(f"token-{index}", TextSendMessage(text="hello"))
+            latencies.append(time.perf_counter() - started)
+        except Exception:
+            errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - started
+    summarize("LineBotApi (blocking)", latencies, elapsed, errors)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="LINE client throughput benchmark")
+    arg_parser.add_argument("--port", type=int, default=9100)
+    arg_parser.add_argument("--requests", type=int, default=2000)
+    arg_parser.add_argument("--concurrency", type=int, default=100)
+    arg_parser.add_argument("--latency-ms", type=float, default=20)
+    arg_parser.add_argument("--sync-requests", type=int, default=100,
+                            help="同步客戶端的請求數 (0 表示略過)")
+    args = arg_parser.parse_args()
+
+    fake_line_api.FAKE_LINE_LATENCY_MS = args.latency_ms
+    server = start_fake_server(args.port)
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    try:
+        asyncio.run(run_async_client(base_url, args.requests, args.concurrency))
+        if args.sync_requests > 0:
+            asyncio.run(run_sync_client(base_url, args.sync_requests, args.concurrency))
+    finally:
+        server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
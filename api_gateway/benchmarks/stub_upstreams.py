@@ -0,0 +1,129 @@
+"""
+user_service / chat_service / image_service 的本機替身，用於閘道壓測
+
+三個服務的路由互不衝突，因此由同一個程序提供：
+    python -m benchmarks.stub_upstreams --port 9200 --chat-latency-ms 300
+
+閘道設定:
+    USER_SERVICE_URL=CHAT_SERVICE_URL=IMAGE_SERVICE_URL=http://127.0.0.1:9200
+"""
+import os
+import json
+import random
+import asyncio
+import argparse
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# 模擬延遲與錯誤率
+STUB_USER_LATENCY_MS = float(os.getenv("STUB_USER_LATENCY_MS", "5"))
+STUB_CHAT_LATENCY_MS = float(os.getenv("STUB_CHAT_LATENCY_MS", "300"))
+STUB_IMAGE_LATENCY_MS = float(os.getenv("STUB_IMAGE_LATENCY_MS", "800"))
+STUB_ERROR_RATE = float(os.getenv("STUB_ERROR_RATE", "0"))
+# 串流模式下第一段文字佔總延遲的比例
+STUB_CHAT_TTFT_RATIO = float(os.getenv("STUB_CHAT_TTFT_RATIO", "0.3"))
+
+app = FastAPI(title="Stub upstream services")
+app.state.stats = {"update_activity": 0, "chat": 0, "image": 0, "image_bytes": 0, "errors": 0}
+
+
+async def _simulate(latency_ms: float):
+    # 以±20%的隨機抖動模擬真實延遲分佈
+    if latency_ms > 0:
+        await asyncio.sleep(latency_ms * random.uniform(0.8, 1.2) / 1000)
+    if STUB_ERROR_RATE > 0 and random.random() < STUB_ERROR_RATE:
+        app.state.stats["errors"] += 1
+        return JSONResponse(status_code=503, content={"detail": "stub error"})
+    return None
+
+
+@app.get("/")
+async def health_check():
+    return {"status": "ok", "service": "stub_upstreams"}
+
+
+@app.post("/users/update_activity")
+async def update_activity(request: Request):
+    payload = await request.json()
+    app.state.stats["update_activity"] += 1
+    error = await _simulate(STUB_USER_LATENCY_MS)
+    if error is not None:
+        return error
+    return {"status": "success", "line_user_id": payload.get("line_user_id")}
+
+
+@app.post("/chat/process")
+async def chat_process(request: Request):
+    payload = await request.json()
+    app.state.stats["chat"] += 1
+    error = await _simulate(STUB_CHAT_LATENCY_MS)
+    if error is not None:
+        return error
+    return {
+        "response": f"收到: {payload.get('message', '')[:50]}",
+        "provider": payload.get("model_provider") or "openai"
+    }
+
+
+@app.post("/chat/stream")
+async def chat_stream(request: Request):
+    payload = await request.json()
+    app.state.stats["chat"] += 1
+    error = await _simulate(STUB_CHAT_LATENCY_MS * STUB_CHAT_TTFT_RATIO)
+    if error is not None:
+        return error
+    
+    async def events():
+        pieces = ["收到", ": ", payload.get("message", "")[:50]]
+        interval = STUB_CHAT_LATENCY_MS * (1 - STUB_CHAT_TTFT_RATIO) / len(pieces) / 1000
+        for piece in pieces:
+            yield f"event: delta\ndata: {json.dumps({'text': piece}, ensure_ascii=False)}\n\n"
+            await asyncio.sleep(interval)
+        done = {"response": "".join(pieces), "provider": payload.get("model_provider") or "openai"}
+        yield f"event: done\ndata: {json.dumps(done, ensure_ascii=False)}\n\n"
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/images/analyze")
+async def images_analyze(request: Request):
+    # 直接讀取原始串流，不解析multipart，只統計大小
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+    app.state.stats["image"] += 1
+    app.state.stats["image_bytes"] += size
+    error = await _simulate(STUB_IMAGE_LATENCY_MS)
+    if error is not None:
+        return error
+    return {"analysis": f"圖片大小約 {size} bytes", "model": "stub"}
+
+
+@app.get("/stats")
+async def stats():
+    return app.state.stats
+
+
+def main():
+    global STUB_USER_LATENCY_MS, STUB_CHAT_LATENCY_MS, STUB_IMAGE_LATENCY_MS, STUB_ERROR_RATE
+
+    arg_parser = argparse.ArgumentParser(description="Stub upstream services")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=9200)
+    arg_parser.add_argument("--user-latency-ms", type=float, default=STUB_USER_LATENCY_MS)
+    arg_parser.add_argument("--chat-latency-ms", type=float, default=STUB_CHAT_LATENCY_MS)
+    arg_parser.add_argument("--image-latency-ms", type=float, default=STUB_IMAGE_LATENCY_MS)
+    arg_parser.add_argument("--error-rate", type=float, default=STUB_ERROR_RATE)
+    args = arg_parser.parse_args()
+
+    STUB_USER_LATENCY_MS = args.user_latency_ms
+    STUB_CHAT_LATENCY_MS = args.chat_latency_ms
+    STUB_IMAGE_LATENCY_MS = args.image_latency_ms
+    STUB_ERROR_RATE = args.error_rate
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
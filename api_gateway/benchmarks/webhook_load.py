@@ -0,0 +1,349 @@
+"""
+簽章webhook壓測工具
+
+產生逼真的LINE webhook請求(文字、圖片、多事件批次)，以頻道密鑰簽章後
+依固定到達率(open-loop)送往閘道的 /webhook，回報延遲百分位數、吞吐量與
+錯誤率，並可儲存基準線供之後比較。
+
+使用本機替身 (fake LINE + stub upstreams + 閘道) 執行:
+    python -m benchmarks.webhook_load --spawn --rates 50,100,200 --duration 20
+
+對既有閘道執行並與基準線比較:
+    python -m benchmarks.webhook_load --url http://127.0.0.1:8000 --secret xxx \\
+        --rates 100 --compare baseline.json
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import hmac
+import base64
+import random
+import socket
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import subprocess
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+GATEWAY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLE_TEXTS = [
+    "你好",
+    "今天天氣如何？",
+    "可以幫我翻譯這句話嗎: Where is the train station?",
+    "/gemini 介紹一下台北101",
+    "/openai 幫我寫一首關於秋天的短詩",
+    "推薦幾本適合初學者的Python書籍",
+    "謝謝！",
+    "我想了解更多關於你們的服務內容，請問有哪些方案可以選擇？價格大概是多少？",
+]
+
+
+class WebhookPayloadFactory:
+    """產生LINE webhook請求內容"""
+
+    def __init__(self, users: int = 1000, image_ratio: float = 0.1,
+                 batch_ratio: float = 0.1, max_batch: int = 5, seed: Optional[int] = None):
+        self.users = [f"U{uuid.UUID(int=i).hex}" for i in range(users)]
+        self.image_ratio = image_ratio
+        self.batch_ratio = batch_ratio
+        self.max_batch = max_batch
+        self.random = random.Random(seed)
+        self._message_id = 100000000000
+
+    def _next_message_id(self) -> str:
+        self._message_id += 1
+        return str(self._message_id)
+
+    def event(self, user_id: str) -> Dict:
+        timestamp = int(time.time() * 1000)
+        event = {
+            "type": "message",
+            "mode": "active",
+            "timestamp": timestamp,
+            "source": {"type": "user", "userId": user_id},
+            "webhookEventId": uuid.uuid4().hex.upper()[:26],
+            "deliveryContext": {"isRedelivery": False},
+            "replyToken": uuid.uuid4().hex,
+        }
+        if self.random.random() < self.image_ratio:
+            event["message"] = {
+                "type": "image",
+                "id": self._next_message_id(),
+                "contentProvider": {"type": "line"},
+            }
+        else:
+            event["message"] = {
+                "type": "text",
+                "id": self._next_message_id(),
+                "text": self.random.choice(SAMPLE_TEXTS),
+            }
+        return event
+
+    def payload(self) -> Dict:
+        user_id = self.random.choice(self.users)
+        count = 1
+        if self.random.random() < self.batch_ratio:
+            count = self.random.randint(2, self.max_batch)
+        return {
+            "destination": "Ubenchmarkdestination",
+            "events": [self.event(user_id) for _ in range(count)],
+        }
+
+
+def sign(body: bytes, channel_secret: str) -> str:
+    """計算X-Line-Signature"""
+    digest = hmac.new(channel_secret.encode("utf-8"), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))]
+
+
+async def run_step(url: str, secret: str, factory: WebhookPayloadFactory,
+                   rate: float, duration: float, max_outstanding: int) -> Dict:
+    """以固定到達率送出請求，不因回應變慢而降低送出速度"""
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    skipped = 0
+    events_sent = 0
+    outstanding = 0
+    tasks = []
+
+    limits = httpx.Limits(max_connections=max_outstanding, max_keepalive_connections=max_outstanding)
+    async with httpx.AsyncClient(limits=limits, timeout=30.0) as client:
+
+        async def send(body: bytes):
+            nonlocal outstanding
+            started = time.perf_counter()
+            try:
+                response = await client.post(
+                    f"{url}/webhook",
+                    content=body,
+                    headers={"Content-Type": "application/json", "X-Line-Signature": sign(body, secret)}
+                )
+                key = str(response.status_code)
+                if response.status_code == 200:
+                    latencies.append(time.perf_counter() - started)
+            except httpx.HTTPError as e:
+                key = type(e).__name__
+            finally:
+                outstanding -= 1
+            statuses[key] = statuses.get(key, 0) + 1
+
+        total = int(rate * duration)
+        started = time.perf_counter()
+        for index in range(total):
+            due = started + index / rate
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if outstanding >= max_outstanding:
+                skipped += 1
+                continue
+            payload = factory.payload()
+            events_sent += len(payload["events"])
+            outstanding += 1
+            tasks.append(asyncio.create_task(send(json.dumps(payload).encode("utf-8"))))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+    sent = sum(statuses.values())
+    errors = sent - statuses.get("200", 0)
+    return {
+        "target_rate": rate,
+        "duration": round(elapsed, 3),
+        "requests": sent,
+        "events": events_sent,
+        "skipped": skipped,
+        "throughput": round(statuses.get("200", 0) / elapsed, 2) if elapsed else 0.0,
+        "error_rate": round(errors / sent, 4) if sent else 0.0,
+        "statuses": statuses,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 3),
+            "p95": round(percentile(latencies, 0.95) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "max": round(max(latencies) * 1000, 3) if latencies else 0.0,
+        },
+    }
+
+
+def print_step(result: Dict):
+    latency = result["latency_ms"]
+    print(
+        f"rate={result['target_rate']:>7.1f}/s  sent={result['requests']:<6} "
+        f"ok/s={result['throughput']:>8.1f}  err={result['error_rate'] * 100:5.2f}%  "
+        f"skipped={result['skipped']:<5} p50={latency['p50']:7.2f}ms "
+        f"p95={latency['p95']:7.2f}ms p99={latency['p99']:7.2f}ms"
+    )
+
+
+def compare(results: List[Dict], baseline: Dict, max_regression: float) -> bool:
+    """與基準線比較，p95延遲或錯誤率退步超過門檻時回傳False"""
+    ok = True
+    by_rate = {step["target_rate"]: step for step in baseline.get("results", [])}
+    print("\n與基準線比較:")
+    for step in results:
+        base = by_rate.get(step["target_rate"])
+        if base is None:
+            print(f"rate={step['target_rate']}: 基準線沒有此速率")
+            continue
+        for metric in ("p50", "p95", "p99"):
+            current = step["latency_ms"][metric]
+            previous = base["latency_ms"][metric]
+            change = (current - previous) / previous if previous else 0.0
+            flag = ""
+            if metric == "p95" and change > max_regression:
+                flag = "  <-- 退步"
+                ok = False
+            print(f"rate={step['target_rate']:>7.1f}/s {metric}: {previous:8.2f}ms -> {current:8.2f}ms ({change:+.1%}){flag}")
+        if step["error_rate"] > base["error_rate"] + 0.01:
+            print(f"rate={step['target_rate']:>7.1f}/s error_rate: {base['error_rate']:.2%} -> {step['error_rate']:.2%}  <-- 退步")
+            ok = False
+    return ok
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_ready(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"服務未就緒: {url}")
+
+
+def spawn_stack(args, secret: str) -> Tuple[str, List[subprocess.Popen], str, str]:
+    """以子程序啟動fake LINE、上游替身與閘道"""
+    line_port, stub_port, gateway_port = _free_port(), _free_port(), _free_port()
+    log_dir = tempfile.mkdtemp(prefix="webhook_load_")
+    processes = []
+
+    def start(cmd, env=None):
+        process = subprocess.Popen(
+            cmd, cwd=GATEWAY_DIR, env={**os.environ, **(env or {})},
+            stdout=subprocess.DEVNULL, stderr=open(os.path.join(log_dir, f"{len(processes)}.log"), "w")
+        )
+        processes.append(process)
+
+    start([sys.executable, "-m", "benchmarks.fake_line_api", "--port", str(line_port),
+           "--latency-ms", str(args.line_latency_ms), "--content-bytes", str(args.image_bytes)])
+    start([sys.executable, "-m", "benchmarks.stub_upstreams", "--port", str(stub_port),
+           "--chat-latency-ms", str(args.chat_latency_ms), "--image-latency-ms", str(args.image_latency_ms),
+           "--error-rate", str(args.stub_error_rate)])
+
+    stub_url = f"http://127.0.0.1:{stub_port}"
+    gateway_env = {
+        "LINE_CHANNEL_SECRET": secret,
+        "LINE_CHANNEL_ACCESS_TOKEN": "benchmark-token",
+        "LINE_API_BASE_URL": f"http://127.0.0.1:{line_port}",
+        "LINE_DATA_API_BASE_URL": f"http://127.0.0.1:{line_port}",
+        "USER_SERVICE_URL": stub_url,
+        "CHAT_SERVICE_URL": stub_url,
+        "IMAGE_SERVICE_URL": stub_url,
+        "REDIS_HOST": args.redis_host,
+        "LOG_FILE": os.path.join(log_dir, "api_gateway.log"),
+        "LOG_LEVEL": "WARNING",
+    }
+    if not args.keep_rate_limits:
+        for kind in ("TEXT", "IMAGE"):
+            for scope in ("USER", "GLOBAL"):
+                gateway_env[f"RATE_LIMIT_{kind}_{scope}_RATE"] = "0"
+    start([sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1",
+           "--port", str(gateway_port), "--log-level", "warning"], gateway_env)
+
+    _wait_ready(f"http://127.0.0.1:{line_port}/stats")
+    _wait_ready(f"{stub_url}/")
+    gateway_url = f"http://127.0.0.1:{gateway_port}"
+    _wait_ready(f"{gateway_url}/")
+    print(f"本機替身已啟動 (日誌: {log_dir})")
+    return gateway_url, processes, f"http://127.0.0.1:{line_port}", stub_url
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Signed LINE webhook load generator")
+    arg_parser.add_argument("--url", default="http://127.0.0.1:8000", help="閘道位址")
+    arg_parser.add_argument("--secret", default=os.getenv("LINE_CHANNEL_SECRET", "benchmark-secret"))
+    arg_parser.add_argument("--rates", default="50,100,200", help="逗號分隔的每秒請求數")
+    arg_parser.add_argument("--duration", type=float, default=20.0, help="每個速率的秒數")
+    arg_parser.add_argument("--max-outstanding", type=int, default=1000)
+    arg_parser.add_argument("--users", type=int, default=1000)
+    arg_parser.add_argument("--image-ratio", type=float, default=0.1)
+    arg_parser.add_argument("--batch-ratio", type=float, default=0.1)
+    arg_parser.add_argument("--seed", type=int, default=None)
+    arg_parser.add_argument("--save-baseline", help="將結果儲存為基準線JSON")
+    arg_parser.add_argument("--compare", help="與基準線JSON比較")
+    arg_parser.add_argument("--max-regression", type=float, default=0.2, help="允許的p95退步比例")
+    arg_parser.add_argument("--spawn", action="store_true", help="啟動本機替身與閘道")
+    arg_parser.add_argument("--keep-rate-limits", action="store_true", help="--spawn時保留閘道限流")
+    arg_parser.add_argument("--redis-host", default="127.0.0.1")
+    arg_parser.add_argument("--line-latency-ms", type=float, default=20)
+    arg_parser.add_argument("--chat-latency-ms", type=float, default=300)
+    arg_parser.add_argument("--image-latency-ms", type=float, default=800)
+    arg_parser.add_argument("--image-bytes", type=int, default=512 * 1024)
+    arg_parser.add_argument("--stub-error-rate", type=float, default=0.0)
+    args = arg_parser.parse_args()
+
+    processes = []
+    line_url = stub_url = None
+    url = args.url.rstrip("/")
+    if args.spawn:
+        url, processes, line_url, stub_url = spawn_stack(args, args.secret)
+
+    try:
+        factory = WebhookPayloadFactory(args.users, args.image_ratio, args.batch_ratio, seed=args.seed)
+        results = []
+        for rate in [float(value) for value in args.rates.split(",") if value]:
+            result = asyncio.run(run_step(url, args.secret, factory, rate, args.duration, args.max_outstanding))
+            print_step(result)
+            results.append(result)
+
+        report = {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": {key: value for key, value in vars(args).items() if key != "secret"},
+            "results": results,
+        }
+        if args.spawn:
+            # 等待背景工作者處理完畢，再收集閘道與替身的統計
+            time.sleep(min(10.0, args.chat_latency_ms / 1000 * 5 + 2))
+            report["gateway_metrics"] = httpx.get(f"{url}/metrics").json()
+            report["line_stats"] = httpx.get(f"{line_url}/stats").json()
+            report["upstream_stats"] = httpx.get(f"{stub_url}/stats").json()
+            print(f"LINE回覆: {report['line_stats']}  上游呼叫: {report['upstream_stats']}")
+
+        if args.save_baseline:
+            with open(args.save_baseline, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"基準線已儲存: {args.save_baseline}")
+
+        if args.compare:
+            with open(args.compare, encoding="utf-8") as f:
+                baseline = json.load(f)
+            if not compare(results, baseline, args.max_regression):
+                sys.exit(1)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import tempfile
+
+# 測試不寫入容器內的日誌目錄
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.gettempdir(), "api_gateway_test.log"))
@@ -0,0 +1,62 @@
+import asyncio
+from types import SimpleNamespace
+
+import fakeredis.aioredis
+
+from app.services.dedup import EventDeduplicator
+
+
+def event(event_id, redelivery=False):
+    return SimpleNamespace(webhook_event_id=event_id, delivery_context=SimpleNamespace(is_redelivery=redelivery))
+
+
+def test_redis_claims_events_across_replicas():
+    async def scenario():
+        redis_client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        first = EventDeduplicator(redis_client)
+        second = EventDeduplicator(redis_client)
+        assert len(await first.filter_new([event("a"), event("b")])) == 2
+        # 另一個副本收到重送的事件
+        assert await second.filter_new([event("a", redelivery=True), event("c")]) == [event("c")]
+        assert await redis_client.ttl("webhook_event:a") > 0
+
+    asyncio.run(scenario())
+
+
+def test_local_lru_filters_duplicates_in_same_batch_window():
+    async def scenario():
+        dedup = EventDeduplicator(None, local_capacity=2)
+        assert len(await dedup.filter_new([event("a")])) == 1
+        assert await dedup.filter_new([event("a")]) == []
+        await dedup.filter_new([event("b"), event("c")])
+        # 超出容量後最舊的ID被淘汰
+        assert len(await dedup.filter_new([event("a")])) == 1
+
+    asyncio.run(scenario())
+
+
+def test_forget_allows_redelivery_to_be_processed():
+    async def scenario():
+        redis_client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        dedup = EventDeduplicator(redis_client)
+        events = [event("a")]
+        assert await dedup.filter_new(events) == events
+        await dedup.forget(events)
+        assert await dedup.filter_new(events) == events
+
+    asyncio.run(scenario())
+
+
+def test_events_without_id_always_pass_and_redis_errors_fall_back_to_local():
+    class BrokenRedis:
+        def pipeline(self, transaction=False):
+            raise ConnectionError("down")
+
+    async def scenario():
+        dedup = EventDeduplicator(BrokenRedis())
+        no_id = SimpleNamespace(webhook_event_id=None)
+        assert await dedup.filter_new([no_id, no_id]) == [no_id, no_id]
+        assert len(await dedup.filter_new([event("a")])) == 1
+        assert await dedup.filter_new([event("a")]) == []
+
+    asyncio.run(scenario())
@@ -0,0 +1,58 @@
+import asyncio
+
+from app.services.event_worker import EventWorkerPool
+
+
+def test_rejects_whole_batch_when_queue_is_full():
+    async def scenario():
+        pool = EventWorkerPool(lambda events: asyncio.sleep(0), workers=1, max_queue_size=2, name="test_full")
+        assert pool.submit_many(["a", "b"])
+        assert not pool.submit_many(["c"])
+        await pool.start()
+        await pool.stop(timeout=1)
+        assert pool.submit_many(["c", "d"])
+
+    asyncio.run(scenario())
+
+
+def test_events_of_same_key_run_in_order_and_errors_do_not_stop_workers():
+    handled = []
+
+    async def handler(events):
+        for event in events:
+            if event == "boom":
+                raise RuntimeError(event)
+            await asyncio.sleep(0.001)
+            handled.append(event)
+
+    async def scenario():
+        pool = EventWorkerPool(handler, workers=4, name="test_order", key_func=lambda event: event[0])
+        await pool.start()
+        assert pool.submit_many(["a1", "b1", "a2", "boom", "b2", "a3"])
+        await pool.stop(timeout=1)
+
+    asyncio.run(scenario())
+    assert [event for event in handled if event[0] == "a"] == ["a1", "a2", "a3"]
+    assert [event for event in handled if event[0] == "b"] == ["b1", "b2"]
+
+
+def test_debounce_coalesces_same_group():
+    batches = []
+
+    async def handler(events):
+        batches.append(list(events))
+
+    async def scenario():
+        pool = EventWorkerPool(
+            handler, workers=1, name="test_debounce",
+            key_func=lambda event: "user", group_func=lambda event: "text", debounce=0.05
+        )
+        await pool.start()
+        pool.submit_many(["hello"])
+        await asyncio.sleep(0.01)
+        pool.submit_many(["world"])
+        await asyncio.sleep(0.2)
+        await pool.stop(timeout=1)
+
+    asyncio.run(scenario())
+    assert batches == [["hello", "world"]]
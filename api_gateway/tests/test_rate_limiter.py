@@ -0,0 +1,68 @@
+import asyncio
+
+import fakeredis.aioredis
+
+from app.services.rate_limiter import BucketConfig, RateLimiter
+
+
+def buckets(user_capacity=2, global_capacity=100):
+    return {
+        "text": {
+            "user": BucketConfig(rate=1, capacity=user_capacity),
+            "global": BucketConfig(rate=10, capacity=global_capacity),
+        }
+    }
+
+
+def test_lua_bucket_rejects_after_burst_and_notifies_once():
+    async def scenario():
+        limiter = RateLimiter(fakeredis.aioredis.FakeRedis(), buckets())
+        assert (await limiter.acquire("text", "u1")).allowed
+        assert (await limiter.acquire("text", "u1")).allowed
+        rejected = await limiter.acquire("text", "u1")
+        assert not rejected.allowed and rejected.notify
+        assert 0 < rejected.retry_after <= 1
+        # 封鎖期間在行程內直接拒絕，不再通知
+        again = await limiter.acquire("text", "u1")
+        assert not again.allowed and not again.notify
+        # 其他用戶不受影響
+        assert (await limiter.acquire("text", "u2")).allowed
+
+    asyncio.run(scenario())
+
+
+def test_buckets_are_shared_across_replicas_through_redis():
+    async def scenario():
+        redis_client = fakeredis.aioredis.FakeRedis()
+        first = RateLimiter(redis_client, buckets())
+        second = RateLimiter(redis_client, buckets())
+        assert (await first.acquire("text", "u1")).allowed
+        assert (await second.acquire("text", "u1")).allowed
+        assert not (await second.acquire("text", "u1")).allowed
+
+    asyncio.run(scenario())
+
+
+def test_global_bucket_rejects_without_consuming_user_tokens():
+    async def scenario():
+        redis_client = fakeredis.aioredis.FakeRedis()
+        limiter = RateLimiter(redis_client, buckets(user_capacity=5, global_capacity=1))
+        assert (await limiter.acquire("text", "u1")).allowed
+        assert not (await limiter.acquire("text", "u2")).allowed
+        # 任一桶不足時全部不扣，u2的用戶桶仍是滿的
+        tokens = await redis_client.hget("rate_limit:text:user:u2", "tokens")
+        assert tokens is None
+
+    asyncio.run(scenario())
+
+
+def test_falls_back_to_local_buckets_without_redis():
+    async def scenario():
+        limiter = RateLimiter(None, buckets())
+        assert (await limiter.acquire("text", "u1")).allowed
+        assert (await limiter.acquire("text", "u1")).allowed
+        assert not (await limiter.acquire("text", "u1")).allowed
+        # 未設定的類型不限流
+        assert (await limiter.acquire("image", "u1")).allowed
+
+    asyncio.run(scenario())
@@ -0,0 +1,140 @@
+import asyncio
+import hashlib
+import os
+from typing import Optional
+
+import httpx
+import pytest
+from fastapi import FastAPI, File, Form, UploadFile
+
+from app.services.line_client import AsyncLineClient, LineApiError
+from app.utils.streaming_upload import ImageTooLargeError, StreamingMultipartUpload
+
+CHUNK_SIZE = 4096
+
+# 與image_service /images/analyze相同的表單欄位，以同一套FastAPI解析器讀取
+image_service = FastAPI()
+
+
+@image_service.post("/images/analyze")
+async def analyze(
+    image: UploadFile = File(...),
+    line_user_id: str = Form(...),
+    description: Optional[str] = Form(None),
+    image_sha256: Optional[str] = Form(None)
+):
+    data = await image.read()
+    return {
+        "line_user_id": line_user_id,
+        "filename": image.filename,
+        "content_type": image.content_type,
+        "size": len(data),
+        "received_sha256": hashlib.sha256(data).hexdigest(),
+        "image_sha256": image_sha256,
+    }
+
+
+async def iterate(data: bytes, pulled: Optional[list] = None):
+    for offset in range(0, len(data), CHUNK_SIZE):
+        if pulled is not None:
+            pulled.append(offset)
+        yield data[offset:offset + CHUNK_SIZE]
+
+
+def make_upload(chunks, max_bytes=10 * 1024 * 1024):
+    return StreamingMultipartUpload(
+        chunks,
+        fields={"line_user_id": "U123"},
+        file_field="image",
+        filename="image.jpg",
+        file_content_type="image/jpeg",
+        max_bytes=max_bytes
+    )
+
+
+async def post(upload):
+    transport = httpx.ASGITransport(app=image_service)
+    async with httpx.AsyncClient(transport=transport, base_url="http://image_service") as client:
+        return await client.post("/images/analyze", content=upload, headers={"Content-Type": upload.content_type})
+
+
+def test_size_limit_stops_reading_the_source_early():
+    data = os.urandom(CHUNK_SIZE * 100)
+    pulled = []
+    upload = make_upload(iterate(data, pulled), max_bytes=CHUNK_SIZE * 3 + 1)
+
+    async def scenario():
+        sent = 0
+        with pytest.raises(ImageTooLargeError) as error:
+            async for part in upload:
+                sent += len(part)
+        return sent, error.value
+
+    sent, error = asyncio.run(scenario())
+    assert error.limit == CHUNK_SIZE * 3 + 1
+    # 超過上限的那一塊讀到後立即停止，不會讀完來源
+    assert len(pulled) == 4
+    assert upload.size == CHUNK_SIZE * 4
+    assert sent < CHUNK_SIZE * 4
+    assert upload.hexdigest is None
+
+
+def test_digest_trailer_matches_the_streamed_bytes():
+    data = os.urandom(CHUNK_SIZE * 5 + 123)
+    upload = make_upload(iterate(data))
+
+    async def scenario():
+        return b"".join([part async for part in upload])
+
+    body = asyncio.run(scenario())
+    expected = hashlib.sha256(data).hexdigest()
+    assert upload.hexdigest == expected
+    assert upload.size == len(data)
+    # 雜湊值是檔案之後的最後一個欄位
+    assert body.rindex(expected.encode()) > body.index(data[-123:])
+
+
+def test_image_service_parses_the_streamed_body_byte_for_byte():
+    data = os.urandom(CHUNK_SIZE * 7 + 5)
+    upload = make_upload(iterate(data))
+
+    response = asyncio.run(post(upload))
+    assert response.status_code == 200
+    result = response.json()
+    assert result == {
+        "line_user_id": "U123",
+        "filename": "image.jpg",
+        "content_type": "image/jpeg",
+        "size": len(data),
+        "received_sha256": hashlib.sha256(data).hexdigest(),
+        "image_sha256": hashlib.sha256(data).hexdigest(),
+    }
+
+
+def test_line_content_streams_into_the_upload_in_chunks():
+    data = os.urandom(CHUNK_SIZE * 9)
+
+    def handler(request):
+        if request.url.path.endswith("/missing/content"):
+            return httpx.Response(404, text="not found")
+        return httpx.Response(200, headers={"content-type": "image/png"}, stream=httpx.ByteStream(data))
+
+    async def scenario():
+        line = AsyncLineClient("token", data_api_base_url="https://line.test")
+        await line._client.aclose()
+        line._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            async with line.stream_message_content("1", CHUNK_SIZE) as (content, chunks):
+                upload = make_upload(chunks)
+                response = await post(upload)
+            with pytest.raises(LineApiError):
+                async with line.stream_message_content("missing", CHUNK_SIZE):
+                    pass
+        finally:
+            await line.aclose()
+        return content, response
+
+    content, response = asyncio.run(scenario())
+    assert content.headers["content-type"] == "image/png"
+    assert response.json()["received_sha256"] == hashlib.sha256(data).hexdigest()
+    assert response.json()["image_sha256"] == hashlib.sha256(data).hexdigest()
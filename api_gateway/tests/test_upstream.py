@@ -0,0 +1,154 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app.services.upstream import CircuitBreaker, CircuitOpenError, UpstreamClient
+
+
+def make_client(handler, breaker):
+    client = UpstreamClient("test", "http://upstream", max_retries=0, breaker=breaker)
+    client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return client
+
+
+def open_breaker(breaker: CircuitBreaker):
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    # 直接讓冷卻時間結束
+    breaker._opened_at -= breaker.reset_timeout
+
+
+def test_breaker_opens_and_closes_after_successful_probe():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    breaker._opened_at -= breaker.reset_timeout
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_stale_probe_release_does_not_free_next_round():
+    breaker = CircuitBreaker(failure_threshold=1)
+    open_breaker(breaker)
+    assert breaker.allow()
+    stale = breaker.probe()
+    breaker.record_failure()
+    open_breaker(breaker)
+    assert breaker.allow()
+    breaker.release(stale)
+    assert not breaker.allow()
+
+
+def test_cancelled_probe_releases_half_open_slot():
+    started = asyncio.Event()
+
+    async def handler(request):
+        started.set()
+        await asyncio.sleep(10)
+
+    async def scenario():
+        breaker = CircuitBreaker(failure_threshold=1)
+        client = make_client(handler, breaker)
+        open_breaker(breaker)
+        task = asyncio.create_task(client.get("/slow"))
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        # 名額已歸還，下一個探測可以送出
+        assert breaker.allow()
+
+    asyncio.run(scenario())
+
+
+def test_probe_failing_with_non_transport_error_releases_slot():
+    async def handler(request):
+        raise ValueError("bad request body")
+
+    async def scenario():
+        breaker = CircuitBreaker(failure_threshold=1)
+        client = make_client(handler, breaker)
+        open_breaker(breaker)
+        with pytest.raises(ValueError):
+            await client.get("/")
+        assert breaker.allow()
+
+    asyncio.run(scenario())
+
+
+def test_stream_probe_aborted_by_caller_releases_slot():
+    async def handler(request):
+        return httpx.Response(200, content=b"x" * 1024)
+
+    class TooLarge(Exception):
+        pass
+
+    async def scenario():
+        breaker = CircuitBreaker(failure_threshold=1)
+        client = make_client(handler, breaker)
+        open_breaker(breaker)
+        with pytest.raises(TooLarge):
+            async with client.stream("GET", "/image") as response:
+                async for _ in response.aiter_bytes():
+                    raise TooLarge()
+        # 收到回應標頭即記錄成功
+        assert breaker.state == CircuitBreaker.CLOSED
+
+        open_breaker(breaker)
+        with pytest.raises(TooLarge):
+            async with client.stream("GET", "/image"):
+                raise TooLarge()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    asyncio.run(scenario())
+
+
+def test_stream_probe_cancelled_before_headers_releases_slot():
+    started = asyncio.Event()
+
+    async def handler(request):
+        started.set()
+        await asyncio.sleep(10)
+
+    async def scenario():
+        breaker = CircuitBreaker(failure_threshold=1)
+        client = make_client(handler, breaker)
+        open_breaker(breaker)
+
+        async def consume():
+            async with client.stream("GET", "/image"):
+                pass
+
+        task = asyncio.create_task(consume())
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert breaker.allow()
+
+    asyncio.run(scenario())
+
+
+def test_transport_failure_during_probe_reopens():
+    async def handler(request):
+        raise httpx.ConnectError("refused")
+
+    async def scenario():
+        breaker = CircuitBreaker(failure_threshold=1)
+        client = make_client(handler, breaker)
+        open_breaker(breaker)
+        with pytest.raises(httpx.ConnectError):
+            await client.get("/")
+        assert breaker.state == CircuitBreaker.OPEN
+        with pytest.raises(CircuitOpenError):
+            await client.get("/")
+
+    asyncio.run(scenario())
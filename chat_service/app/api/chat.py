@@ -1,111 +1,245 @@
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Header
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from sqlalchemy import literal, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
 from typing import Optional, Dict, Any, Literal
+import json
+import math
+import time
 import logging
 
 from app.models.database import get_db, ChatHistory
-from app.services.openai_service import OpenAIService
-from app.services.gemini_service import GeminiService
+from app.services.provider_router import FALLBACK_MESSAGE, ProvidersUnavailable, provider_router
+from app.services.history_writer import history_writer
+from app.services.llm_scheduler import llm_scheduler, SchedulerBusy
+from app.services.adaptive_limiter import ProviderOverloaded
+from app.utils.deadline import (
+    DeadlineExceeded, parse_deadline, check_deadline, run_with_deadline, iterate_with_deadline
+)
+from app.utils.metrics import metrics
+from app.utils.pagination import InvalidCursor, decode_cursor, encode_cursor, clamp_page_size
 
 # 配置日誌
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+# 從收到請求到送出第一段文字的時間
+stream_ttft = metrics.histogram("chat_stream_ttft_seconds")
+stream_duration = metrics.histogram("chat_stream_duration_seconds")
+stream_errors = metrics.counter("chat_stream_errors_total")
+
 class ChatRequest(BaseModel):
     line_user_id: str
     message: str
     context: Optional[Dict[str, Any]] = None
-    model_provider: Optional[Literal["openai", "gemini"]] = "openai"  # 預設使用OpenAI
+    model_provider: Optional[Literal["openai", "gemini"]] = None  # 未指定時依延遲與錯誤率自動選擇
 
 class ChatResponse(BaseModel):
     response: str
     provider: str
+    fallback: bool = False  # 所有提供者都無法回應時為True，response為固定的道歉訊息
+
+def busy_retry_after(error: Exception) -> int:
+    """建議閘道重試前等待的秒數，提供者沒有提示時以排程的估計為準"""
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is None:
+        retry_after = llm_scheduler.retry_after()
+    return max(1, math.ceil(retry_after))
+
+def busy_error(request: ChatRequest, error: Exception) -> HTTPException:
+    """排程滿載或提供者限流時回應429，Retry-After告知閘道多久後可重試"""
+    logger.warning(f"聊天請求無法處理，用戶ID: {request.line_user_id}: {error}")
+    return HTTPException(
+        status_code=429,
+        detail=str(error),
+        headers={"Retry-After": str(busy_retry_after(error))}
+    )
 
 @router.post("/process", response_model=ChatResponse)
 async def process_chat(
     request: ChatRequest,
-    background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db)
+    x_request_deadline: Optional[str] = Header(None)
 ):
     """處理用戶聊天請求"""
+    deadline = parse_deadline(x_request_deadline)
     try:
-        # 根據選擇的服務生成回應
-        if request.model_provider == "gemini":
-            response_text = await GeminiService.generate_response(request.line_user_id, request.message)
-            provider = "gemini"
-        else:
-            response_text = await OpenAIService.generate_response(request.line_user_id, request.message)
-            provider = "openai"
+        # 截止時間已過則不再呼叫付費的LLM
+        check_deadline(deadline)
         
-        # 在背景保存聊天歷史到數據庫
-        background_tasks.add_task(
-            save_chat_history,
-            db=db,
+        # 依用戶輪流取得LLM名額，滿載時直接拒絕
+        async with llm_scheduler.slot(request.line_user_id, provider_router.primary(request.model_provider), deadline):
+            # 使用指定或自動選擇的服務生成回應，超過截止時間時取消進行中的呼叫
+            response_text, provider = await run_with_deadline(
+                provider_router.generate(request.line_user_id, request.message, deadline, request.model_provider),
+                deadline
+            )
+        
+        # 交由寫入佇列批次保存到數據庫
+        history_writer.submit(
             line_user_id=request.line_user_id,
             message=request.message,
             response=response_text,
             context=request.context,
-            provider=provider
+            provider=provider,
+            history=provider_router.history(request.model_provider).name
         )
         
         return ChatResponse(response=response_text, provider=provider)
+    except ProvidersUnavailable as e:
+        # 道歉訊息只回覆給用戶，不寫入歷史記錄，避免之後被當作上下文或回填
+        return ChatResponse(response=FALLBACK_MESSAGE, provider=e.provider, fallback=True)
+    except (SchedulerBusy, ProviderOverloaded) as e:
+        raise busy_error(request, e)
+    except DeadlineExceeded as e:
+        logger.warning(f"放棄聊天請求，用戶ID: {request.line_user_id}: {e}")
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         logger.error(f"處理聊天請求時出錯: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-def save_chat_history(
-    db: Session,
-    line_user_id: str,
-    message: str,
-    response: str,
-    provider: str,
-    context: Optional[Dict[str, Any]] = None
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    """組成一個server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@router.post("/stream")
+async def stream_chat(
+    request: ChatRequest,
+    x_request_deadline: Optional[str] = Header(None)
 ):
-    """將聊天歷史保存到數據庫"""
+    """
+    以server-sent events串流回應
+
+    事件依序為多個delta({"text"})，最後是done({"response", "provider"})；
+    開始串流後發生的錯誤以error({"detail"})事件通知。
+    """
+    deadline = parse_deadline(x_request_deadline)
     try:
-        # 如果context為None，初始化為空字典
-        if context is None:
-            context = {}
-        
-        # 添加提供者資訊到context
-        context["provider"] = provider
-        
-        chat_history = ChatHistory(
-            line_user_id=line_user_id,
-            message=message,
-            response=response,
-            context=context
+        check_deadline(deadline)
+        # 開始串流前取得名額，滿載時仍能以狀態碼回應429
+        lease = await llm_scheduler.acquire(
+            request.line_user_id, provider_router.primary(request.model_provider, streaming=True), deadline
         )
-        db.add(chat_history)
-        db.commit()
-        logger.info(f"已保存聊天記錄，用戶ID: {line_user_id}, 使用服務: {provider}")
-    except Exception as e:
-        db.rollback()
-        logger.error(f"保存聊天記錄時出錯: {e}")
+    except SchedulerBusy as e:
+        raise busy_error(request, e)
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    
+    # 串流結束後才知道完整回應與實際使用的提供者，之後才放入寫入佇列
+    result: Dict[str, Any] = {"provider": request.model_provider or "openai"}
+    
+    async def events():
+        started = time.perf_counter()
+        parts = []
+        try:
+            stream = provider_router.stream(request.line_user_id, request.message, deadline, request.model_provider)
+            async for provider, delta in iterate_with_deadline(stream, deadline):
+                if not parts:
+                    stream_ttft.observe(time.perf_counter() - started)
+                    result["provider"] = provider
+                parts.append(delta)
+                yield format_sse("delta", {"text": delta})
+            result["response"] = "".join(parts).strip()
+            stream_duration.observe(time.perf_counter() - started)
+            yield format_sse("done", {"response": result["response"], "provider": result["provider"]})
+        except DeadlineExceeded as e:
+            logger.warning(f"放棄串流聊天請求，用戶ID: {request.line_user_id}: {e}")
+            yield format_sse("error", {"detail": str(e), "status": 504})
+        except ProviderOverloaded as e:
+            logger.warning(f"提供者限流，串流聊天請求失敗，用戶ID: {request.line_user_id}: {e}")
+            yield format_sse("error", {"detail": str(e), "status": 429, "retry_after": busy_retry_after(e)})
+        except Exception as e:
+            stream_errors.inc()
+            logger.error(f"串流聊天請求時出錯: {e}")
+            yield format_sse("error", {"detail": str(e), "status": 500})
+        finally:
+            lease.release()
+    
+    async def persist():
+        # 用戶在串流開始前斷線時events()不會執行，在此釋放名額
+        lease.release()
+        if result.get("response"):
+            history_writer.submit(
+                line_user_id=request.line_user_id,
+                message=request.message,
+                response=result["response"],
+                context=request.context,
+                provider=result["provider"],
+                history=provider_router.history(request.model_provider).name
+            )
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(persist)
+    )
 
 @router.get("/history/{line_user_id}")
-async def get_chat_history(line_user_id: str, limit: int = 10, db: Session = Depends(get_db)):
-    """獲取用戶的聊天歷史"""
+async def get_chat_history(
+    line_user_id: str,
+    limit: int = 10,
+    before: Optional[str] = None,
+    include_context: bool = False,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    由新到舊分頁獲取用戶的聊天歷史
+
+    before為上一頁回傳的next_cursor，依(created_at, id)定位，深分頁不需掃過前面的記錄。
+    列表只讀取顯示需要的欄位，include_context=true時才附上完整context。
+    """
     try:
-        history = db.query(ChatHistory).filter(
-            ChatHistory.line_user_id == line_user_id
-        ).order_by(ChatHistory.created_at.desc()).limit(limit).all()
+        cursor = decode_cursor(before)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    limit = clamp_page_size(limit)
+    
+    try:
+        columns = [
+            ChatHistory.id,
+            ChatHistory.message,
+            ChatHistory.response,
+            ChatHistory.created_at,
+            ChatHistory.context["provider"].as_string().label("provider"),
+        ]
+        if include_context:
+            columns.append(ChatHistory.context)
+        query = select(*columns).where(ChatHistory.line_user_id == line_user_id)
+        if cursor:
+            created_at, row_id = cursor
+            query = query.where(
+                tuple_(ChatHistory.created_at, ChatHistory.id) < tuple_(literal(created_at, ChatHistory.created_at.type), literal(row_id))
+            )
+        # 多取一筆判斷是否還有下一頁
+        query = query.order_by(ChatHistory.created_at.desc(), ChatHistory.id.desc()).limit(limit + 1)
+        rows = (await db.execute(query)).all()
+        
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+        
+        history = []
+        for row in rows:
+            item = {
+                "id": row.id,
+                "message": row.message,
+                "response": row.response,
+                "created_at": row.created_at,
+                "provider": row.provider or "unknown"
+            }
+            if include_context:
+                item["context"] = row.context
+            history.append(item)
         
         return {
             "line_user_id": line_user_id,
-            "history": [
-                {
-                    "id": item.id,
-                    "message": item.message,
-                    "response": item.response,
-                    "created_at": item.created_at,
-                    "provider": item.context.get("provider", "unknown") if item.context else "unknown",
-                    "context": item.context
-                } for item in history
-            ]
+            "history": history,
+            "next_cursor": next_cursor
         }
     except Exception as e:
         logger.error(f"獲取聊天歷史時出錯: {e}")
-        raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
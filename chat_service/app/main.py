@@ -1,11 +1,17 @@
 import os
+import asyncio
 import logging
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 
 from app.api import chat
-from app.models.database import engine, Base
+from app.models.database import engine, init_db
+from app.utils.metrics import metrics
+from app.services.openai_service import OpenAIService
+from app.services import conversation_store
+from app.services.history_writer import history_writer
+from app.services.semantic_cache import semantic_cache
 
 # 加載環境變數
 load_dotenv()
@@ -28,9 +34,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# 創建表格
-Base.metadata.create_all(bind=engine)
-
 app = FastAPI(title="Chat Service")
 
 # 設置CORS
@@ -49,10 +52,28 @@ app.include_router(chat.router, prefix="/chat", tags=["chat"])
 async def health_check():
     return {"status": "ok", "service": "chat_service"}
 
+@app.get("/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
 @app.on_event("startup")
 async def startup_event():
     logger.info("Chat Service starting up")
+    # 創建表格
+    await init_db()
+    await conversation_store.migrate_legacy_history()
+    # 訂閱其他副本的寫入通知後才啟用本機歷史快取
+    await conversation_store.local_history.start()
+    await history_writer.start()
+    # 近似問題索引在背景載入，不延遲服務啟動
+    app.state.semantic_cache_load = asyncio.create_task(semantic_cache.load())
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    # 先寫完佇列中的聊天記錄
+    await history_writer.stop()
+    await OpenAIService.aclose()
+    await conversation_store.local_history.stop()
+    await conversation_store.aclose()
+    await engine.dispose()
     logger.info("Chat Service shutting down") 
\ No newline at end of file
@@ -1,17 +1,80 @@
 import os
-from sqlalchemy import Column, Integer, String, Text, DateTime, JSON, create_engine, func
+import time
+from sqlalchemy import Column, Integer, String, Text, DateTime, JSON, Index, func
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from dotenv import load_dotenv
 
+from app.utils.metrics import metrics
+
 # 加載環境變數
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-# 創建SQLAlchemy引擎
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# 連線池設定
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# asyncpg方言的prepared statement快取(URL參數prepared_statement_cache_size)，經由pgbouncer(transaction模式)連線時需設為0
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+
+db_pool_wait = metrics.histogram("db_pool_checkout_wait_seconds")
+db_pool_timeouts = metrics.counter("db_pool_checkout_timeouts_total")
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """記錄取得連線等待時間的連線池"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            # 只計入等待連線逾時，連線建立失敗等其他錯誤不算
+            db_pool_timeouts.inc()
+            raise
+        finally:
+            db_pool_wait.observe(time.perf_counter() - started)
+
+
+def async_database_url(url: str):
+    """將同步連線字串轉為非同步驅動，PostgreSQL使用asyncpg"""
+    url = make_url(url)
+    if url.drivername in ("postgresql", "postgresql+psycopg2"):
+        url = url.set(drivername="postgresql+asyncpg")
+    elif url.drivername == "sqlite":
+        url = url.set(drivername="sqlite+aiosqlite")
+    if url.drivername == "postgresql+asyncpg":
+        url = url.update_query_dict({"prepared_statement_cache_size": str(DB_STATEMENT_CACHE_SIZE)})
+    return url
+
+
+def create_engine_from_env(url: str):
+    """依環境變數建立非同步引擎"""
+    url = async_database_url(url)
+    options = {"pool_pre_ping": DB_POOL_PRE_PING}
+    if url.drivername == "postgresql+asyncpg":
+        options.update(
+            poolclass=TimedQueuePool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+        )
+    return create_async_engine(url, **options)
+
+
+# 創建SQLAlchemy非同步引擎
+engine = create_engine_from_env(DATABASE_URL)
+AsyncSessionLocal = async_sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+metrics.gauge("db_pool_checked_out", lambda: engine.pool.checkedout() if hasattr(engine.pool, "checkedout") else 0)
 
 Base = declarative_base()
 
@@ -20,16 +83,23 @@ class ChatHistory(Base):
     __tablename__ = "chat_history"
 
     id = Column(Integer, primary_key=True, index=True)
-    line_user_id = Column(String(50), nullable=False, index=True)
+    line_user_id = Column(String(50), nullable=False)
     message = Column(Text, nullable=False)
     response = Column(Text, nullable=False)
     created_at = Column(DateTime, server_default=func.now())
     context = Column(JSON, default={})
 
+    # 依用戶由新到舊列出歷史，也涵蓋只以line_user_id查詢的情況
+    __table_args__ = (
+        Index("chat_history_user_created_idx", line_user_id, created_at.desc(), id.desc()),
+    )
+
+async def init_db():
+    """創建表格"""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
 # 獲取數據庫會話
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close() 
\ No newline at end of file
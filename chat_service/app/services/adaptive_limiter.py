@@ -0,0 +1,231 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Optional
+
+from dotenv import load_dotenv
+
+from app.utils.deadline import remaining
+from app.utils.metrics import metrics
+
+# 加載環境變數
+load_dotenv()
+
+# 配置日誌
+logger = logging.getLogger(__name__)
+
+# 關閉時固定使用最大並行數且不理會Retry-After，行為與固定上限相同
+ADAPTIVE_LIMIT_ENABLED = os.getenv("ADAPTIVE_LIMIT_ENABLED", "true").lower() == "true"
+ADAPTIVE_LIMIT_MIN = int(os.getenv("ADAPTIVE_LIMIT_MIN", "2"))
+# 啟動時的並行上限，之後依結果在[MIN, 提供者最大並行數]之間調整
+ADAPTIVE_LIMIT_INITIAL = int(os.getenv("ADAPTIVE_LIMIT_INITIAL", "20"))
+# 每一輪(約等於上限數量的成功呼叫)增加的並行數
+ADAPTIVE_LIMIT_INCREASE = float(os.getenv("ADAPTIVE_LIMIT_INCREASE", "1"))
+# 遇到429/503或延遲飆高時乘上的比例
+ADAPTIVE_LIMIT_DECREASE = float(os.getenv("ADAPTIVE_LIMIT_DECREASE", "0.5"))
+# 延遲超過基準的倍數視為過載
+ADAPTIVE_LIMIT_LATENCY_TOLERANCE = float(os.getenv("ADAPTIVE_LIMIT_LATENCY_TOLERANCE", "2.5"))
+ADAPTIVE_LIMIT_MIN_SAMPLES = int(os.getenv("ADAPTIVE_LIMIT_MIN_SAMPLES", "20"))
+# 兩次調降的最短間隔，同一波過載造成的多個錯誤只調降一次
+ADAPTIVE_LIMIT_COOLDOWN = float(os.getenv("ADAPTIVE_LIMIT_COOLDOWN", "1"))
+# 提供者未給Retry-After時的暫停秒數，0表示不暫停
+ADAPTIVE_LIMIT_DEFAULT_BACKOFF = float(os.getenv("ADAPTIVE_LIMIT_DEFAULT_BACKOFF", "0"))
+# 採用提供者Retry-After的上限
+ADAPTIVE_LIMIT_MAX_BACKOFF = float(os.getenv("ADAPTIVE_LIMIT_MAX_BACKOFF", "30"))
+
+# 延遲基準的平滑係數，較小以免被過載時的延遲拉高
+BASELINE_ALPHA = 0.05
+
+# 代表提供者限流或過載的狀態碼
+OVERLOAD_STATUS_CODES = {429, 503}
+
+
+class ProviderOverloaded(Exception):
+    """提供者限流或過載(429/503)，retry_after為建議的等待秒數"""
+
+    def __init__(self, provider: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        detail = f"{provider} 限流或過載"
+        if status is not None:
+            detail = f"{detail} ({status})"
+        if retry_after is not None:
+            detail = f"{detail}，{retry_after:.1f} 秒後再試"
+        super().__init__(detail)
+        self.provider = provider
+        self.status = status
+        self.retry_after = retry_after
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    """OpenAI SDK的status_code或google.api_core的code"""
+    for attr in ("status_code", "code"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """讀取提供者的重試提示：HTTP標頭retry-after-ms/retry-after，或gRPC的RetryInfo"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if headers is not None:
+        try:
+            value = headers.get("retry-after-ms")
+            if value is not None:
+                return float(value) / 1000
+            value = headers.get("retry-after")
+            if value is not None:
+                return float(value)
+        except (TypeError, ValueError):
+            pass
+    for detail in getattr(error, "details", None) or ():
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+    return None
+
+
+def as_overload(provider: str, error: Exception) -> Optional[ProviderOverloaded]:
+    """SDK例外為限流或過載時轉成ProviderOverloaded，其餘回傳None"""
+    if isinstance(error, ProviderOverloaded):
+        return error
+    status = _status_code(error)
+    if status not in OVERLOAD_STATUS_CODES:
+        return None
+    return ProviderOverloaded(provider, status, _retry_after(error))
+
+
+class AdaptiveLimiter:
+    """
+    單一提供者的AIMD並行上限
+
+    成功且上限接近用滿時，每一輪增加ADAPTIVE_LIMIT_INCREASE；遇到429/503或延遲
+    超過基準的數倍時乘以ADAPTIVE_LIMIT_DECREASE。提供者給了Retry-After時在該時間內
+    不再送出新請求，來不及在截止時間前等到時直接拋出ProviderOverloaded，讓路由改用其他提供者。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_limit: int,
+        initial: int = ADAPTIVE_LIMIT_INITIAL,
+        min_limit: int = ADAPTIVE_LIMIT_MIN,
+        enabled: bool = ADAPTIVE_LIMIT_ENABLED
+    ):
+        self.name = name
+        self.max_limit = max_limit
+        self.min_limit = max(1, min(min_limit, max_limit))
+        self.enabled = enabled
+        self.limit = float(min(max(initial, self.min_limit), max_limit) if enabled else max_limit)
+        self._in_flight = 0
+        self._waiters = deque()
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._baseline: Optional[float] = None
+        self._samples = 0
+
+        metrics.gauge(f"{name}_concurrency_limit", lambda: int(self.limit))
+        metrics.gauge(f"{name}_limiter_waiting", lambda: len(self._waiters))
+        metrics.gauge(f"{name}_latency_baseline_seconds", lambda: round(self._baseline or 0.0, 4))
+        self._decreases = metrics.counter(f"{name}_limit_decreases_total")
+        self._overloads = metrics.counter(f"{name}_overloaded_total")
+        self._backoffs = metrics.counter(f"{name}_retry_after_total")
+        self._shed = metrics.counter(f"{name}_limiter_shed_total")
+
+    def _capacity(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    def _wake(self):
+        while self._waiters and self._in_flight < self._capacity():
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._in_flight += 1
+                waiter.set_result(None)
+
+    async def acquire(self, deadline: Optional[float] = None):
+        """取得呼叫名額；提供者要求暫停且截止時間前等不到時拋出ProviderOverloaded"""
+        wait = self._blocked_until - time.monotonic()
+        if wait > 0:
+            seconds_left = remaining(deadline)
+            if seconds_left is not None and wait >= seconds_left:
+                self._shed.inc()
+                raise ProviderOverloaded(self.name, retry_after=wait)
+            await asyncio.sleep(wait)
+
+        if not self._waiters and self._in_flight < self._capacity():
+            self._in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # 取得名額的同時被取消
+                self._in_flight -= 1
+                self._wake()
+            else:
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+            raise
+
+    def release(self, success: bool = False, latency: Optional[float] = None, error: Optional[Exception] = None):
+        """
+        歸還名額並依結果調整上限
+
+        success: 呼叫成功完成；被取消或其他錯誤不調整上限
+        latency: 完整回應的耗時，用於偵測延遲飆高；串流呼叫不提供
+        error: 呼叫失敗時的例外，只有ProviderOverloaded會調降上限
+        """
+        saturated = self._in_flight >= self.limit / 2
+        self._in_flight -= 1
+        if isinstance(error, ProviderOverloaded):
+            self._overloads.inc()
+            self._on_overload(error.retry_after)
+        elif success:
+            if latency is not None and self._is_spike(latency):
+                self._decrease(f"延遲 {latency:.2f}s 超過基準 {self._baseline:.2f}s")
+            elif saturated and self.enabled:
+                self.limit = min(float(self.max_limit), self.limit + ADAPTIVE_LIMIT_INCREASE / self.limit)
+            if latency is not None:
+                self._observe(latency)
+        self._wake()
+
+    def _is_spike(self, latency: float) -> bool:
+        return (
+            self._baseline is not None
+            and self._samples >= ADAPTIVE_LIMIT_MIN_SAMPLES
+            and latency > self._baseline * ADAPTIVE_LIMIT_LATENCY_TOLERANCE
+        )
+
+    def _observe(self, latency: float):
+        self._samples += 1
+        if self._baseline is None:
+            self._baseline = latency
+        else:
+            self._baseline = BASELINE_ALPHA * latency + (1 - BASELINE_ALPHA) * self._baseline
+
+    def _on_overload(self, retry_after: Optional[float]):
+        if not self.enabled:
+            return
+        backoff = retry_after if retry_after is not None else ADAPTIVE_LIMIT_DEFAULT_BACKOFF
+        backoff = min(backoff, ADAPTIVE_LIMIT_MAX_BACKOFF)
+        if backoff > 0:
+            self._backoffs.inc()
+            self._blocked_until = max(self._blocked_until, time.monotonic() + backoff)
+        self._decrease("提供者限流或過載")
+
+    def _decrease(self, reason: str):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if now - self._last_decrease < ADAPTIVE_LIMIT_COOLDOWN:
+            return
+        self._last_decrease = now
+        previous = self.limit
+        self.limit = max(float(self.min_limit), self.limit * ADAPTIVE_LIMIT_DECREASE)
+        self._decreases.inc()
+        logger.warning(f"{self.name} 並行上限 {previous:.0f} -> {self.limit:.0f}: {reason}")
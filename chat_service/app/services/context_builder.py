@@ -0,0 +1,231 @@
+import os
+import re
+import time
+import asyncio
+import hashlib
+import logging
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, List, Optional
+
+from dotenv import load_dotenv
+
+from app.utils.metrics import metrics
+
+# 加載環境變數
+load_dotenv()
+
+# 配置日誌
+logger = logging.getLogger(__name__)
+
+# 每次請求的提示詞token預算(含系統提示、摘要、歷史與當前訊息)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+# 從歷史中取出、供預算挑選的最多輪數
+CONTEXT_HISTORY_TURNS = int(os.getenv("CONTEXT_HISTORY_TURNS", "10"))
+# 超出視窗的舊對話是否壓縮成摘要
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "true").lower() == "true"
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "300"))
+# 累積到此輪數未摘要的對話才更新摘要，避免歷史超出預算後每個請求都呼叫一次摘要；
+# 同時提前這麼多輪摘要即將被LTRIM移出歷史的對話
+SUMMARY_BATCH_TURNS = max(1, int(os.getenv("SUMMARY_BATCH_TURNS", "4")))
+
+SUMMARY_PROMPT = (
+    "請將以下對話整理成簡潔的繁體中文摘要，保留用戶的需求、偏好與重要事實，"
+    f"不要加入對話中沒有的內容，長度不超過{SUMMARY_MAX_TOKENS}個token。"
+)
+
+# 每則訊息的格式開銷(角色、分隔符號)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_CJK = re.compile(r"[\u3000-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+prompt_tokens = {
+    "openai": metrics.histogram("openai_prompt_tokens"),
+    "gemini": metrics.histogram("gemini_prompt_tokens"),
+}
+context_tokens_saved = metrics.counter("context_tokens_saved_total")
+context_turns_dropped = metrics.counter("context_turns_dropped_total")
+summaries_created = metrics.counter("context_summaries_total")
+summary_errors = metrics.counter("context_summary_errors_total")
+summary_seconds = metrics.histogram("context_summary_seconds")
+
+# tiktoken需要下載編碼檔，無法使用時改用估算
+_encoding = None
+_encoding_failed = False
+
+
+def _get_encoding():
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            _encoding_failed = True
+            logger.warning(f"無法載入tiktoken編碼，改用估算token數: {e}")
+    return _encoding
+
+
+def estimate_tokens(text: str) -> int:
+    """估算token數：中日韓字元約一字一token，其餘約四個字元一token"""
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_tokens(text: str, provider: str = "openai") -> int:
+    """依提供者計算token數；Gemini沒有本機tokenizer，使用估算"""
+    if not text:
+        return 0
+    if provider == "openai":
+        encoding = _get_encoding()
+        if encoding is not None:
+            return len(encoding.encode(text))
+    return estimate_tokens(text)
+
+
+def turn_tokens(entry: dict, provider: str) -> int:
+    return (
+        count_tokens(entry["user"], provider)
+        + count_tokens(entry["assistant"], provider)
+        + 2 * MESSAGE_OVERHEAD_TOKENS
+    )
+
+
+def turn_digest(entry: dict) -> str:
+    return hashlib.sha1(f"{entry['user']}\x1f{entry['assistant']}".encode("utf-8")).hexdigest()[:16]
+
+
+@dataclass
+class ContextWindow:
+    """一次請求實際送出的上下文"""
+    turns: List[dict]
+    summary: Optional[str]
+    prompt_tokens: int
+    # 超出預算而未送出或即將移出歷史、且尚未被摘要涵蓋的舊對話
+    unsummarized: List[dict] = field(default_factory=list)
+    # 最舊的對話尚未被摘要涵蓋，且下一次寫入就會被移出歷史
+    urgent: bool = False
+
+
+def build_context(
+    provider: str,
+    system_prompt: str,
+    chat_history: List[dict],
+    message: str,
+    summary_record: Optional[dict] = None,
+    budget: int = CONTEXT_TOKEN_BUDGET,
+    max_turns: Optional[int] = None
+) -> ContextWindow:
+    """
+    由新到舊填入最近CONTEXT_HISTORY_TURNS輪對話直到用完token預算
+
+    系統提示、當前訊息與摘要優先保留；放不下的對話不再送出，
+    改由摘要涵蓋。當前訊息本身超過預算時仍會送出。
+    chat_history應為保留的所有對話，max_turns為歷史保留的輪數：歷史將滿時，
+    之後SUMMARY_BATCH_TURNS次寫入會移出的最舊對話也列入待摘要，即使仍在視窗內。
+    """
+    summary = summary_record.get("summary") if summary_record else None
+    used = count_tokens(system_prompt, provider) + count_tokens(message, provider) + 2 * MESSAGE_OVERHEAD_TOKENS
+    if summary:
+        used += count_tokens(summary, provider) + MESSAGE_OVERHEAD_TOKENS
+
+    selected = []
+    full_history_tokens = 0
+    window_closed = False
+    candidates = chat_history[-CONTEXT_HISTORY_TURNS:] if CONTEXT_HISTORY_TURNS > 0 else []
+    for entry in reversed(candidates):
+        cost = turn_tokens(entry, provider)
+        full_history_tokens += cost
+        # 一旦有一輪放不下，更舊的對話也不送出，保持上下文連續
+        if window_closed or used + cost > budget:
+            window_closed = True
+            continue
+        selected.append(entry)
+        used += cost
+    selected.reverse()
+
+    dropped = chat_history[:len(chat_history) - len(selected)]
+    # 送出的視窗之外與即將移出歷史的對話都是最舊的一段，取兩者較長者
+    expiring = 0
+    if max_turns:
+        expiring = min(len(chat_history), max(0, len(chat_history) + SUMMARY_BATCH_TURNS - max_turns))
+    pending = chat_history[:max(len(dropped), expiring)]
+    # 摘要已涵蓋到的對話不需再壓縮；找不到時表示已涵蓋的對話都比目前歷史更舊
+    unsummarized = pending
+    covered = summary_record.get("last_turn") if summary_record else None
+    if covered and pending:
+        digests = [turn_digest(entry) for entry in chat_history]
+        if covered in digests:
+            unsummarized = pending[digests.index(covered) + 1:]
+    urgent = bool(
+        max_turns and unsummarized and len(chat_history) >= max_turns and unsummarized[0] is chat_history[0]
+    )
+
+    sent_history_tokens = sum(turn_tokens(entry, provider) for entry in selected)
+    context_tokens_saved.inc(full_history_tokens - sent_history_tokens)
+    context_turns_dropped.inc(len(dropped))
+    if provider in prompt_tokens:
+        prompt_tokens[provider].observe(used)
+    return ContextWindow(
+        turns=selected, summary=summary, prompt_tokens=used, unsummarized=unsummarized, urgent=urgent
+    )
+
+
+def format_summary_request(previous_summary: Optional[str], turns: List[dict]) -> str:
+    """組合摘要請求的內容：舊摘要加上新移出視窗的對話"""
+    lines = []
+    if previous_summary:
+        lines.append(f"先前的摘要：{previous_summary}")
+        lines.append("")
+    lines.append("需要併入摘要的對話：")
+    for entry in turns:
+        lines.append(f"用戶：{entry['user']}")
+        lines.append(f"助手：{entry['assistant']}")
+    return "\n".join(lines)
+
+
+# 每位用戶同時只進行一個摘要工作
+_pending_summaries = set()
+_summary_tasks = set()
+
+
+def schedule_summary(
+    store,
+    line_user_id: str,
+    window: ContextWindow,
+    summarize: Callable[[Optional[str], List[dict]], Awaitable[str]]
+):
+    """
+    在背景更新滾動摘要，不佔用請求路徑
+
+    累積SUMMARY_BATCH_TURNS輪待摘要的對話才呼叫一次；最舊的對話即將被移出歷史時
+    不論數量立即摘要，避免對話在摘要前遺失。
+    """
+    if not SUMMARY_ENABLED or not window.unsummarized:
+        return
+    if len(window.unsummarized) < SUMMARY_BATCH_TURNS and not window.urgent:
+        return
+    key = (store.key_prefix, line_user_id)
+    if key in _pending_summaries:
+        return
+    _pending_summaries.add(key)
+    task = asyncio.create_task(_update_summary(store, line_user_id, window, summarize, key))
+    _summary_tasks.add(task)
+    task.add_done_callback(_summary_tasks.discard)
+
+
+async def _update_summary(store, line_user_id, window, summarize, key):
+    started = time.perf_counter()
+    try:
+        summary = await summarize(window.summary, window.unsummarized)
+        await store.set_summary(line_user_id, {
+            "summary": summary.strip(),
+            "last_turn": turn_digest(window.unsummarized[-1]),
+            "updated_at": int(time.time()),
+        })
+        summaries_created.inc()
+        summary_seconds.observe(time.perf_counter() - started)
+    except Exception as e:
+        summary_errors.inc()
+        logger.warning(f"更新對話摘要失敗，用戶ID: {line_user_id}: {e}")
+    finally:
+        _pending_summaries.discard(key)
@@ -0,0 +1,585 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+import redis.asyncio as aioredis
+from redis.exceptions import ResponseError
+from sqlalchemy import and_, or_, select
+from dotenv import load_dotenv
+
+from app.utils.metrics import metrics
+from app.utils.value_codec import ValueCodec
+
+# 加載環境變數
+load_dotenv()
+
+# 配置日誌
+logger = logging.getLogger(__name__)
+
+# Redis配置
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_CACHE_EXPIRY = int(os.getenv("REDIS_CACHE_EXPIRY", "3600"))  # 1小時
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "100"))
+
+# 對話與摘要的編碼：msgpack(超過門檻時以zstd壓縮)或與舊版相同的json
+# 逐步升級多個副本時先設為json，全部升級後再改為msgpack；兩種格式都能讀取
+REDIS_VALUE_CODEC = os.getenv("REDIS_VALUE_CODEC", "msgpack")
+REDIS_VALUE_COMPRESS_MIN_BYTES = int(os.getenv("REDIS_VALUE_COMPRESS_MIN_BYTES", "512"))
+REDIS_VALUE_ZSTD_LEVEL = int(os.getenv("REDIS_VALUE_ZSTD_LEVEL", "3"))
+
+# 每位用戶保留的對話輪數
+CHAT_HISTORY_MAX_TURNS = int(os.getenv("CHAT_HISTORY_MAX_TURNS", "10"))
+
+# 行程內的最近對話快取，只在訂閱其他副本的失效通知時使用
+CHAT_HISTORY_LOCAL_ENABLED = os.getenv("CHAT_HISTORY_LOCAL_ENABLED", "true").lower() == "true"
+CHAT_HISTORY_LOCAL_MAX_USERS = int(os.getenv("CHAT_HISTORY_LOCAL_MAX_USERS", "10000"))
+# 漏接失效通知時過期資料的存活上限
+CHAT_HISTORY_LOCAL_TTL = float(os.getenv("CHAT_HISTORY_LOCAL_TTL", "300"))
+# Redis無法連線或沒有歷史時改由chat_history資料表讀取並回填
+CHAT_HISTORY_DB_FALLBACK = os.getenv("CHAT_HISTORY_DB_FALLBACK", "true").lower() == "true"
+# 只回填此秒數內的對話，與Redis歷史過期的行為一致；0表示不限
+CHAT_HISTORY_DB_WINDOW = int(os.getenv("CHAT_HISTORY_DB_WINDOW", str(REDIS_CACHE_EXPIRY)))
+CHAT_HISTORY_DB_TIMEOUT = float(os.getenv("CHAT_HISTORY_DB_TIMEOUT", "2"))
+# 資料表沒有記錄時在Redis留下標記，此秒數內同一用戶不再查詢資料表；0表示不記錄
+CHAT_HISTORY_DB_EMPTY_TTL = int(os.getenv("CHAT_HISTORY_DB_EMPTY_TTL", "60"))
+# 資料表沒有記錄的標記，與歷史鍵使用不同的前綴，不會被舊格式遷移掃描到
+DB_EMPTY_PREFIX = "conversation_store:db_empty:"
+
+# 對話寫入時通知其他副本移除本機快取，訊息為"副本ID 鍵"
+INVALIDATION_CHANNEL = "conversation_store:invalidate"
+REPLICA_ID = uuid.uuid4().hex[:12]
+# 記錄最近寫入過的鍵，讀取期間被寫入的結果不放入本機快取
+RECENT_WRITES_LIMIT = 10000
+
+# 舊格式遷移完成的標記
+MIGRATION_MARKER_KEY = "conversation_store:migrated:v1"
+MIGRATION_BATCH_SIZE = 500
+
+# 將舊的JSON字串歷史原地轉為list，保留剩餘TTL；非字串鍵不處理，可重複執行
+MIGRATE_KEY_SCRIPT = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'string' then
+    return 0
+end
+local raw = redis.call('GET', KEYS[1])
+local ttl = redis.call('PTTL', KEYS[1])
+redis.call('DEL', KEYS[1])
+local ok, entries = pcall(cjson.decode, raw)
+if not ok or type(entries) ~= 'table' or #entries == 0 then
+    return 1
+end
+for _, entry in ipairs(entries) do
+    redis.call('RPUSH', KEYS[1], cjson.encode(entry))
+end
+redis.call('LTRIM', KEYS[1], -tonumber(ARGV[1]), -1)
+if ttl > 0 then
+    redis.call('PEXPIRE', KEYS[1], ttl)
+else
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+# 由資料庫回填歷史；已有其他請求寫入時不覆蓋
+# KEYS[1]: 歷史; ARGV[1]: TTL, ARGV[2..]: 由舊到新的對話
+BACKFILL_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('RPUSH', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+# 所有對話存取共用的非同步連線池
+redis_client = aioredis.Redis(
+    connection_pool=aioredis.ConnectionPool(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        decode_responses=True,
+        max_connections=REDIS_MAX_CONNECTIONS
+    )
+)
+# 對話與摘要為二進位值，使用不解碼回應的連線池
+binary_client = aioredis.Redis(
+    connection_pool=aioredis.ConnectionPool(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        max_connections=REDIS_MAX_CONNECTIONS
+    )
+)
+_migrate_key = redis_client.register_script(MIGRATE_KEY_SCRIPT)
+_backfill = binary_client.register_script(BACKFILL_SCRIPT)
+
+history_codec = ValueCodec(
+    "conversation_store",
+    format=REDIS_VALUE_CODEC,
+    compress_min_bytes=REDIS_VALUE_COMPRESS_MIN_BYTES,
+    level=REDIS_VALUE_ZSTD_LEVEL
+)
+
+migrated_keys = metrics.counter("conversation_store_migrated_keys_total")
+store_errors = metrics.counter("conversation_store_errors_total")
+backfilled_keys = metrics.counter("conversation_store_backfills_total")
+backfills_skipped = metrics.counter("conversation_store_backfills_skipped_total")
+db_empty_hits = metrics.counter("conversation_store_db_empty_hits_total")
+invalidations = metrics.counter("conversation_store_invalidations_total")
+
+# 各層的命中、未命中與查詢耗時
+TIERS = ("local", "redis", "db")
+tier_hits = {tier: metrics.counter(f"conversation_store_{tier}_hits_total") for tier in TIERS}
+tier_misses = {tier: metrics.counter(f"conversation_store_{tier}_misses_total") for tier in TIERS}
+tier_seconds = {tier: metrics.histogram(f"conversation_store_{tier}_seconds") for tier in TIERS}
+
+
+def _hit_ratio(tier: str):
+    hits = tier_hits[tier].value
+    total = hits + tier_misses[tier].value
+    return round(hits / total, 4) if total else 0.0
+
+
+for _tier in TIERS:
+    metrics.gauge(f"conversation_store_{_tier}_hit_ratio", lambda tier=_tier: _hit_ratio(tier))
+
+
+class LocalHistory:
+    """
+    行程內的最近對話LRU，依用戶數與TTL淘汰
+
+    本副本的寫入直接更新快取；其他副本的寫入經由Redis pub/sub通知後移除。
+    只有在訂閱中才使用快取，訂閱中斷時清空並改為直接讀Redis，重新訂閱後再逐步填入，
+    避免漏接通知而讀到其他副本已更新的舊歷史。
+    """
+
+    def __init__(
+        self,
+        max_users: int = CHAT_HISTORY_LOCAL_MAX_USERS,
+        ttl: float = CHAT_HISTORY_LOCAL_TTL,
+        enabled: bool = CHAT_HISTORY_LOCAL_ENABLED
+    ):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.enabled = enabled and max_users > 0
+        self.synced = False
+        # 鍵 -> (由舊到新的對話, 摘要, 過期時間)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        # 鍵 -> 最後寫入的序號
+        self._writes: "OrderedDict[str, int]" = OrderedDict()
+        self._seq = 0
+        self._task: Optional[asyncio.Task] = None
+
+        metrics.gauge("conversation_store_local_users", lambda: len(self._entries))
+        metrics.gauge("conversation_store_local_synced", lambda: int(self.synced))
+
+    @property
+    def usable(self) -> bool:
+        return self.enabled and self.synced
+
+    @property
+    def seq(self) -> int:
+        """讀取下層前記下的序號，回填時用來判斷期間是否有寫入"""
+        return self._seq
+
+    def get(self, key: str) -> Optional[Tuple[List[dict], Optional[dict]]]:
+        item = self._entries.get(key)
+        if item is None:
+            return None
+        entries, summary, expires_at = item
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entries, summary
+
+    def fill(self, key: str, entries: List[dict], summary: Optional[dict], since: int):
+        """放入由下層讀到的歷史；讀取期間有寫入或未訂閱時不放入"""
+        if not self.usable or self._writes.get(key, 0) > since:
+            return
+        self._put(key, entries, summary)
+
+    def _put(self, key: str, entries: List[dict], summary: Optional[dict]):
+        self._entries[key] = (entries, summary, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+
+    def _touch(self, key: str):
+        self._seq += 1
+        self._writes[key] = self._seq
+        self._writes.move_to_end(key)
+        while len(self._writes) > RECENT_WRITES_LIMIT:
+            self._writes.popitem(last=False)
+
+    def append(self, key: str, entry: dict, max_turns: int):
+        """本副本寫入的新對話，已快取的歷史直接附加"""
+        self._touch(key)
+        item = self.get(key)
+        if item is not None:
+            entries, summary = item
+            self._put(key, (entries + [entry])[-max_turns:], summary)
+
+    def set_summary(self, key: str, summary: dict):
+        self._touch(key)
+        item = self.get(key)
+        if item is not None:
+            self._put(key, item[0], summary)
+
+    def invalidate(self, key: str):
+        self._touch(key)
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _on_message(self, data: str):
+        replica, _, key = data.partition(" ")
+        if replica != REPLICA_ID and key:
+            invalidations.inc()
+            self.invalidate(key)
+
+    async def start(self):
+        """啟動失效通知的訂閱"""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _listen(self):
+        backoff = 1.0
+        while True:
+            pubsub = redis_client.pubsub()
+            try:
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                # 訂閱前的通知可能已漏接，由空的快取重新開始
+                self.clear()
+                self.synced = True
+                backoff = 1.0
+                logger.info("已訂閱聊天歷史失效通知，啟用本機快取")
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message is not None and message["type"] == "message":
+                        self._on_message(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"聊天歷史失效通知中斷，暫停本機快取: {e}")
+            finally:
+                self.synced = False
+                self.clear()
+                try:
+                    await pubsub.close()
+                except Exception:
+                    pass
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+
+
+# 所有對話歷史共用本機容量，鍵包含各自的前綴
+local_history = LocalHistory()
+
+
+class ConversationStore:
+    """
+    以Redis list保存對話歷史，每輪對話是一個以history_codec編碼的元素
+
+    寫入以單一pipeline完成 RPUSH + LTRIM + EXPIRE，讀取使用LRANGE，
+    同一用戶的並行訊息不會互相覆蓋。移出上下文視窗的舊對話摘要另存於
+    summary_prefix開頭的字串鍵，與歷史使用相同的TTL。
+
+    讀取依序查詢本機LRU、Redis、chat_history資料表，下層命中時回填上層；
+    寫入同時更新本機LRU與Redis，資料表由history_writer寫入。資料表沒有記錄時
+    以短期標記避免每個請求都查詢；history_writer還有此用戶未寫入的記錄時資料表
+    尚未完整，讀到的結果只用於當次請求，不回填。
+    name對應chat_history.context的history欄位，用來區分各對話歷史的記錄。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        key_prefix: str,
+        summary_prefix: str,
+        max_turns: int = CHAT_HISTORY_MAX_TURNS,
+        ttl: int = REDIS_CACHE_EXPIRY,
+        db_fallback: bool = CHAT_HISTORY_DB_FALLBACK
+    ):
+        self.name = name
+        self.key_prefix = key_prefix
+        self.summary_prefix = summary_prefix
+        self.max_turns = max_turns
+        self.ttl = ttl
+        self.db_fallback = db_fallback
+
+    def _key(self, line_user_id: str) -> str:
+        return f"{self.key_prefix}{line_user_id}"
+
+    def _summary_key(self, line_user_id: str) -> str:
+        return f"{self.summary_prefix}{line_user_id}"
+
+    def _db_empty_key(self, line_user_id: str) -> str:
+        return f"{DB_EMPTY_PREFIX}{self.name}:{line_user_id}"
+
+    async def _migrate(self, key: str):
+        """遇到尚未遷移的舊格式鍵時就地轉換"""
+        if await _migrate_key(keys=[key], args=[self.max_turns, self.ttl]):
+            migrated_keys.inc()
+
+    async def get_history(self, line_user_id: str, limit: int = 5) -> List[dict]:
+        """獲取最近limit輪對話"""
+        entries, _ = await self.get_context(line_user_id, limit)
+        return entries
+
+    async def get_context(self, line_user_id: str, limit: int) -> Tuple[List[dict], Optional[dict]]:
+        """取得最近limit輪對話與滾動摘要，依序查詢本機LRU、Redis、資料表"""
+        entries, summary = await self._load(line_user_id)
+        return entries[-limit:] if limit > 0 else [], summary
+
+    async def _load(self, line_user_id: str) -> Tuple[List[dict], Optional[dict]]:
+        key = self._key(line_user_id)
+        if local_history.usable:
+            started = time.perf_counter()
+            cached = local_history.get(key)
+            tier_seconds["local"].observe(time.perf_counter() - started)
+            if cached is not None:
+                tier_hits["local"].inc()
+                return cached
+            tier_misses["local"].inc()
+        since = local_history.seq
+
+        summary = None
+        redis_ok = True
+        started = time.perf_counter()
+        try:
+            entries, summary, db_empty = await self._read_redis(line_user_id)
+            tier_seconds["redis"].observe(time.perf_counter() - started)
+            if entries:
+                tier_hits["redis"].inc()
+                local_history.fill(key, entries, summary, since)
+                return entries, summary
+            tier_misses["redis"].inc()
+            if db_empty:
+                # 最近查過資料表且沒有記錄
+                db_empty_hits.inc()
+                return [], summary
+        except Exception as e:
+            tier_seconds["redis"].observe(time.perf_counter() - started)
+            tier_misses["redis"].inc()
+            redis_ok = False
+            store_errors.inc()
+            logger.error(f"獲取聊天歷史錯誤: {e}")
+
+        if not self.db_fallback:
+            return [], summary
+        lagging = self._writes_pending(line_user_id)
+        entries = await self._read_db(line_user_id)
+        if entries is None:
+            return [], summary
+        if lagging or self._writes_pending(line_user_id):
+            # 資料表還缺少寫入佇列中的對話，回填後之後的寫入會接在不完整的歷史後面
+            backfills_skipped.inc()
+            return entries, summary
+        if redis_ok:
+            if entries:
+                await self._backfill(key, entries)
+            else:
+                await self._mark_db_empty(line_user_id)
+        local_history.fill(key, entries, summary, since)
+        return entries, summary
+
+    def _writes_pending(self, line_user_id: str) -> bool:
+        """本副本的history_writer是否還有此用戶尚未寫入資料表的記錄"""
+        from app.services.history_writer import history_writer
+        return history_writer.pending(line_user_id, self.name)
+
+    async def _read_redis(self, line_user_id: str) -> Tuple[List[dict], Optional[dict], bool]:
+        """一次往返取得保留的所有對話、滾動摘要與資料表沒有記錄的標記"""
+        key = self._key(line_user_id)
+        pipe = binary_client.pipeline(transaction=False)
+        pipe.lrange(key, -self.max_turns, -1)
+        pipe.get(self._summary_key(line_user_id))
+        pipe.exists(self._db_empty_key(line_user_id))
+        entries, summary, db_empty = await pipe.execute(raise_on_error=False)
+        if isinstance(entries, ResponseError):
+            if "WRONGTYPE" not in str(entries):
+                raise entries
+            await self._migrate(key)
+            entries = await binary_client.lrange(key, -self.max_turns, -1)
+        if isinstance(summary, Exception):
+            raise summary
+        if isinstance(db_empty, Exception):
+            raise db_empty
+        decode = history_codec.decode
+        return [decode(entry) for entry in entries], decode(summary) if summary else None, bool(db_empty)
+
+    async def _read_db(self, line_user_id: str) -> Optional[List[dict]]:
+        """由chat_history讀取最近的對話，失敗時回傳None"""
+        started = time.perf_counter()
+        try:
+            entries = await asyncio.wait_for(self._query_db(line_user_id), CHAT_HISTORY_DB_TIMEOUT)
+        except Exception as e:
+            store_errors.inc()
+            tier_misses["db"].inc()
+            logger.error(f"由資料庫獲取聊天歷史錯誤: {e!r}")
+            return None
+        finally:
+            tier_seconds["db"].observe(time.perf_counter() - started)
+        if entries:
+            tier_hits["db"].inc()
+        else:
+            tier_misses["db"].inc()
+        return entries
+
+    async def _query_db(self, line_user_id: str) -> List[dict]:
+        # 資料庫只在Redis沒有歷史時才需要，延後載入讓只使用Redis的工具不需設定DATABASE_URL
+        from app.models.database import AsyncSessionLocal, ChatHistory
+
+        history = ChatHistory.context["history"].as_string()
+        query = select(ChatHistory.message, ChatHistory.response).where(
+            ChatHistory.line_user_id == line_user_id,
+            # 未記錄history的舊記錄依提供者區分
+            or_(
+                history == self.name,
+                and_(history.is_(None), ChatHistory.context["provider"].as_string() == self.name)
+            )
+        )
+        if CHAT_HISTORY_DB_WINDOW > 0:
+            # created_at由資料庫以UTC寫入
+            cutoff = datetime.utcnow() - timedelta(seconds=CHAT_HISTORY_DB_WINDOW)
+            query = query.where(ChatHistory.created_at >= cutoff)
+        query = query.order_by(ChatHistory.created_at.desc(), ChatHistory.id.desc()).limit(self.max_turns)
+        async with AsyncSessionLocal() as session:
+            rows = (await session.execute(query)).all()
+        return [{"user": row.message, "assistant": row.response} for row in reversed(rows)]
+
+    async def _backfill(self, key: str, entries: List[dict]):
+        """將資料表讀到的歷史寫回Redis"""
+        try:
+            args = [self.ttl] + [history_codec.encode(entry) for entry in entries]
+            if await _backfill(keys=[key], args=args):
+                backfilled_keys.inc()
+        except Exception as e:
+            store_errors.inc()
+            logger.warning(f"回填聊天歷史到Redis失敗: {e}")
+
+    async def _mark_db_empty(self, line_user_id: str):
+        """記錄資料表沒有此用戶的記錄，標記過期前不再查詢"""
+        if CHAT_HISTORY_DB_EMPTY_TTL <= 0:
+            return
+        try:
+            await binary_client.set(self._db_empty_key(line_user_id), b"1", ex=CHAT_HISTORY_DB_EMPTY_TTL)
+        except Exception as e:
+            store_errors.inc()
+            logger.warning(f"記錄資料表沒有聊天歷史失敗: {e}")
+
+    def _publish(self, pipe, key: str):
+        """寫入的同一個pipeline通知其他副本移除本機快取"""
+        if local_history.enabled:
+            pipe.publish(INVALIDATION_CHANNEL, f"{REPLICA_ID} {key}")
+
+    async def set_summary(self, line_user_id: str, record: dict):
+        key = self._key(line_user_id)
+        local_history.set_summary(key, record)
+        pipe = binary_client.pipeline(transaction=True)
+        pipe.set(self._summary_key(line_user_id), history_codec.encode(record), ex=self.ttl)
+        self._publish(pipe, key)
+        await pipe.execute()
+
+    async def append(self, line_user_id: str, message: str, response: str):
+        """新增一輪對話，只保留最近max_turns輪"""
+        key = self._key(line_user_id)
+        record = {"user": message, "assistant": response}
+        local_history.append(key, record, self.max_turns)
+        entry = history_codec.encode(record)
+        try:
+            try:
+                await self._append(line_user_id, entry)
+            except ResponseError as e:
+                if "WRONGTYPE" not in str(e):
+                    raise
+                await self._migrate(key)
+                await self._append(line_user_id, entry)
+        except Exception as e:
+            store_errors.inc()
+            logger.error(f"保存聊天歷史錯誤: {e}")
+
+    async def _append(self, line_user_id: str, entry: bytes):
+        key = self._key(line_user_id)
+        pipe = binary_client.pipeline(transaction=True)
+        pipe.rpush(key, entry)
+        pipe.ltrim(key, -self.max_turns, -1)
+        pipe.expire(key, self.ttl)
+        # 摘要與歷史一起延長存活時間
+        pipe.expire(self._summary_key(line_user_id), self.ttl)
+        # 之後資料表會有這輪對話
+        pipe.delete(self._db_empty_key(line_user_id))
+        self._publish(pipe, key)
+        await pipe.execute()
+
+    async def clear(self, line_user_id: str):
+        key = self._key(line_user_id)
+        local_history.invalidate(key)
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.delete(key, self._summary_key(line_user_id))
+        self._publish(pipe, key)
+        await pipe.execute()
+
+    async def migrate_legacy_keys(self) -> int:
+        """掃描此前綴下的所有鍵，將舊的JSON字串格式轉為list"""
+        count = 0
+        batch = []
+        async for key in redis_client.scan_iter(match=f"{self.key_prefix}*", count=MIGRATION_BATCH_SIZE):
+            batch.append(key)
+            if len(batch) >= MIGRATION_BATCH_SIZE:
+                count += await self._migrate_batch(batch)
+                batch = []
+        if batch:
+            count += await self._migrate_batch(batch)
+        return count
+
+    async def _migrate_batch(self, keys: List[str]) -> int:
+        pipe = redis_client.pipeline(transaction=False)
+        for key in keys:
+            await _migrate_key(keys=[key], args=[self.max_turns, self.ttl], client=pipe)
+        converted = sum(await pipe.execute())
+        migrated_keys.inc(converted)
+        return converted
+
+
+# 各模型提供者的對話歷史
+openai_history = ConversationStore("openai", "chat_history:", "chat_summary:")
+gemini_history = ConversationStore("gemini", "gemini_chat_history:", "gemini_chat_summary:")
+
+
+async def migrate_legacy_history():
+    """啟動時執行一次的舊格式遷移，完成後寫入標記避免重複掃描"""
+    try:
+        if await redis_client.exists(MIGRATION_MARKER_KEY):
+            return
+        total = 0
+        for store in (openai_history, gemini_history):
+            total += await store.migrate_legacy_keys()
+        await redis_client.set(MIGRATION_MARKER_KEY, 1)
+        logger.info(f"聊天歷史遷移完成，轉換 {total} 個鍵")
+    except Exception as e:
+        logger.warning(f"聊天歷史遷移失敗，將於存取時逐鍵轉換: {e}")
+
+
+async def aclose():
+    """關閉Redis連線池"""
+    for client in (redis_client, binary_client):
+        await client.close()
+        await client.connection_pool.disconnect()
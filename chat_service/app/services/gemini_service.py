@@ -1,10 +1,22 @@
 import os
-import json
+import time
+import asyncio
 import logging
-import redis
 import google.generativeai as genai
 from dotenv import load_dotenv
 
+from app.utils.deadline import remaining
+from app.utils.metrics import metrics
+from app.services.conversation_store import gemini_history
+from app.services.response_cache import gemini_cache
+from app.services.semantic_cache import semantic_cache, namespace_id
+from app.services.single_flight import single_flight
+from app.services.provider_stats import get_stats
+from app.services.adaptive_limiter import AdaptiveLimiter, as_overload
+from app.services.context_builder import (
+    SUMMARY_PROMPT, build_context, format_summary_request, schedule_summary
+)
+
 # 加載環境變數
 load_dotenv()
 
@@ -16,98 +28,238 @@ logger = logging.getLogger(__name__)
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-pro")  # 使用文字模型
 MAX_TOKENS = int(os.getenv("MAX_TOKENS", "500"))
+TEMPERATURE = float(os.getenv("TEMPERATURE", "0.7"))
 
-# Redis配置
-REDIS_HOST = os.getenv("REDIS_HOST", "redis")
-REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
-REDIS_CACHE_EXPIRY = int(os.getenv("REDIS_CACHE_EXPIRY", "3600"))  # 1小時
-
-# 初始化Redis連接
-try:
-    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
-    redis_client.ping()  # 測試連接
-    logger.info("Redis連接成功")
-except redis.ConnectionError as e:
-    logger.warning(f"Redis連接失敗: {e}")
-    redis_client = None
+# 並行與逾時設定，並行數依限流回應在上限內自動調整
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "100"))
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "30"))
 
 # 配置Gemini
 genai.configure(api_key=GEMINI_API_KEY)
 
+# 生成設定只建立一次，所有請求共用
+GENERATION_CONFIG = genai.types.GenerationConfig(
+    max_output_tokens=MAX_TOKENS,
+    temperature=TEMPERATURE
+)
+
+# 依模型名稱快取的模型物件，避免每則訊息重新建立
+_model_handles = {}
+
+# 限制同時進行的Gemini請求數
+gemini_limiter = AdaptiveLimiter("gemini", GEMINI_MAX_CONCURRENCY)
+_in_flight = 0
+metrics.gauge("gemini_in_flight", lambda: _in_flight)
+gemini_queue_wait = metrics.histogram("gemini_limiter_wait_seconds")
+gemini_latency = metrics.histogram("gemini_request_seconds")
+gemini_errors = metrics.counter("gemini_errors_total")
+gemini_ttft = metrics.histogram("gemini_ttft_seconds")
+gemini_stats = get_stats("gemini", GEMINI_MODEL)
+
+def get_model(model_name=GEMINI_MODEL):
+    """取得重複使用的模型物件"""
+    model = _model_handles.get(model_name)
+    if model is None:
+        model = genai.GenerativeModel(model_name, generation_config=GENERATION_CONFIG)
+        _model_handles[model_name] = model
+    return model
+
+def build_contents(chat_history, message, summary=None):
+    """將摘要、歷史對話與當前消息組成contents列表"""
+    contents = []
+    if summary:
+        # gemini-pro沒有系統角色，以一組對話帶入摘要
+        contents.append({"role": "user", "parts": [f"先前對話摘要：{summary}"]})
+        contents.append({"role": "model", "parts": ["好的，我會參考這段摘要。"]})
+    for entry in chat_history:
+        contents.append({"role": "user", "parts": [entry["user"]]})
+        contents.append({"role": "model", "parts": [entry["assistant"]]})
+    contents.append({"role": "user", "parts": [message]})
+    return contents
+
 class GeminiService:
+    # 未指定對話歷史時使用的儲存
+    history = gemini_history
+    
     @staticmethod
-    def get_chat_history(line_user_id, limit=5):
+    async def get_chat_history(line_user_id, limit=5):
         """從Redis獲取用戶的聊天歷史"""
-        if not redis_client:
-            return []
+        return await gemini_history.get_history(line_user_id, limit)
+    
+    @staticmethod
+    async def create_completion(contents, deadline=None):
+        """
+        在並行上限內呼叫Gemini，逾時依截止時間縮短
+
+        限流或過載(429/503)時拋出ProviderOverloaded，其餘錯誤原樣拋出。
+        """
+        global _in_flight
+        wait_started = time.perf_counter()
+        await gemini_limiter.acquire(deadline)
+        gemini_queue_wait.observe(time.perf_counter() - wait_started)
+        
+        # 扣除等待時間後依剩餘時間設定逾時
+        timeout = GEMINI_TIMEOUT
+        seconds_left = remaining(deadline)
+        if seconds_left is not None:
+            timeout = max(0.001, min(timeout, seconds_left))
         
-        history_key = f"gemini_chat_history:{line_user_id}"
+        _in_flight += 1
+        started = time.perf_counter()
+        latency = None
+        error = None
         try:
-            history_json = redis_client.get(history_key)
-            if history_json:
-                return json.loads(history_json)[-limit:]
-            return []
+            response = await asyncio.wait_for(
+                get_model().generate_content_async(contents),
+                timeout=timeout
+            )
+            latency = time.perf_counter() - started
         except Exception as e:
-            logger.error(f"獲取聊天歷史錯誤: {e}")
-            return []
+            gemini_errors.inc()
+            gemini_stats.record_failure()
+            error = as_overload("gemini", e)
+            if error is not None:
+                raise error from e
+            raise
+        finally:
+            _in_flight -= 1
+            gemini_latency.observe(time.perf_counter() - started)
+            gemini_limiter.release(success=latency is not None, latency=latency, error=error)
+        gemini_stats.record_success(latency)
+        
+        # 獲取生成的回應
+        return response.text
     
     @staticmethod
-    def save_chat_history(line_user_id, message, response):
-        """保存聊天歷史到Redis"""
-        if not redis_client:
-            return
+    async def stream_completion(contents, deadline=None):
+        """以串流模式呼叫Gemini，逐段產生回應文字；限流或過載時拋出ProviderOverloaded"""
+        global _in_flight
+        wait_started = time.perf_counter()
+        await gemini_limiter.acquire(deadline)
+        gemini_queue_wait.observe(time.perf_counter() - wait_started)
+        
+        # 逾時只限制等待第一段回應，總時間由呼叫端的截止時間限制
+        timeout = GEMINI_TIMEOUT
+        seconds_left = remaining(deadline)
+        if seconds_left is not None:
+            timeout = max(0.001, min(timeout, seconds_left))
         
-        history_key = f"gemini_chat_history:{line_user_id}"
+        _in_flight += 1
+        started = time.perf_counter()
+        first_token = True
+        completed = False
+        error = None
         try:
-            # 獲取現有歷史或創建新的
-            history_json = redis_client.get(history_key)
-            if history_json:
-                history = json.loads(history_json)
-            else:
-                history = []
-            
-            # 添加新的對話
-            history.append({
-                "user": message,
-                "assistant": response
-            })
-            
-            # 保存歷史，只保留最近10條
-            redis_client.set(
-                history_key, 
-                json.dumps(history[-10:]), 
-                ex=REDIS_CACHE_EXPIRY
+            response = await asyncio.wait_for(
+                get_model().generate_content_async(contents, stream=True),
+                timeout=timeout
             )
+            async for chunk in response:
+                text = chunk.text
+                if not text:
+                    continue
+                if first_token:
+                    gemini_ttft.observe(time.perf_counter() - started)
+                    gemini_stats.record_ttft(time.perf_counter() - started)
+                    first_token = False
+                yield text
+            completed = True
+            gemini_stats.record_success(time.perf_counter() - started)
         except Exception as e:
-            logger.error(f"保存聊天歷史錯誤: {e}")
+            gemini_errors.inc()
+            gemini_stats.record_failure()
+            error = as_overload("gemini", e)
+            if error is not None:
+                raise error from e
+            raise
+        finally:
+            _in_flight -= 1
+            gemini_latency.observe(time.perf_counter() - started)
+            # 串流長度取決於回應內容，不以總耗時判斷延遲飆高
+            gemini_limiter.release(success=completed, error=error)
     
     @staticmethod
-    async def generate_response(line_user_id, message):
-        """使用Gemini生成回應"""
-        try:
-            # 獲取聊天歷史
-            chat_history = GeminiService.get_chat_history(line_user_id)
-            
-            # 初始化聊天模型
-            model = genai.GenerativeModel(GEMINI_MODEL)
-            chat = model.start_chat(history=[])
-            
-            # 添加歷史對話
-            for entry in chat_history:
-                chat.history.append({"role": "user", "parts": [entry["user"]]})
-                chat.history.append({"role": "model", "parts": [entry["assistant"]]})
-            
-            # 發送當前消息
-            response = chat.send_message(message)
-            
-            # 獲取生成的回應
-            generated_text = response.text
-            
-            # 保存到歷史記錄
-            GeminiService.save_chat_history(line_user_id, message, generated_text)
-            
+    async def summarize(previous_summary, turns):
+        """將移出上下文視窗的對話併入摘要"""
+        prompt = f"{SUMMARY_PROMPT}\n\n{format_summary_request(previous_summary, turns)}"
+        return await GeminiService.create_completion([{"role": "user", "parts": [prompt]}])
+    
+    @staticmethod
+    async def lookup_cached(chat_history, message, summary_record=None):
+        """查詢完全相同與改寫過的問題，回傳(快取鍵, 命名空間, 快取的回應)；Gemini沒有系統提示"""
+        # 鍵包含提示中的所有上下文：取得的每一輪對話與滾動摘要
+        summary = summary_record.get("summary") if summary_record else None
+        cache_key = gemini_cache.make_key(GEMINI_MODEL, "", message, chat_history, summary)
+        namespace = namespace_id("gemini", GEMINI_MODEL, "", chat_history, message, summary)
+        generated_text = await gemini_cache.get(cache_key)
+        if generated_text is None:
+            generated_text = await semantic_cache.get(namespace, message)
+        return cache_key, namespace, generated_text
+    
+    @staticmethod
+    async def remember(line_user_id, message, generated_text, latency, cache_key, namespace, window, store):
+        """新生成的回應寫入快取，並在背景更新摘要"""
+        await gemini_cache.set(cache_key, generated_text, latency)
+        await semantic_cache.set(namespace, message, generated_text, latency)
+        schedule_summary(store, line_user_id, window, GeminiService.summarize)
+    
+    @staticmethod
+    async def complete(line_user_id, message, deadline=None, store=gemini_history):
+        """
+        使用Gemini生成完整回應
+
+        store為讀取上下文的對話歷史；錯誤直接拋出，歷史記錄由呼叫端在回應確定送出後寫入。
+        """
+        # 獲取保留的所有聊天歷史與摘要，送出的輪數由build_context決定
+        chat_history, summary_record = await store.get_context(line_user_id, store.max_turns)
+        
+        # 相同問題與上下文直接使用快取的回應
+        cache_key, namespace, generated_text = await GeminiService.lookup_cached(chat_history, message, summary_record)
+        if generated_text is not None:
             return generated_text
-            
-        except Exception as e:
-            logger.error(f"Gemini API錯誤: {e}")
-            return "很抱歉，我現在無法處理您的請求，請稍後再試。" 
\ No newline at end of file
+        
+        # 在token預算內由新到舊挑選歷史，較舊的對話以摘要代替
+        window = build_context(
+            "gemini", "", chat_history, message, summary_record, max_turns=store.max_turns
+        )
+        
+        # 歷史對話與當前消息直接組成contents，不需建立chat session
+        contents = build_contents(window.turns, message, window.summary)
+        
+        # 調用Gemini API
+        started = time.perf_counter()
+        # 相同問題同時進行時共用同一次呼叫
+        generated_text = await single_flight.do(
+            cache_key, lambda: GeminiService.create_completion(contents, deadline), deadline
+        )
+        await GeminiService.remember(
+            line_user_id, message, generated_text, time.perf_counter() - started, cache_key, namespace, window, store
+        )
+        return generated_text
+    
+    @staticmethod
+    async def stream(line_user_id, message, deadline=None, store=gemini_history):
+        """
+        以串流方式生成回應，逐段產生文字
+
+        快取命中時一次產生完整回應；串流完成後才寫入快取，錯誤直接拋出。
+        """
+        chat_history, summary_record = await store.get_context(line_user_id, store.max_turns)
+        cache_key, namespace, generated_text = await GeminiService.lookup_cached(chat_history, message, summary_record)
+        if generated_text is not None:
+            yield generated_text
+            return
+        
+        window = build_context(
+            "gemini", "", chat_history, message, summary_record, max_turns=store.max_turns
+        )
+        contents = build_contents(window.turns, message, window.summary)
+        
+        started = time.perf_counter()
+        parts = []
+        async for delta in GeminiService.stream_completion(contents, deadline):
+            parts.append(delta)
+            yield delta
+        await GeminiService.remember(
+            line_user_id, message, "".join(parts).strip(), time.perf_counter() - started, cache_key, namespace, window, store
+        )
@@ -0,0 +1,184 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import insert
+from dotenv import load_dotenv
+
+from app.models.database import AsyncSessionLocal, ChatHistory
+from app.utils.metrics import metrics
+
+# 加載環境變數
+load_dotenv()
+
+# 配置日誌
+logger = logging.getLogger(__name__)
+
+# 寫入佇列設定
+HISTORY_WRITER_QUEUE_SIZE = int(os.getenv("HISTORY_WRITER_QUEUE_SIZE", "10000"))
+HISTORY_WRITER_BATCH_SIZE = int(os.getenv("HISTORY_WRITER_BATCH_SIZE", "200"))
+HISTORY_WRITER_FLUSH_INTERVAL = float(os.getenv("HISTORY_WRITER_FLUSH_INTERVAL", "0.5"))
+HISTORY_WRITER_MAX_RETRIES = int(os.getenv("HISTORY_WRITER_MAX_RETRIES", "3"))
+HISTORY_WRITER_RETRY_BACKOFF = float(os.getenv("HISTORY_WRITER_RETRY_BACKOFF", "0.5"))
+HISTORY_WRITER_DRAIN_TIMEOUT = float(os.getenv("HISTORY_WRITER_DRAIN_TIMEOUT", "10"))
+
+
+class HistoryWriter:
+    """
+    聊天記錄的延遲批次寫入
+
+    請求路徑只把記錄放入有界佇列；背景工作以自己的AsyncSession，
+    在累積到batch_size筆或等待超過flush_interval秒時以單一多列INSERT寫入。
+    寫入失敗時以指數退避重試，關閉服務時會先寫完佇列中的記錄。
+    依(用戶, 對話歷史)記錄尚未寫完的筆數，資料表落後於Redis時不由資料表回填。
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable = AsyncSessionLocal,
+        max_queue_size: int = HISTORY_WRITER_QUEUE_SIZE,
+        batch_size: int = HISTORY_WRITER_BATCH_SIZE,
+        flush_interval: float = HISTORY_WRITER_FLUSH_INTERVAL,
+        max_retries: int = HISTORY_WRITER_MAX_RETRIES,
+        retry_backoff: float = HISTORY_WRITER_RETRY_BACKOFF
+    ):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+        self._task: Optional[asyncio.Task] = None
+        # (用戶, 對話歷史) -> 已放入佇列但尚未寫入或捨棄的筆數
+        self._pending: Dict[Tuple[str, str], int] = {}
+
+        metrics.gauge("history_writer_queue_depth", lambda: self._queue.qsize())
+        metrics.gauge("history_writer_pending_users", lambda: len(self._pending))
+        self._enqueued = metrics.counter("history_writer_enqueued_total")
+        self._written = metrics.counter("history_writer_rows_written_total")
+        self._dropped = metrics.counter("history_writer_rows_dropped_total")
+        self._retries = metrics.counter("history_writer_retries_total")
+        self._batch_rows = metrics.histogram("history_writer_batch_size")
+        self._flush_time = metrics.histogram("history_writer_flush_seconds")
+
+    def submit(
+        self,
+        line_user_id: str,
+        message: str,
+        response: str,
+        provider: str,
+        context: Optional[Dict[str, Any]] = None,
+        history: Optional[str] = None
+    ) -> bool:
+        """
+        放入寫入佇列；佇列已滿時捨棄並回傳False，不阻塞請求
+
+        history為這輪對話所屬的對話歷史名稱，Redis沒有歷史時依此由資料表回填
+        """
+        # 添加提供者資訊到context
+        context = dict(context or {})
+        context["provider"] = provider
+        if history:
+            context["history"] = history
+        row = {
+            "line_user_id": line_user_id,
+            "message": message,
+            "response": response,
+            "context": context,
+        }
+        try:
+            self._queue.put_nowait(row)
+        except asyncio.QueueFull:
+            self._dropped.inc()
+            logger.error(f"聊天記錄寫入佇列已滿，捨棄記錄，用戶ID: {line_user_id}")
+            return False
+        self._enqueued.inc()
+        pending_key = self._pending_key(row)
+        self._pending[pending_key] = self._pending.get(pending_key, 0) + 1
+        return True
+
+    @staticmethod
+    def _pending_key(row: dict) -> Tuple[str, str]:
+        context = row["context"]
+        return row["line_user_id"], context.get("history") or context["provider"]
+
+    def pending(self, line_user_id: str, history: str) -> bool:
+        """此用戶在該對話歷史是否還有尚未寫入資料表的記錄"""
+        return (line_user_id, history) in self._pending
+
+    def _settle(self, row: dict):
+        pending_key = self._pending_key(row)
+        count = self._pending.get(pending_key, 0) - 1
+        if count > 0:
+            self._pending[pending_key] = count
+        else:
+            self._pending.pop(pending_key, None)
+
+    async def start(self):
+        """啟動背景寫入工作"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"聊天記錄寫入工作已啟動，批次大小: {self.batch_size}, 間隔: {self.flush_interval}秒")
+
+    async def stop(self, timeout: float = HISTORY_WRITER_DRAIN_TIMEOUT):
+        """寫完佇列中的記錄後停止"""
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"停止時仍有 {self._queue.qsize()} 筆聊天記錄未寫入")
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        logger.info("聊天記錄寫入工作已停止")
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            # 等到批次滿或第一筆記錄等待超過flush_interval
+            flush_at = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = flush_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._flush(batch)
+            finally:
+                for row in batch:
+                    self._settle(row)
+                    self._queue.task_done()
+
+    async def _flush(self, rows: List[dict]):
+        started = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self._insert(rows)
+                self._written.inc(len(rows))
+                self._batch_rows.observe(len(rows))
+                self._flush_time.observe(time.perf_counter() - started)
+                return
+            except Exception as e:
+                if attempt >= self.max_retries:
+                    self._dropped.inc(len(rows))
+                    logger.error(f"批次寫入聊天記錄失敗，捨棄 {len(rows)} 筆: {e}")
+                    return
+                self._retries.inc()
+                logger.warning(f"批次寫入聊天記錄失敗，第 {attempt + 1} 次重試: {e}")
+                await asyncio.sleep(self.retry_backoff * (2 ** attempt))
+
+    async def _insert(self, rows: List[dict]):
+        """以單一多列INSERT在一個交易內寫入整批記錄"""
+        async with self.session_factory() as session:
+            async with session.begin():
+                await session.execute(insert(ChatHistory).values(rows))
+
+
+# 服務共用的寫入器
+history_writer = HistoryWriter()
@@ -0,0 +1,253 @@
+import os
+import math
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Deque, Dict, Optional
+
+from dotenv import load_dotenv
+
+from app.utils.deadline import DeadlineExceeded, remaining
+from app.utils.metrics import metrics
+
+# 加載環境變數
+load_dotenv()
+
+# 配置日誌
+logger = logging.getLogger(__name__)
+
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "true").lower() == "true"
+# 同時進行的LLM請求上限(所有提供者合計)
+SCHEDULER_MAX_CONCURRENCY = int(os.getenv("SCHEDULER_MAX_CONCURRENCY", "64"))
+# 各提供者的同時請求上限，0表示只受全域上限限制
+SCHEDULER_OPENAI_CONCURRENCY = int(os.getenv("SCHEDULER_OPENAI_CONCURRENCY", "48"))
+SCHEDULER_GEMINI_CONCURRENCY = int(os.getenv("SCHEDULER_GEMINI_CONCURRENCY", "48"))
+# 排隊中的請求總數與每位用戶的上限
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "500"))
+SCHEDULER_MAX_QUEUE_PER_USER = int(os.getenv("SCHEDULER_MAX_QUEUE_PER_USER", "3"))
+# 最長排隊時間，預估等待超過此值時直接拒絕
+SCHEDULER_MAX_WAIT = float(os.getenv("SCHEDULER_MAX_WAIT", "5"))
+# 尚無實測資料時假設的單一請求耗時
+SCHEDULER_DEFAULT_SERVICE_TIME = float(os.getenv("SCHEDULER_DEFAULT_SERVICE_TIME", "3"))
+
+SERVICE_TIME_ALPHA = 0.1
+
+scheduler_admitted = metrics.counter("scheduler_admitted_total")
+scheduler_rejected = metrics.counter("scheduler_rejected_total")
+scheduler_rejected_user = metrics.counter("scheduler_rejected_user_queue_total")
+scheduler_timeouts = metrics.counter("scheduler_queue_timeouts_total")
+scheduler_wait = metrics.histogram("scheduler_queue_wait_seconds")
+scheduler_depth = metrics.histogram("scheduler_queue_depth")
+
+
+class SchedulerBusy(Exception):
+    """排隊已滿或等待過久，retry_after為建議的重試秒數"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"{reason}，{retry_after:.0f} 秒後再試")
+        self.retry_after = retry_after
+
+
+@dataclass
+class _Ticket:
+    user: str
+    provider: str
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class Lease:
+    """取得的執行名額，release可重複呼叫"""
+
+    def __init__(self, scheduler: Optional["FairScheduler"], provider: str):
+        self._scheduler = scheduler
+        self.provider = provider
+        self.started = time.monotonic()
+        self.released = scheduler is None
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self._scheduler._release(self.provider, time.monotonic() - self.started)
+
+
+class FairScheduler:
+    """
+    LLM請求的公平排程
+
+    每位用戶一個FIFO佇列，有空位時依序輪流從各用戶佇列取出一個請求，
+    少數用戶連續送出大量訊息時不會佔滿所有名額。同時受全域與各提供者的並行上限限制。
+    排隊已滿、用戶佇列已滿或預估等待超過上限時立即拒絕，由呼叫端回應429。
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = SCHEDULER_MAX_CONCURRENCY,
+        provider_limits: Optional[Dict[str, int]] = None,
+        max_queue: int = SCHEDULER_MAX_QUEUE,
+        max_queue_per_user: int = SCHEDULER_MAX_QUEUE_PER_USER,
+        max_wait: float = SCHEDULER_MAX_WAIT,
+        enabled: bool = SCHEDULER_ENABLED
+    ):
+        self.max_concurrency = max_concurrency
+        self.provider_limits = {name: limit for name, limit in (provider_limits or {}).items() if limit > 0}
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.max_wait = max_wait
+        self.enabled = enabled
+        # 用戶輪流的順序，剛取出請求的用戶移到最後
+        self._queues: "OrderedDict[str, Deque[_Ticket]]" = OrderedDict()
+        self._queued = 0
+        self._active = 0
+        self._active_by_provider: Dict[str, int] = {name: 0 for name in self.provider_limits}
+        self._service_time = SCHEDULER_DEFAULT_SERVICE_TIME
+
+        metrics.gauge("scheduler_active", lambda: self._active)
+        metrics.gauge("scheduler_queued", lambda: self._queued)
+        metrics.gauge("scheduler_queued_users", lambda: len(self._queues))
+        metrics.gauge("scheduler_service_time_ewma_seconds", lambda: round(self._service_time, 4))
+        for name in self.provider_limits:
+            metrics.gauge(f"scheduler_{name}_active", lambda name=name: self._active_by_provider[name])
+
+    def retry_after(self) -> float:
+        """依排隊長度與平均耗時估計多久後會有空位"""
+        return max(1.0, math.ceil((self._queued + 1) / self.max_concurrency * self._service_time))
+
+    def _has_capacity(self, provider: str) -> bool:
+        if self._active >= self.max_concurrency:
+            return False
+        limit = self.provider_limits.get(provider)
+        return limit is None or self._active_by_provider[provider] < limit
+
+    def _dispatch(self):
+        """輪流從各用戶佇列取出可執行的請求，直到沒有空位"""
+        progressed = True
+        while progressed and self._queues and self._active < self.max_concurrency:
+            progressed = False
+            for user in list(self._queues):
+                queue = self._queues[user]
+                ticket = queue[0]
+                if not self._has_capacity(ticket.provider):
+                    continue
+                queue.popleft()
+                self._queued -= 1
+                if queue:
+                    self._queues.move_to_end(user)
+                else:
+                    del self._queues[user]
+                if ticket.future.done():
+                    # 已放棄等待
+                    continue
+                self._start(ticket.provider)
+                ticket.future.set_result(None)
+                progressed = True
+
+    def _start(self, provider: str):
+        self._active += 1
+        if provider in self._active_by_provider:
+            self._active_by_provider[provider] += 1
+
+    def _release(self, provider: str, elapsed: float):
+        self._active -= 1
+        if provider in self._active_by_provider:
+            self._active_by_provider[provider] -= 1
+        self._service_time = SERVICE_TIME_ALPHA * elapsed + (1 - SERVICE_TIME_ALPHA) * self._service_time
+        self._dispatch()
+
+    def _discard(self, ticket: _Ticket):
+        queue = self._queues.get(ticket.user)
+        if queue is None:
+            return
+        try:
+            queue.remove(ticket)
+        except ValueError:
+            return
+        self._queued -= 1
+        if not queue:
+            del self._queues[ticket.user]
+
+    async def acquire(self, user: str, provider: str, deadline: Optional[float] = None) -> Lease:
+        """取得執行名額，無法在時限內取得時拋出SchedulerBusy"""
+        if not self.enabled:
+            return Lease(None, provider)
+        if not self._queues and self._has_capacity(provider):
+            self._start(provider)
+            scheduler_depth.observe(0)
+            scheduler_wait.observe(0.0)
+            scheduler_admitted.inc()
+            return Lease(self, provider)
+
+        scheduler_depth.observe(self._queued)
+        if self._queued >= self.max_queue:
+            scheduler_rejected.inc()
+            raise SchedulerBusy("請求排隊已滿", self.retry_after())
+        user_queue = self._queues.get(user)
+        if user_queue is not None and len(user_queue) >= self.max_queue_per_user:
+            scheduler_rejected.inc()
+            scheduler_rejected_user.inc()
+            raise SchedulerBusy("用戶排隊中的請求過多", self.retry_after())
+        # 前面的請求以平均耗時消化，預估等待超過上限時不必排隊
+        estimated = self._queued / self.max_concurrency * self._service_time
+        if estimated > self.max_wait:
+            scheduler_rejected.inc()
+            raise SchedulerBusy("預估等待時間過長", self.retry_after())
+
+        ticket = _Ticket(user, provider, asyncio.get_running_loop().create_future())
+        self._queues.setdefault(user, deque()).append(ticket)
+        self._queued += 1
+        self._dispatch()
+
+        timeout = self.max_wait
+        seconds_left = remaining(deadline)
+        if seconds_left is not None:
+            timeout = min(timeout, max(0.0, seconds_left))
+        try:
+            await asyncio.wait_for(ticket.future, timeout)
+        except asyncio.TimeoutError:
+            self._discard(ticket)
+            scheduler_wait.observe(time.monotonic() - ticket.enqueued_at)
+            if seconds_left is not None and seconds_left <= self.max_wait:
+                raise DeadlineExceeded("排隊等待時超過截止時間")
+            scheduler_timeouts.inc()
+            scheduler_rejected.inc()
+            raise SchedulerBusy("排隊等待逾時", self.retry_after())
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # 取得名額的同時被取消
+                self._release(ticket.provider, 0.0)
+            else:
+                self._discard(ticket)
+            raise
+        scheduler_wait.observe(time.monotonic() - ticket.enqueued_at)
+        scheduler_admitted.inc()
+        return Lease(self, provider)
+
+    def try_acquire(self, user: str, provider: str) -> Optional[Lease]:
+        """有空位且無人排隊時立即取得名額，否則回傳None；用於可有可無的額外呼叫(如對沖請求)"""
+        if not self.enabled:
+            return Lease(None, provider)
+        if self._queues or not self._has_capacity(provider):
+            return None
+        self._start(provider)
+        scheduler_admitted.inc()
+        return Lease(self, provider)
+
+    @asynccontextmanager
+    async def slot(self, user: str, provider: str, deadline: Optional[float] = None):
+        """在名額內執行，離開時釋放名額"""
+        lease = await self.acquire(user, provider, deadline)
+        try:
+            yield lease
+        finally:
+            lease.release()
+
+
+# 聊天請求共用的排程器
+llm_scheduler = FairScheduler(provider_limits={
+    "openai": SCHEDULER_OPENAI_CONCURRENCY,
+    "gemini": SCHEDULER_GEMINI_CONCURRENCY,
+})
@@ -1,10 +1,22 @@
 import os
-import openai
-import json
+import time
 import logging
-import redis
+import httpx
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
 
+from app.utils.deadline import remaining
+from app.utils.metrics import metrics
+from app.services.conversation_store import openai_history
+from app.services.response_cache import openai_cache
+from app.services.semantic_cache import semantic_cache, namespace_id
+from app.services.single_flight import single_flight
+from app.services.provider_stats import get_stats
+from app.services.adaptive_limiter import AdaptiveLimiter, as_overload
+from app.services.context_builder import (
+    SUMMARY_PROMPT, build_context, format_summary_request, schedule_summary
+)
+
 # 加載環境變數
 load_dotenv()
 
@@ -13,108 +25,270 @@ logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
 logger = logging.getLogger(__name__)
 
 # OpenAI配置
-openai.api_key = os.getenv("OPENAI_API_KEY")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")  # 可指向相容OpenAI的本機模擬伺服器
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
 MAX_TOKENS = int(os.getenv("MAX_TOKENS", "500"))
 TEMPERATURE = float(os.getenv("TEMPERATURE", "0.7"))
+SYSTEM_PROMPT = "你是一個友善的聊天機器人助手，請用繁體中文回應用戶問題。"
+
+# 連線池與並行設定，並行數依限流回應在上限內自動調整
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "200"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "200"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "50"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "30"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "1"))
+
+# 共用的非同步客戶端，第一次使用時建立
+_openai_client = None
 
-# Redis配置
-REDIS_HOST = os.getenv("REDIS_HOST", "redis")
-REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
-REDIS_CACHE_EXPIRY = int(os.getenv("REDIS_CACHE_EXPIRY", "3600"))  # 1小時
+# 限制同時進行的OpenAI請求數
+openai_limiter = AdaptiveLimiter("openai", OPENAI_MAX_CONCURRENCY)
+_in_flight = 0
+metrics.gauge("openai_in_flight", lambda: _in_flight)
+openai_queue_wait = metrics.histogram("openai_limiter_wait_seconds")
+openai_latency = metrics.histogram("openai_request_seconds")
+openai_errors = metrics.counter("openai_errors_total")
+openai_ttft = metrics.histogram("openai_ttft_seconds")
+openai_stats = get_stats("openai", OPENAI_MODEL)
 
-# 初始化Redis連接
-try:
-    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
-    redis_client.ping()  # 測試連接
-    logger.info("Redis連接成功")
-except redis.ConnectionError as e:
-    logger.warning(f"Redis連接失敗: {e}")
-    redis_client = None
+def get_openai_client():
+    """取得共用連線池的AsyncOpenAI客戶端"""
+    global _openai_client
+    if _openai_client is None:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE
+            ),
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+        )
+        _openai_client = AsyncOpenAI(
+            api_key=OPENAI_API_KEY or "not-configured",
+            base_url=OPENAI_BASE_URL or None,
+            max_retries=OPENAI_MAX_RETRIES,
+            timeout=OPENAI_TIMEOUT,
+            http_client=http_client
+        )
+    return _openai_client
 
 class OpenAIService:
+    # 未指定對話歷史時使用的儲存
+    history = openai_history
+    
     @staticmethod
-    def get_chat_history(line_user_id, limit=5):
+    async def get_chat_history(line_user_id, limit=5):
         """從Redis獲取用戶的聊天歷史"""
-        if not redis_client:
-            return []
-        
-        history_key = f"chat_history:{line_user_id}"
-        try:
-            history_json = redis_client.get(history_key)
-            if history_json:
-                return json.loads(history_json)[-limit:]
-            return []
-        except Exception as e:
-            logger.error(f"獲取聊天歷史錯誤: {e}")
-            return []
+        return await openai_history.get_history(line_user_id, limit)
     
     @staticmethod
-    def save_chat_history(line_user_id, message, response):
-        """保存聊天歷史到Redis"""
-        if not redis_client:
-            return
+    async def create_completion(messages, deadline=None):
+        """
+        在並行上限內呼叫OpenAI，逾時依截止時間縮短
+
+        限流或過載(429/503)時拋出ProviderOverloaded，其餘錯誤原樣拋出。
+        """
+        global _in_flight
+        wait_started = time.perf_counter()
+        await openai_limiter.acquire(deadline)
+        openai_queue_wait.observe(time.perf_counter() - wait_started)
         
-        history_key = f"chat_history:{line_user_id}"
+        # 扣除等待時間後依剩餘時間設定逾時
+        timeout = OPENAI_TIMEOUT
+        seconds_left = remaining(deadline)
+        if seconds_left is not None:
+            timeout = max(0.001, min(timeout, seconds_left))
+        
+        _in_flight += 1
+        started = time.perf_counter()
+        latency = None
+        error = None
         try:
-            # 獲取現有歷史或創建新的
-            history_json = redis_client.get(history_key)
-            if history_json:
-                history = json.loads(history_json)
-            else:
-                history = []
-            
-            # 添加新的對話
-            history.append({
-                "user": message,
-                "assistant": response
-            })
-            
-            # 保存歷史，只保留最近10條
-            redis_client.set(
-                history_key, 
-                json.dumps(history[-10:]), 
-                ex=REDIS_CACHE_EXPIRY
+            response = await get_openai_client().chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=messages,
+                max_tokens=MAX_TOKENS,
+                temperature=TEMPERATURE,
+                n=1,
+                timeout=timeout
             )
+            latency = time.perf_counter() - started
         except Exception as e:
-            logger.error(f"保存聊天歷史錯誤: {e}")
+            openai_errors.inc()
+            openai_stats.record_failure()
+            error = as_overload("openai", e)
+            if error is not None:
+                raise error from e
+            raise
+        finally:
+            _in_flight -= 1
+            openai_latency.observe(time.perf_counter() - started)
+            openai_limiter.release(success=latency is not None, latency=latency, error=error)
+        openai_stats.record_success(latency)
+        
+        # 獲取生成的回應
+        return response.choices[0].message.content.strip()
     
     @staticmethod
-    async def generate_response(line_user_id, message):
-        """使用OpenAI生成回應"""
+    async def stream_completion(messages, deadline=None):
+        """以串流模式呼叫OpenAI，逐段產生回應文字；限流或過載時拋出ProviderOverloaded"""
+        global _in_flight
+        wait_started = time.perf_counter()
+        await openai_limiter.acquire(deadline)
+        openai_queue_wait.observe(time.perf_counter() - wait_started)
+        
+        # 串流時逾時套用於每次讀取，總時間由呼叫端的截止時間限制
+        timeout = OPENAI_TIMEOUT
+        seconds_left = remaining(deadline)
+        if seconds_left is not None:
+            timeout = max(0.001, min(timeout, seconds_left))
+        
+        _in_flight += 1
+        started = time.perf_counter()
+        first_token = True
+        completed = False
+        error = None
         try:
-            # 獲取聊天歷史
-            chat_history = OpenAIService.get_chat_history(line_user_id)
-            
-            # 創建消息列表
-            messages = [{"role": "system", "content": "你是一個友善的聊天機器人助手，請用繁體中文回應用戶問題。"}]
-            
-            # 添加聊天歷史
-            for entry in chat_history:
-                messages.append({"role": "user", "content": entry["user"]})
-                messages.append({"role": "assistant", "content": entry["assistant"]})
-            
-            # 添加當前消息
-            messages.append({"role": "user", "content": message})
-            
-            # 調用OpenAI API
-            response = openai.ChatCompletion.create(
+            stream = await get_openai_client().chat.completions.create(
                 model=OPENAI_MODEL,
                 messages=messages,
                 max_tokens=MAX_TOKENS,
                 temperature=TEMPERATURE,
                 n=1,
-                stop=None
+                stream=True,
+                timeout=timeout
             )
-            
-            # 獲取生成的回應
-            generated_text = response.choices[0].message["content"].strip()
-            
-            # 保存到歷史記錄
-            OpenAIService.save_chat_history(line_user_id, message, generated_text)
-            
-            return generated_text
-            
+            async for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                if first_token:
+                    openai_ttft.observe(time.perf_counter() - started)
+                    openai_stats.record_ttft(time.perf_counter() - started)
+                    first_token = False
+                yield chunk.choices[0].delta.content
+            completed = True
+            openai_stats.record_success(time.perf_counter() - started)
         except Exception as e:
-            logger.error(f"OpenAI API錯誤: {e}")
-            return "很抱歉，我現在無法處理您的請求，請稍後再試。" 
\ No newline at end of file
+            openai_errors.inc()
+            openai_stats.record_failure()
+            error = as_overload("openai", e)
+            if error is not None:
+                raise error from e
+            raise
+        finally:
+            _in_flight -= 1
+            openai_latency.observe(time.perf_counter() - started)
+            # 串流長度取決於回應內容，不以總耗時判斷延遲飆高
+            openai_limiter.release(success=completed, error=error)
+    
+    @staticmethod
+    async def summarize(previous_summary, turns):
+        """將移出上下文視窗的對話併入摘要"""
+        messages = [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": format_summary_request(previous_summary, turns)}
+        ]
+        return await OpenAIService.create_completion(messages)
+    
+    @staticmethod
+    async def aclose():
+        """關閉共用連線池"""
+        global _openai_client
+        if _openai_client is not None:
+            await _openai_client.close()
+            _openai_client = None
+    
+    @staticmethod
+    def build_messages(window, message):
+        """依上下文視窗組成消息列表"""
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        if window.summary:
+            messages.append({"role": "system", "content": f"先前對話摘要：{window.summary}"})
+        
+        # 添加聊天歷史
+        for entry in window.turns:
+            messages.append({"role": "user", "content": entry["user"]})
+            messages.append({"role": "assistant", "content": entry["assistant"]})
+        
+        # 添加當前消息
+        messages.append({"role": "user", "content": message})
+        return messages
+    
+    @staticmethod
+    async def lookup_cached(chat_history, message, summary_record=None):
+        """查詢完全相同與改寫過的問題，回傳(快取鍵, 命名空間, 快取的回應)"""
+        # 鍵包含提示中的所有上下文：取得的每一輪對話與滾動摘要
+        summary = summary_record.get("summary") if summary_record else None
+        cache_key = openai_cache.make_key(OPENAI_MODEL, SYSTEM_PROMPT, message, chat_history, summary)
+        namespace = namespace_id("openai", OPENAI_MODEL, SYSTEM_PROMPT, chat_history, message, summary)
+        generated_text = await openai_cache.get(cache_key)
+        if generated_text is None:
+            generated_text = await semantic_cache.get(namespace, message)
+        return cache_key, namespace, generated_text
+    
+    @staticmethod
+    async def remember(line_user_id, message, generated_text, latency, cache_key, namespace, window, store):
+        """新生成的回應寫入快取，並在背景更新摘要"""
+        await openai_cache.set(cache_key, generated_text, latency)
+        await semantic_cache.set(namespace, message, generated_text, latency)
+        schedule_summary(store, line_user_id, window, OpenAIService.summarize)
+    
+    @staticmethod
+    async def complete(line_user_id, message, deadline=None, store=openai_history):
+        """
+        使用OpenAI生成完整回應
+
+        store為讀取上下文的對話歷史；錯誤直接拋出，歷史記錄由呼叫端在回應確定送出後寫入。
+        """
+        # 獲取保留的所有聊天歷史與摘要，送出的輪數由build_context決定
+        chat_history, summary_record = await store.get_context(line_user_id, store.max_turns)
+        
+        # 相同問題與上下文直接使用快取的回應
+        cache_key, namespace, generated_text = await OpenAIService.lookup_cached(chat_history, message, summary_record)
+        if generated_text is not None:
+            return generated_text
+        
+        # 在token預算內由新到舊挑選歷史，較舊的對話以摘要代替
+        window = build_context(
+            "openai", SYSTEM_PROMPT, chat_history, message, summary_record, max_turns=store.max_turns
+        )
+        messages = OpenAIService.build_messages(window, message)
+        
+        # 調用OpenAI API
+        started = time.perf_counter()
+        # 相同問題同時進行時共用同一次呼叫
+        generated_text = await single_flight.do(
+            cache_key, lambda: OpenAIService.create_completion(messages, deadline), deadline
+        )
+        await OpenAIService.remember(
+            line_user_id, message, generated_text, time.perf_counter() - started, cache_key, namespace, window, store
+        )
+        return generated_text
+    
+    @staticmethod
+    async def stream(line_user_id, message, deadline=None, store=openai_history):
+        """
+        以串流方式生成回應，逐段產生文字
+
+        快取命中時一次產生完整回應；串流完成後才寫入快取，錯誤直接拋出。
+        """
+        chat_history, summary_record = await store.get_context(line_user_id, store.max_turns)
+        cache_key, namespace, generated_text = await OpenAIService.lookup_cached(chat_history, message, summary_record)
+        if generated_text is not None:
+            yield generated_text
+            return
+        
+        window = build_context(
+            "openai", SYSTEM_PROMPT, chat_history, message, summary_record, max_turns=store.max_turns
+        )
+        messages = OpenAIService.build_messages(window, message)
+        
+        started = time.perf_counter()
+        parts = []
+        async for delta in OpenAIService.stream_completion(messages, deadline):
+            parts.append(delta)
+            yield delta
+        await OpenAIService.remember(
+            line_user_id, message, "".join(parts).strip(), time.perf_counter() - started, cache_key, namespace, window, store
+        )
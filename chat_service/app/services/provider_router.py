@@ -0,0 +1,294 @@
+import os
+import time
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from app.utils.deadline import DeadlineExceeded, check_deadline
+from app.utils.metrics import metrics
+from app.services.conversation_store import openai_history
+from app.services.provider_stats import get_stats
+from app.services.adaptive_limiter import ProviderOverloaded
+from app.services.llm_scheduler import llm_scheduler
+from app.services.openai_service import OpenAIService, OPENAI_API_KEY, OPENAI_BASE_URL, OPENAI_MODEL
+from app.services.gemini_service import GeminiService, GEMINI_API_KEY, GEMINI_MODEL
+
+# 加載環境變數
+load_dotenv()
+
+# 配置日誌
+logger = logging.getLogger(__name__)
+
+# 自動選擇時的候選提供者，延遲相同時依此順序
+ROUTER_PROVIDERS = [name.strip() for name in os.getenv("ROUTER_PROVIDERS", "openai,gemini").split(",") if name.strip()]
+# 主要提供者出錯時改用下一個
+ROUTER_FALLBACK_ENABLED = os.getenv("ROUTER_FALLBACK_ENABLED", "true").lower() == "true"
+# 錯誤率超過此值的提供者排到最後
+ROUTER_ERROR_THRESHOLD = float(os.getenv("ROUTER_ERROR_THRESHOLD", "0.5"))
+# 對沖請求：主要提供者超過延遲百分位數仍未回應時，同時請求下一個提供者(會增加呼叫量，預設關閉)
+ROUTER_HEDGE_ENABLED = os.getenv("ROUTER_HEDGE_ENABLED", "false").lower() == "true"
+ROUTER_HEDGE_PERCENTILE = float(os.getenv("ROUTER_HEDGE_PERCENTILE", "0.95"))
+ROUTER_HEDGE_MIN_SAMPLES = int(os.getenv("ROUTER_HEDGE_MIN_SAMPLES", "20"))
+ROUTER_HEDGE_DEFAULT_DELAY = float(os.getenv("ROUTER_HEDGE_DEFAULT_DELAY", "3"))
+ROUTER_HEDGE_MIN_DELAY = float(os.getenv("ROUTER_HEDGE_MIN_DELAY", "0.5"))
+ROUTER_HEDGE_MAX_DELAY = float(os.getenv("ROUTER_HEDGE_MAX_DELAY", "10"))
+
+FALLBACK_MESSAGE = "很抱歉，我現在無法處理您的請求，請稍後再試。"
+
+PROVIDERS = {"openai": OpenAIService, "gemini": GeminiService}
+MODELS = {"openai": OPENAI_MODEL, "gemini": GEMINI_MODEL}
+
+# 自動選擇時所有提供者共用同一份對話歷史，切換提供者不會中斷上下文
+AUTO_HISTORY = openai_history
+
+router_hedges = metrics.counter("router_hedges_total")
+router_hedge_wins = metrics.counter("router_hedge_wins_total")
+router_hedges_skipped = metrics.counter("router_hedges_skipped_total")
+router_fallbacks = metrics.counter("router_fallbacks_total")
+router_failures = metrics.counter("router_all_failed_total")
+router_wins = {name: metrics.counter(f"router_{name}_wins_total") for name in PROVIDERS}
+
+
+class ProvidersUnavailable(Exception):
+    """所有提供者都無法回應；呼叫端以FALLBACK_MESSAGE回覆，但不寫入歷史記錄或快取"""
+
+    def __init__(self, provider: str, error: BaseException):
+        super().__init__(f"所有提供者都無法回應: {error}")
+        self.provider = provider
+
+
+def _configured(name: str) -> bool:
+    """未設定金鑰的提供者不參與自動選擇"""
+    if name == "openai":
+        return bool(OPENAI_API_KEY or OPENAI_BASE_URL)
+    if name == "gemini":
+        return bool(GEMINI_API_KEY)
+    return False
+
+
+class ProviderRouter:
+    """
+    依延遲與錯誤率選擇LLM提供者
+
+    每個提供者/模型以EWMA追蹤延遲與錯誤率(見provider_stats)，自動選擇時優先使用
+    錯誤率低且延遲最短的提供者；出錯時改用下一個。啟用對沖時，主要提供者超過
+    其延遲百分位數仍未回應，會同時請求下一個提供者，採用先完成的結果並取消另一個；
+    對沖請求需另外取得排程名額，沒有空位時不對沖。
+    用戶明確指定提供者時只使用該提供者，也使用該提供者自己的對話歷史。
+    """
+
+    def __init__(
+        self,
+        providers: List[str] = ROUTER_PROVIDERS,
+        hedge_enabled: bool = ROUTER_HEDGE_ENABLED,
+        fallback_enabled: bool = ROUTER_FALLBACK_ENABLED
+    ):
+        self.providers = [name for name in providers if name in PROVIDERS]
+        self.hedge_enabled = hedge_enabled
+        self.fallback_enabled = fallback_enabled
+
+    def stats(self, name: str):
+        return get_stats(name, MODELS[name])
+
+    def rank(self, streaming: bool = False) -> List[str]:
+        """
+        依(是否異常, 延遲EWMA, 設定順序)排序可用的提供者
+
+        尚無延遲樣本的提供者以其他提供者EWMA的平均值計算，不會因為沒有資料而總是排在最前面；
+        都沒有樣本時依設定順序。
+        """
+        candidates = [name for name in self.providers if _configured(name)] or list(self.providers)
+        ewmas = {name: self.stats(name).tracker(streaming).ewma for name in candidates}
+        measured = [ewma for ewma in ewmas.values() if ewma is not None]
+        prior = sum(measured) / len(measured) if measured else 0.0
+
+        def key(item):
+            index, name = item
+            ewma = ewmas[name]
+            return (self.stats(name).error_rate >= ROUTER_ERROR_THRESHOLD, prior if ewma is None else ewma, index)
+
+        return [name for _, name in sorted(enumerate(candidates), key=key)]
+
+    def hedge_delay(self, name: str, streaming: bool = False) -> float:
+        """主要提供者的延遲百分位數，樣本不足時使用預設值"""
+        tracker = self.stats(name).tracker(streaming)
+        delay = ROUTER_HEDGE_DEFAULT_DELAY
+        if len(tracker) >= ROUTER_HEDGE_MIN_SAMPLES:
+            delay = tracker.percentile(ROUTER_HEDGE_PERCENTILE)
+        return min(max(delay, ROUTER_HEDGE_MIN_DELAY), ROUTER_HEDGE_MAX_DELAY)
+
+    def history(self, provider: Optional[str]):
+        """請求使用的對話歷史"""
+        if provider:
+            return PROVIDERS[provider].history
+        return AUTO_HISTORY
+
+    def plan(self, provider: Optional[str], streaming: bool = False):
+        """回傳(候選提供者, 對話歷史)"""
+        if provider:
+            return [provider], self.history(provider)
+        return self.rank(streaming), self.history(provider)
+
+    def primary(self, provider: Optional[str], streaming: bool = False) -> str:
+        """請求優先使用的提供者，排程時以此計算各提供者的並行數"""
+        names, _ = self.plan(provider, streaming)
+        return names[0]
+
+    async def _race(
+        self,
+        line_user_id: str,
+        names: List[str],
+        start: Callable[[str], Awaitable],
+        deadline: Optional[float],
+        streaming: bool
+    ) -> Tuple[str, object]:
+        """
+        依序啟動候選提供者，回傳最先成功的(提供者, 結果)
+
+        主要提供者出錯時立即啟動下一個；啟用對沖時，超過對沖延遲仍未完成也會啟動下一個，
+        對沖請求與主要請求同時進行，需另外向排程器取得該提供者的名額，結束時釋放。
+        返回前取消其餘仍在進行的請求。
+        """
+        queue = list(names)
+        pending: Dict[asyncio.Future, str] = {}
+        order: Dict[str, int] = {}
+        hedged = set()
+        last_error: Optional[BaseException] = None
+        hedge_at = None
+
+        async def run_hedge(name, lease):
+            try:
+                return await start(name)
+            finally:
+                lease.release()
+
+        def launch(lease=None):
+            nonlocal hedge_at
+            name = queue.pop(0)
+            order[name] = len(order)
+            task = start(name) if lease is None else run_hedge(name, lease)
+            pending[asyncio.ensure_future(task)] = name
+            hedge_at = None
+            if self.hedge_enabled and queue:
+                hedge_at = time.monotonic() + self.hedge_delay(name, streaming)
+
+        launch()
+        try:
+            while pending:
+                timeout = None if hedge_at is None else max(0.0, hedge_at - time.monotonic())
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    lease = llm_scheduler.try_acquire(line_user_id, queue[0])
+                    if lease is None:
+                        # 排程已滿，繼續等待主要提供者，出錯時仍會依序改用下一個
+                        router_hedges_skipped.inc()
+                        hedge_at = None
+                        continue
+                    router_hedges.inc()
+                    hedged.add(queue[0])
+                    launch(lease)
+                    continue
+
+                # 同時完成時以先啟動的為準
+                for task in sorted(done, key=lambda task: order[pending[task]]):
+                    name = pending.pop(task)
+                    if task.exception() is None:
+                        if name in hedged:
+                            router_hedge_wins.inc()
+                        router_wins[name].inc()
+                        return name, task.result()
+                    last_error = task.exception()
+                    if isinstance(last_error, DeadlineExceeded):
+                        raise last_error
+                    logger.warning(f"提供者 {name} 回應失敗: {last_error}")
+
+                if not pending and queue and self.fallback_enabled:
+                    check_deadline(deadline)
+                    router_fallbacks.inc()
+                    launch()
+            router_failures.inc()
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def generate(
+        self,
+        line_user_id: str,
+        message: str,
+        deadline: Optional[float] = None,
+        provider: Optional[str] = None
+    ) -> Tuple[str, str]:
+        """
+        生成完整回應，回傳(回應, 實際使用的提供者)
+
+        最後嘗試的提供者限流或過載時拋出ProviderOverloaded，由呼叫端回應429；
+        其他錯誤拋出ProvidersUnavailable，由呼叫端回覆FALLBACK_MESSAGE且不保存。
+        """
+        names, store = self.plan(provider)
+        try:
+            name, generated_text = await self._race(
+                line_user_id,
+                names,
+                lambda name: PROVIDERS[name].complete(line_user_id, message, deadline, store),
+                deadline,
+                streaming=False
+            )
+        except (DeadlineExceeded, ProviderOverloaded):
+            raise
+        except Exception as e:
+            logger.error(f"所有提供者都無法回應，用戶ID: {line_user_id}: {e}")
+            raise ProvidersUnavailable(names[0], e) from e
+
+        # 回應已無法送達時不寫入歷史記錄
+        check_deadline(deadline, in_flight=True)
+        await store.append(line_user_id, message, generated_text)
+        return generated_text, name
+
+    async def stream(
+        self,
+        line_user_id: str,
+        message: str,
+        deadline: Optional[float] = None,
+        provider: Optional[str] = None
+    ) -> AsyncIterator[Tuple[str, str]]:
+        """
+        串流生成回應，逐段產生(提供者, 文字)
+
+        以第一段文字到達的時間決定勝出的提供者；開始輸出後不再切換提供者，
+        之後的錯誤直接拋出。串流完成後才寫入歷史記錄。
+        """
+        names, store = self.plan(provider, streaming=True)
+        streams = {}
+
+        async def first_delta(name):
+            streams[name] = PROVIDERS[name].stream(line_user_id, message, deadline, store)
+            try:
+                return await streams[name].__anext__()
+            except StopAsyncIteration:
+                return None
+
+        try:
+            name, delta = await self._race(line_user_id, names, first_delta, deadline, streaming=True)
+            parts = []
+            if delta is not None:
+                parts.append(delta)
+                yield name, delta
+            async for delta in streams[name]:
+                parts.append(delta)
+                yield name, delta
+
+            # 回應已無法送達時不寫入歷史記錄
+            check_deadline(deadline, in_flight=True)
+            await store.append(line_user_id, message, "".join(parts).strip())
+        finally:
+            for source in streams.values():
+                await source.aclose()
+
+
+# 服務共用的路由器
+provider_router = ProviderRouter()
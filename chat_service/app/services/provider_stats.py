@@ -0,0 +1,98 @@
+import os
+import time
+import threading
+from collections import deque
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+from app.utils.metrics import metrics
+
+# 加載環境變數
+load_dotenv()
+
+# 延遲EWMA的平滑係數，越大越快反映最近的延遲
+ROUTER_EWMA_ALPHA = float(os.getenv("ROUTER_EWMA_ALPHA", "0.2"))
+# 錯誤率每經過此秒數減半，讓停止分流的提供者能自動恢復
+ROUTER_ERROR_HALF_LIFE = float(os.getenv("ROUTER_ERROR_HALF_LIFE", "30"))
+# 計算百分位數保留的最近樣本數
+ROUTER_LATENCY_WINDOW = int(os.getenv("ROUTER_LATENCY_WINDOW", "256"))
+
+
+class LatencyTracker:
+    """延遲的EWMA與最近樣本"""
+
+    def __init__(self, alpha: float = ROUTER_EWMA_ALPHA, window: int = ROUTER_LATENCY_WINDOW):
+        self.alpha = alpha
+        self.ewma: Optional[float] = None
+        self._samples = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        self.ewma = seconds if self.ewma is None else self.alpha * seconds + (1 - self.alpha) * self.ewma
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))]
+
+    def __len__(self):
+        return len(self._samples)
+
+
+class ProviderStats:
+    """
+    單一提供者與模型的呼叫統計
+
+    latency為完整回應的延遲，ttft為串流第一段文字的延遲；
+    錯誤率是成功/失敗的EWMA，並隨時間衰減。快取命中不經過提供者，不列入統計。
+    """
+
+    def __init__(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+        self.latency = LatencyTracker()
+        self.ttft = LatencyTracker()
+        self._error_rate = 0.0
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def error_rate(self) -> float:
+        elapsed = time.monotonic() - self._updated_at
+        return self._error_rate * 0.5 ** (elapsed / ROUTER_ERROR_HALF_LIFE)
+
+    def _record_outcome(self, failed: bool):
+        with self._lock:
+            self._error_rate = ROUTER_EWMA_ALPHA * failed + (1 - ROUTER_EWMA_ALPHA) * self.error_rate
+            self._updated_at = time.monotonic()
+
+    def record_success(self, seconds: float):
+        self.latency.observe(seconds)
+        self._record_outcome(False)
+
+    def record_ttft(self, seconds: float):
+        self.ttft.observe(seconds)
+
+    def record_failure(self):
+        self._record_outcome(True)
+
+    def tracker(self, streaming: bool) -> LatencyTracker:
+        """串流時以第一段文字的延遲為準"""
+        return self.ttft if streaming and len(self.ttft) else self.latency
+
+
+_stats: Dict[str, ProviderStats] = {}
+
+
+def get_stats(provider: str, model: str) -> ProviderStats:
+    """取得提供者與模型的統計，第一次使用時建立並註冊指標"""
+    key = f"{provider}:{model}"
+    stats = _stats.get(key)
+    if stats is None:
+        stats = _stats[key] = ProviderStats(provider, model)
+        metrics.gauge(f"router_{provider}_latency_ewma_seconds", lambda: round(stats.latency.ewma or 0.0, 4))
+        metrics.gauge(f"router_{provider}_ttft_ewma_seconds", lambda: round(stats.ttft.ewma or 0.0, 4))
+        metrics.gauge(f"router_{provider}_error_rate", lambda: round(stats.error_rate, 4))
+    return stats
@@ -0,0 +1,227 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import unicodedata
+from collections import OrderedDict
+from typing import List, Optional
+
+from dotenv import load_dotenv
+
+from app.utils.metrics import metrics
+from app.services.conversation_store import redis_client
+
+# 加載環境變數
+load_dotenv()
+
+# 配置日誌
+logger = logging.getLogger(__name__)
+
+# 回應快取預設關閉，需明確開啟
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+# digest: 鍵包含送出的所有歷史與滾動摘要；single_turn: 忽略歷史，只適合回答與上下文無關的FAQ型單輪問答
+RESPONSE_CACHE_HISTORY_MODE = os.getenv("RESPONSE_CACHE_HISTORY_MODE", "digest")
+RESPONSE_CACHE_LOCAL_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_LOCAL_MAX_ENTRIES", "5000"))
+RESPONSE_CACHE_LOCAL_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_LOCAL_MAX_BYTES", str(16 * 1024 * 1024)))
+RESPONSE_CACHE_MAX_RESPONSE_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_RESPONSE_BYTES", "8192"))
+RESPONSE_CACHE_TTL_OPENAI = int(os.getenv("RESPONSE_CACHE_TTL_OPENAI", "3600"))
+RESPONSE_CACHE_TTL_GEMINI = int(os.getenv("RESPONSE_CACHE_TTL_GEMINI", "3600"))
+
+# v2: 鍵包含所有上下文對話與摘要
+KEY_PREFIX = "response_cache:v2:"
+
+# 正規化時移除的結尾標點
+_TRAILING_PUNCTUATION = re.compile(r"[\s?？!！。.,，~～]+$")
+_WHITESPACE = re.compile(r"\s+")
+
+cache_hits_local = metrics.counter("response_cache_hits_local_total")
+cache_hits_redis = metrics.counter("response_cache_hits_redis_total")
+cache_misses = metrics.counter("response_cache_misses_total")
+cache_evictions = metrics.counter("response_cache_evictions_total")
+cache_errors = metrics.counter("response_cache_errors_total")
+cache_corrupt = metrics.counter("response_cache_corrupt_total")
+cache_saved_seconds = metrics.counter("response_cache_saved_seconds_total")
+cache_lookup_seconds = metrics.histogram("response_cache_lookup_seconds")
+
+
+def normalize_message(message: str) -> str:
+    """正規化訊息：全半形統一、大小寫折疊、合併空白、去除結尾標點"""
+    text = unicodedata.normalize("NFKC", message).casefold().strip()
+    text = _WHITESPACE.sub(" ", text)
+    return _TRAILING_PUNCTUATION.sub("", text)
+
+
+def history_digest(chat_history: List[dict], summary: Optional[str] = None) -> str:
+    """
+    提示中所有上下文的摘要：取得的每一輪對話加上滾動摘要
+
+    提示由這些內容決定，只要任何一輪或摘要不同就不共用快取
+    """
+    if RESPONSE_CACHE_HISTORY_MODE == "single_turn":
+        return "-"
+    if not chat_history and not summary:
+        return "-"
+    payload = json.dumps(
+        {
+            "turns": [[normalize_message(entry["user"]), entry["assistant"]] for entry in chat_history],
+            "summary": summary or "",
+        },
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+class _LocalLRU:
+    """依項目數與位元組總量淘汰的行程內LRU"""
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        item = self._entries.get(key)
+        if item is None:
+            return None
+        value, size, expires_at = item
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: dict, size: int, ttl: float):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, size, time.monotonic() + ttl)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            cache_evictions.inc()
+
+    def _remove(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+
+# 所有提供者共用同一個本機容量
+_local = _LocalLRU(RESPONSE_CACHE_LOCAL_MAX_ENTRIES, RESPONSE_CACHE_LOCAL_MAX_BYTES)
+metrics.gauge("response_cache_local_entries", lambda: len(_local))
+metrics.gauge("response_cache_local_bytes", lambda: _local.size_bytes)
+
+
+def _hit_ratio():
+    hits = cache_hits_local.value + cache_hits_redis.value
+    total = hits + cache_misses.value
+    return round(hits / total, 4) if total else 0.0
+
+
+metrics.gauge("response_cache_hit_ratio", _hit_ratio)
+
+
+class ResponseCache:
+    """
+    完全相同問題的LLM回應快取：行程內LRU + Redis
+
+    鍵由提供者、模型、系統提示、正規化後的訊息與完整上下文(所有歷史與滾動摘要)的雜湊組成，
+    只快取成功的回應，錯誤訊息不會進入快取。無法解析的快取值視為未命中並刪除。
+    """
+
+    def __init__(self, provider: str, ttl: int, enabled: bool = RESPONSE_CACHE_ENABLED):
+        self.provider = provider
+        self.ttl = ttl
+        self.enabled = enabled and ttl > 0
+
+    def make_key(
+        self,
+        model: str,
+        system_prompt: str,
+        message: str,
+        chat_history: List[dict],
+        summary: Optional[str] = None
+    ) -> str:
+        raw = "\x1f".join([
+            self.provider,
+            model,
+            hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:16],
+            normalize_message(message),
+            history_digest(chat_history, summary),
+        ])
+        return f"{KEY_PREFIX}{hashlib.sha256(raw.encode('utf-8')).hexdigest()}"
+
+    async def get(self, key: str) -> Optional[str]:
+        """查詢快取，命中時回傳回應文字"""
+        if not self.enabled:
+            return None
+        started = time.perf_counter()
+        entry = _local.get(key)
+        if entry is not None:
+            cache_hits_local.inc()
+        else:
+            try:
+                raw = await redis_client.get(key)
+            except Exception as e:
+                cache_errors.inc()
+                logger.warning(f"讀取回應快取失敗: {e}")
+                raw = None
+            if raw is not None:
+                try:
+                    entry = json.loads(raw)
+                    if not isinstance(entry, dict) or not isinstance(entry.get("response"), str):
+                        raise ValueError("缺少response欄位")
+                except ValueError as e:
+                    await self._discard(key, e)
+                    raw = None
+            if raw is None:
+                cache_misses.inc()
+                cache_lookup_seconds.observe(time.perf_counter() - started)
+                return None
+            # 回填本機快取，剩餘TTL以設定值近似；容量以UTF-8位元組計算
+            _local.set(key, entry, len(raw.encode("utf-8")), self.ttl)
+            cache_hits_redis.inc()
+        lookup = time.perf_counter() - started
+        cache_lookup_seconds.observe(lookup)
+        cache_saved_seconds.inc(max(0.0, entry.get("latency", 0.0) - lookup))
+        return entry["response"]
+
+    async def _discard(self, key: str, error: Exception):
+        """無法解析的快取值視為未命中並刪除"""
+        cache_corrupt.inc()
+        logger.warning(f"回應快取內容無法解析，刪除 {key}: {error}")
+        try:
+            await redis_client.delete(key)
+        except Exception as e:
+            cache_errors.inc()
+            logger.warning(f"刪除回應快取失敗: {e}")
+
+    async def set(self, key: str, response: str, latency: float):
+        """寫入快取；latency為實際生成耗時，用於估算命中時節省的時間"""
+        if not self.enabled or not response:
+            return
+        entry = {"response": response, "latency": round(latency, 4)}
+        # 回應多為中文，每字UTF-8佔3個位元組，上限與本機容量都以位元組計算而非字元數
+        raw = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+        if len(raw) > RESPONSE_CACHE_MAX_RESPONSE_BYTES:
+            return
+        _local.set(key, entry, len(raw), self.ttl)
+        try:
+            await redis_client.set(key, raw, ex=self.ttl)
+        except Exception as e:
+            cache_errors.inc()
+            logger.warning(f"寫入回應快取失敗: {e}")
+
+
+# 各模型提供者的回應快取
+openai_cache = ResponseCache("openai", RESPONSE_CACHE_TTL_OPENAI)
+gemini_cache = ResponseCache("gemini", RESPONSE_CACHE_TTL_GEMINI)
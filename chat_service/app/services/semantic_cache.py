@@ -0,0 +1,441 @@
+import os
+import re
+import json
+import time
+import zlib
+import asyncio
+import hashlib
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+from app.utils.metrics import metrics
+from app.services.conversation_store import redis_client
+from app.services.response_cache import normalize_message, history_digest
+
+# 加載環境變數
+load_dotenv()
+
+# 配置日誌
+logger = logging.getLogger(__name__)
+
+# 近似問題快取預設關閉，需明確開啟
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "100000"))
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", "86400"))
+SEMANTIC_CACHE_DIM = int(os.getenv("SEMANTIC_CACHE_DIM", str(2 ** 18)))
+# 新增項目累積到此數量後在背景執行緒重建倒排索引
+SEMANTIC_CACHE_DELTA_LIMIT = int(os.getenv("SEMANTIC_CACHE_DELTA_LIMIT", "4096"))
+# 只快取短問題，長訊息通常是特定情境
+SEMANTIC_CACHE_MAX_MESSAGE_CHARS = int(os.getenv("SEMANTIC_CACHE_MAX_MESSAGE_CHARS", "200"))
+
+REDIS_ENTRIES_KEY = "semantic_cache:v1:entries"
+LOAD_BATCH_SIZE = 1000
+
+NGRAM_SIZES = (2, 3)
+
+# 不影響語意的語助詞，以及常見的同義疑問詞
+_PARTICLES = re.compile(r"[的了呢嗎吗吧啊呀喔哦耶啦]")
+_SYNONYMS = [
+    (re.compile(r"怎麼樣|怎么样|怎樣|怎样"), "如何"),
+    (re.compile(r"甚麼|什麼|什么|啥"), "什麼"),
+    (re.compile(r"請問|请问"), ""),
+]
+_DIGITS = re.compile(r"\d+")
+
+semantic_hits = metrics.counter("semantic_cache_hits_total")
+semantic_misses = metrics.counter("semantic_cache_misses_total")
+semantic_evictions = metrics.counter("semantic_cache_evictions_total")
+semantic_errors = metrics.counter("semantic_cache_errors_total")
+semantic_corrupt = metrics.counter("semantic_cache_corrupt_total")
+semantic_saved_seconds = metrics.counter("semantic_cache_saved_seconds_total")
+semantic_lookup_seconds = metrics.histogram("semantic_cache_lookup_seconds")
+semantic_rebuild_seconds = metrics.histogram("semantic_cache_rebuild_seconds")
+semantic_similarity = metrics.histogram("semantic_cache_hit_similarity")
+
+
+def canonicalize(message: str) -> str:
+    """在exact cache的正規化之上，去除語助詞並統一常見疑問詞"""
+    text = _PARTICLES.sub("", normalize_message(message)).replace(" ", "")
+    for pattern, replacement in _SYNONYMS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def vectorize(text: str, dim: int = SEMANTIC_CACHE_DIM) -> Tuple[np.ndarray, np.ndarray]:
+    """雜湊字元n-gram稀疏向量，回傳(排序後的維度索引, L2正規化權重)"""
+    grams = [text[i:i + n] for n in NGRAM_SIZES for i in range(len(text) - n + 1)] or [text]
+    hashes = np.fromiter((zlib.crc32(gram.encode("utf-8")) for gram in grams), dtype=np.uint32, count=len(grams))
+    buckets, counts = np.unique(hashes % dim, return_counts=True)
+    weights = counts.astype(np.float32)
+    weights /= np.linalg.norm(weights)
+    return buckets.astype(np.int32), weights
+
+
+def namespace_id(
+    provider: str,
+    model: str,
+    system_prompt: str,
+    chat_history: List[dict],
+    message: str,
+    summary: Optional[str] = None
+) -> int:
+    """
+    只有相同命名空間的項目可以互相命中
+
+    包含提供者、模型、系統提示、完整上下文(所有歷史與滾動摘要)的雜湊以及訊息中的數字，
+    避免「3號」與「5號」這類只差數字的問題共用回應。
+    """
+    raw = "\x1f".join([
+        provider,
+        model,
+        system_prompt,
+        history_digest(chat_history, summary),
+        ",".join(_DIGITS.findall(message)),
+    ])
+    return int.from_bytes(hashlib.sha256(raw.encode("utf-8")).digest()[:8], "little", signed=True)
+
+
+class NgramIndex:
+    """
+    記憶體內的稀疏向量倒排索引
+
+    主索引為以維度排序的CSR陣列(indptr/postings/weights)，新增的項目先放在
+    小型的delta字典，累積到一定數量後合併重建；刪除只標記，重建時壓縮。
+    """
+
+    def __init__(self, dim: int = SEMANTIC_CACHE_DIM, max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES):
+        self.dim = dim
+        self.max_entries = max_entries
+        self._keys: List[str] = []
+        self._buckets: List[np.ndarray] = []
+        self._weights: List[np.ndarray] = []
+        self._namespaces = np.zeros(1024, dtype=np.int64)
+        self._expires = np.zeros(1024, dtype=np.float64)
+        self._alive = np.zeros(1024, dtype=bool)
+        self._ids: Dict[str, int] = {}
+        self._live = 0
+        self._oldest = 0
+        # CSR主索引涵蓋 [0, _indexed) 的項目
+        self._indexed = 0
+        self._indptr = np.zeros(dim + 1, dtype=np.int64)
+        self._postings = np.zeros(0, dtype=np.int32)
+        self._posting_weights = np.zeros(0, dtype=np.float32)
+        self._delta: Dict[int, List[Tuple[int, float]]] = {}
+
+    def __len__(self):
+        return self._live
+
+    @property
+    def delta_size(self) -> int:
+        return len(self._keys) - self._indexed
+
+    def _grow(self, size: int):
+        capacity = len(self._alive)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for name in ("_namespaces", "_expires", "_alive"):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def add(self, key: str, text: str, namespace: int, expires_at: float, index_delta: bool = True) -> List[str]:
+        """
+        新增項目，回傳因容量上限被淘汰的鍵
+
+        index_delta: 大量載入時設為False，載入完成後呼叫rebuild一次建立索引
+        """
+        if key in self._ids:
+            self.remove(key)
+        buckets, weights = vectorize(text, self.dim)
+        entry_id = len(self._keys)
+        self._grow(entry_id + 1)
+        self._keys.append(key)
+        self._buckets.append(buckets)
+        self._weights.append(weights)
+        self._namespaces[entry_id] = namespace
+        self._expires[entry_id] = expires_at
+        self._alive[entry_id] = True
+        self._ids[key] = entry_id
+        self._live += 1
+        if index_delta:
+            for bucket, weight in zip(buckets.tolist(), weights.tolist()):
+                self._delta.setdefault(bucket, []).append((entry_id, weight))
+
+        evicted = []
+        while self._live > self.max_entries:
+            while not self._alive[self._oldest]:
+                self._oldest += 1
+            evicted.append(self._keys[self._oldest])
+            self.remove(self._keys[self._oldest])
+        return evicted
+
+    def remove(self, key: str):
+        entry_id = self._ids.pop(key, None)
+        if entry_id is not None and self._alive[entry_id]:
+            self._alive[entry_id] = False
+            self._live -= 1
+
+    def search(self, text: str, namespace: int, threshold: float) -> Optional[Tuple[str, float]]:
+        """
+        回傳相似度最高且不低於門檻的(鍵, 相似度)
+
+        向量皆為單位長度，未共享查詢向量中某組維度的項目，相似度不會超過其餘維度的範數；
+        因此只需展開出現次數最少、且涵蓋足夠權重的幾個維度作為候選，再逐一計算精確相似度。
+        """
+        buckets, weights = vectorize(text, self.dim)
+        query = dict(zip(buckets.tolist(), weights.tolist()))
+        if self._indexed:
+            starts = self._indptr[buckets]
+            ends = self._indptr[buckets + 1]
+        else:
+            starts = ends = np.zeros(len(buckets), dtype=np.int64)
+        delta_lists = [self._delta.get(bucket, ()) for bucket in buckets.tolist()]
+        frequency = (ends - starts) + np.fromiter(map(len, delta_lists), dtype=np.int64, count=len(delta_lists))
+        order = np.argsort(frequency, kind="stable")
+        uncovered = 1.0 - np.cumsum(weights[order] ** 2)
+        prefix = order[:int(np.searchsorted(-uncovered, -(threshold ** 2) + 1e-9)) + 1]
+
+        candidates = set()
+        for position in prefix.tolist():
+            if ends[position] > starts[position]:
+                candidates.update(self._postings[starts[position]:ends[position]].tolist())
+            candidates.update(entry_id for entry_id, _ in delta_lists[position])
+
+        now = time.time()
+        best = None
+        for entry_id in candidates:
+            if not self._alive[entry_id] or self._namespaces[entry_id] != namespace:
+                continue
+            if self._expires[entry_id] <= now:
+                continue
+            score = sum(
+                query.get(bucket, 0.0) * weight
+                for bucket, weight in zip(self._buckets[entry_id].tolist(), self._weights[entry_id].tolist())
+            )
+            if score >= threshold - 1e-6 and (best is None or score > best[1]):
+                best = (entry_id, score)
+        if best is None:
+            return None
+        return self._keys[best[0]], min(1.0, best[1])
+
+    def prepare_rebuild(self):
+        """
+        以目前項目建立新的CSR索引(可在背景執行緒執行)
+
+        只讀取快照時已存在的項目，期間新增的項目由apply_rebuild接上。
+        """
+        snapshot = len(self._keys)
+        now = time.time()
+        keep = np.flatnonzero(self._alive[:snapshot] & (self._expires[:snapshot] > now))
+        keep_list = keep.tolist()
+        if keep_list:
+            lengths = np.fromiter((len(self._buckets[i]) for i in keep_list), dtype=np.int64, count=len(keep_list))
+            all_buckets = np.concatenate([self._buckets[i] for i in keep_list])
+            all_weights = np.concatenate([self._weights[i] for i in keep_list])
+            all_ids = np.repeat(np.arange(len(keep_list), dtype=np.int32), lengths)
+            order = np.argsort(all_buckets, kind="stable")
+            postings = all_ids[order]
+            posting_weights = all_weights[order]
+            counts = np.bincount(all_buckets, minlength=self.dim)
+        else:
+            postings = np.zeros(0, dtype=np.int32)
+            posting_weights = np.zeros(0, dtype=np.float32)
+            counts = np.zeros(self.dim, dtype=np.int64)
+        indptr = np.zeros(self.dim + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        return snapshot, keep, indptr, postings, posting_weights
+
+    def apply_rebuild(self, prepared):
+        """切換到新的索引並重新編號；快照後新增的項目改放delta"""
+        snapshot, keep, indptr, postings, posting_weights = prepared
+        tail = [i for i in range(snapshot, len(self._keys)) if self._alive[i]]
+        order = keep.tolist() + tail
+
+        self._keys = [self._keys[i] for i in order]
+        self._buckets = [self._buckets[i] for i in order]
+        self._weights = [self._weights[i] for i in order]
+        index = np.asarray(order, dtype=np.int64)
+        size = max(1024, len(order) * 2)
+        namespaces = np.zeros(size, dtype=np.int64)
+        expires = np.zeros(size, dtype=np.float64)
+        alive = np.zeros(size, dtype=bool)
+        namespaces[:len(order)] = self._namespaces[index]
+        expires[:len(order)] = self._expires[index]
+        alive[:len(order)] = self._alive[index]
+        self._namespaces, self._expires, self._alive = namespaces, expires, alive
+        self._ids = {key: entry_id for entry_id, key in enumerate(self._keys) if alive[entry_id]}
+        self._live = len(self._ids)
+        self._oldest = 0
+
+        self._indexed = len(keep)
+        self._indptr = indptr
+        self._postings = postings
+        self._posting_weights = posting_weights
+        self._delta = {}
+        for entry_id in range(self._indexed, len(self._keys)):
+            for bucket, weight in zip(self._buckets[entry_id].tolist(), self._weights[entry_id].tolist()):
+                self._delta.setdefault(bucket, []).append((entry_id, weight))
+
+    def rebuild(self):
+        self.apply_rebuild(self.prepare_rebuild())
+
+
+class SemanticCache:
+    """
+    以字元n-gram相似度比對改寫過的相同問題
+
+    索引只存向量與鍵，回應文字保存在Redis hash，服務啟動時由Redis重建索引。
+    重建會重新編號所有項目，同一時間只能有一個重建；載入期間不觸發背景重建，
+    由載入完成時的重建一次建立索引。
+    """
+
+    def __init__(self, enabled: bool = SEMANTIC_CACHE_ENABLED, threshold: float = SEMANTIC_CACHE_THRESHOLD):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.index = NgramIndex()
+        self._rebuilding = False
+        self._loading = False
+        self._rebuild_lock = asyncio.Lock()
+        self._rebuild_task = None
+        metrics.gauge("semantic_cache_entries", lambda: len(self.index))
+        metrics.gauge("semantic_cache_delta_entries", lambda: self.index.delta_size)
+
+    @staticmethod
+    def _entry_key(namespace: int, text: str) -> str:
+        return hashlib.sha1(f"{namespace}:{text}".encode("utf-8")).hexdigest()
+
+    async def get(self, namespace: int, message: str) -> Optional[str]:
+        """查詢近似問題，命中時回傳快取的回應"""
+        if not self.enabled or len(message) > SEMANTIC_CACHE_MAX_MESSAGE_CHARS:
+            return None
+        started = time.perf_counter()
+        match = self.index.search(canonicalize(message), namespace, self.threshold)
+        semantic_lookup_seconds.observe(time.perf_counter() - started)
+        if match is None:
+            semantic_misses.inc()
+            return None
+        key, similarity = match
+        try:
+            raw = await redis_client.hget(REDIS_ENTRIES_KEY, key)
+        except Exception as e:
+            semantic_errors.inc()
+            logger.warning(f"讀取近似問題快取失敗: {e}")
+            return None
+        if raw is None:
+            # 其他副本已淘汰此項目
+            self.index.remove(key)
+            semantic_misses.inc()
+            return None
+        try:
+            entry = json.loads(raw)
+            response = entry["r"]
+        except (ValueError, KeyError, TypeError) as e:
+            await self._discard(key, e)
+            semantic_misses.inc()
+            return None
+        semantic_hits.inc()
+        semantic_similarity.observe(similarity)
+        semantic_saved_seconds.inc(entry.get("l", 0.0))
+        return response
+
+    async def _discard(self, key: str, error: Exception):
+        """無法解析的項目視為未命中，從索引與Redis刪除"""
+        semantic_corrupt.inc()
+        logger.warning(f"近似問題快取內容無法解析，刪除 {key}: {error}")
+        self.index.remove(key)
+        try:
+            await redis_client.hdel(REDIS_ENTRIES_KEY, key)
+        except Exception as e:
+            semantic_errors.inc()
+            logger.warning(f"刪除近似問題快取失敗: {e}")
+
+    async def set(self, namespace: int, message: str, response: str, latency: float):
+        if not self.enabled or not response or len(message) > SEMANTIC_CACHE_MAX_MESSAGE_CHARS:
+            return
+        text = canonicalize(message)
+        key = self._entry_key(namespace, text)
+        expires_at = time.time() + SEMANTIC_CACHE_TTL
+        evicted = self.index.add(key, text, namespace, expires_at)
+        semantic_evictions.inc(len(evicted))
+        entry = json.dumps(
+            {"t": text, "ns": namespace, "r": response, "l": round(latency, 4), "e": round(expires_at, 1)},
+            ensure_ascii=False
+        )
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.hset(REDIS_ENTRIES_KEY, key, entry)
+            if evicted:
+                pipe.hdel(REDIS_ENTRIES_KEY, *evicted)
+            await pipe.execute()
+        except Exception as e:
+            semantic_errors.inc()
+            logger.warning(f"寫入近似問題快取失敗: {e}")
+        self._maybe_rebuild()
+
+    def _maybe_rebuild(self):
+        if self._loading or self._rebuilding or self.index.delta_size < SEMANTIC_CACHE_DELTA_LIMIT:
+            return
+        self._rebuilding = True
+        self._rebuild_task = asyncio.create_task(self._rebuild())
+
+    async def _rebuild(self):
+        started = time.perf_counter()
+        try:
+            # 快照的編號在另一個重建套用後就失效，重建必須依序執行
+            async with self._rebuild_lock:
+                prepared = await asyncio.to_thread(self.index.prepare_rebuild)
+                self.index.apply_rebuild(prepared)
+            semantic_rebuild_seconds.observe(time.perf_counter() - started)
+        except Exception as e:
+            semantic_errors.inc()
+            logger.error(f"重建近似問題索引失敗: {e}")
+        finally:
+            self._rebuilding = False
+
+    async def load(self):
+        """啟動時由Redis重建索引，並清除已過期的項目"""
+        if not self.enabled:
+            return
+        started = time.perf_counter()
+        now = time.time()
+        loaded = 0
+        expired = []
+        self._loading = True
+        try:
+            async for key, raw in redis_client.hscan_iter(REDIS_ENTRIES_KEY, count=LOAD_BATCH_SIZE):
+                try:
+                    entry = json.loads(raw)
+                    text, namespace, expires_at = entry["t"], entry["ns"], entry["e"]
+                except (ValueError, KeyError, TypeError):
+                    # 無法解析的項目與過期項目一起刪除
+                    semantic_corrupt.inc()
+                    expired.append(key)
+                    continue
+                if expires_at <= now:
+                    expired.append(key)
+                    continue
+                evicted = self.index.add(key, text, namespace, expires_at, index_delta=False)
+                expired.extend(evicted)
+                loaded += 1
+                if loaded % LOAD_BATCH_SIZE == 0:
+                    await asyncio.sleep(0)
+            if expired:
+                await redis_client.hdel(REDIS_ENTRIES_KEY, *expired)
+            await self._rebuild()
+            logger.info(f"近似問題快取載入 {loaded} 筆，耗時 {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            semantic_errors.inc()
+            logger.warning(f"載入近似問題快取失敗: {e}")
+        finally:
+            self._loading = False
+
+
+# 所有提供者共用同一個索引，以命名空間區分
+semantic_cache = SemanticCache()
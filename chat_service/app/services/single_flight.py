@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+
+from dotenv import load_dotenv
+
+from app.utils.deadline import remaining
+from app.utils.metrics import metrics
+from app.services.conversation_store import redis_client
+
+# 加載環境變數
+load_dotenv()
+
+# 配置日誌
+logger = logging.getLogger(__name__)
+
+# 相同快取鍵的請求共用同一次LLM呼叫，預設關閉，需明確開啟
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "false").lower() == "true"
+# 領導者鎖的存活時間，需大於一次LLM呼叫的逾時；領導者中斷時鎖會自動過期
+SINGLE_FLIGHT_LOCK_TTL = float(os.getenv("SINGLE_FLIGHT_LOCK_TTL", "35"))
+# 跟隨者等待領導者結果的上限，逾時後自行呼叫
+SINGLE_FLIGHT_WAIT_TIMEOUT = float(os.getenv("SINGLE_FLIGHT_WAIT_TIMEOUT", "30"))
+# 結果保留秒數，讓在領導者完成前後才訂閱的跟隨者仍能取得結果
+SINGLE_FLIGHT_RESULT_TTL = int(os.getenv("SINGLE_FLIGHT_RESULT_TTL", "10"))
+# 失敗標記保留秒數，讓領導者失敗後才訂閱的跟隨者立即自行呼叫，不必等到逾時
+SINGLE_FLIGHT_FAILURE_TTL = int(os.getenv("SINGLE_FLIGHT_FAILURE_TTL", "2"))
+
+KEY_PREFIX = "single_flight:v1:"
+
+# 搶占領導者鎖，成功時清除上一輪留下的結果或失敗標記，避免新的跟隨者讀到舊結果
+# KEYS[1]: 鎖, KEYS[2]: 結果; ARGV[1]: 鎖的token, ARGV[2]: 鎖的存活毫秒數
+ACQUIRE_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    redis.call('DEL', KEYS[2])
+    return 1
+end
+return 0
+"""
+
+# 寫入結果或失敗標記、通知跟隨者並釋放自己持有的鎖，一次往返完成
+# KEYS[1]: 鎖, KEYS[2]: 結果; ARGV[1]: 鎖的token, ARGV[2]: 結果, ARGV[3]: 保留秒數(0表示不保存), ARGV[4]: 頻道
+FINISH_SCRIPT = """
+if tonumber(ARGV[3]) > 0 then
+    redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+end
+redis.call('PUBLISH', ARGV[4], ARGV[2])
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+return 1
+"""
+
+_acquire = redis_client.register_script(ACQUIRE_SCRIPT)
+_finish = redis_client.register_script(FINISH_SCRIPT)
+
+flight_leaders = metrics.counter("single_flight_leaders_total")
+flight_local_followers = metrics.counter("single_flight_followers_local_total")
+flight_remote_followers = metrics.counter("single_flight_followers_remote_total")
+flight_shared = metrics.counter("single_flight_shared_total")
+flight_fallbacks = metrics.counter("single_flight_fallbacks_total")
+flight_propagated = metrics.counter("single_flight_errors_propagated_total")
+flight_errors = metrics.counter("single_flight_errors_total")
+flight_wait = metrics.histogram("single_flight_wait_seconds")
+
+
+class SingleFlight:
+    """
+    合併進行中的相同LLM請求
+
+    同一副本內以Future合併；跨副本以Redis SET NX搶占領導者鎖，其他副本訂閱
+    完成頻道等待結果。鍵與回應快取相同，只有會共用快取的請求才會共用呼叫。
+
+    領導者呼叫失敗時，同副本的跟隨者收到相同的例外，不會同時重試；領導者被取消時
+    由第一個跟隨者接手成為新的領導者，其餘繼續等待。其他副本的跟隨者讀到失敗標記
+    或逾時後，每個副本只由一個請求自行呼叫。
+    """
+
+    def __init__(self, enabled: bool = SINGLE_FLIGHT_ENABLED):
+        self.enabled = enabled
+        self._flights: Dict[str, asyncio.Future] = {}
+        metrics.gauge("single_flight_in_flight", lambda: len(self._flights))
+
+    @staticmethod
+    def _wait_timeout(deadline: Optional[float]) -> float:
+        seconds_left = remaining(deadline)
+        if seconds_left is None:
+            return SINGLE_FLIGHT_WAIT_TIMEOUT
+        return max(0.0, min(SINGLE_FLIGHT_WAIT_TIMEOUT, seconds_left))
+
+    async def do(self, key: str, func: Callable[[], Awaitable[str]], deadline: Optional[float] = None) -> str:
+        """執行func或等待相同鍵進行中的結果"""
+        if not self.enabled:
+            return await func()
+
+        flight = self._flights.get(key)
+        if flight is not None:
+            # 同一副本已有相同請求，Future的結果為(回應, 例外)，被取消時兩者皆為None
+            flight_local_followers.inc()
+            started = time.perf_counter()
+            try:
+                response, error = await asyncio.wait_for(asyncio.shield(flight), self._wait_timeout(deadline))
+            except asyncio.TimeoutError:
+                flight_wait.observe(time.perf_counter() - started)
+                flight_fallbacks.inc()
+                return await func()
+            flight_wait.observe(time.perf_counter() - started)
+            if error is not None:
+                flight_propagated.inc()
+                raise error
+            if response is not None:
+                flight_shared.inc()
+                return response
+            # 領導者被取消：第一個醒來的跟隨者在此同步建立新的Future成為領導者，其餘等待它
+            flight_fallbacks.inc()
+            return await self.do(key, func, deadline)
+
+        flight = self._flights[key] = asyncio.get_running_loop().create_future()
+        outcome = (None, None)
+        try:
+            response = await self._run(key, func, deadline)
+            outcome = (response, None)
+            return response
+        except Exception as e:
+            outcome = (None, e)
+            raise
+        finally:
+            self._flights.pop(key, None)
+            flight.set_result(outcome)
+
+    async def _run(self, key: str, func: Callable[[], Awaitable[str]], deadline: Optional[float]) -> str:
+        """本副本的第一個請求：搶占領導者鎖，搶不到則等待其他副本的結果"""
+        lock_key = f"{KEY_PREFIX}lock:{key}"
+        token = uuid.uuid4().hex
+        try:
+            acquired = await _acquire(
+                keys=[lock_key, f"{KEY_PREFIX}result:{key}"],
+                args=[token, int(SINGLE_FLIGHT_LOCK_TTL * 1000)]
+            )
+        except Exception as e:
+            flight_errors.inc()
+            logger.warning(f"搶占合併請求鎖失敗，直接呼叫: {e}")
+            return await func()
+
+        if not acquired:
+            flight_remote_followers.inc()
+            response = await self._wait_remote(key, deadline)
+            if response is not None:
+                flight_shared.inc()
+                return response
+            flight_fallbacks.inc()
+            return await func()
+
+        flight_leaders.inc()
+        response = None
+        try:
+            response = await func()
+            return response
+        finally:
+            # 失敗或被取消時也通知跟隨者並留下失敗標記，讓他們立即自行呼叫
+            await self._publish(key, lock_key, token, response)
+
+    async def _publish(self, key: str, lock_key: str, token: str, response: Optional[str]):
+        payload = json.dumps({"ok": response is not None, "response": response}, ensure_ascii=False)
+        try:
+            await _finish(
+                keys=[lock_key, f"{KEY_PREFIX}result:{key}"],
+                args=[
+                    token, payload,
+                    SINGLE_FLIGHT_RESULT_TTL if response is not None else SINGLE_FLIGHT_FAILURE_TTL,
+                    f"{KEY_PREFIX}done:{key}"
+                ]
+            )
+        except Exception as e:
+            flight_errors.inc()
+            logger.warning(f"通知合併請求結果失敗: {e}")
+
+    async def _wait_remote(self, key: str, deadline: Optional[float]) -> Optional[str]:
+        """等待其他副本的領導者，失敗或逾時回傳None"""
+        started = time.perf_counter()
+        wait_until = time.monotonic() + self._wait_timeout(deadline)
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(f"{KEY_PREFIX}done:{key}")
+            # 訂閱前領導者可能已完成或失敗
+            raw = await redis_client.get(f"{KEY_PREFIX}result:{key}")
+            while raw is None:
+                timeout = wait_until - time.monotonic()
+                if timeout <= 0:
+                    return None
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
+                if message is not None and message["type"] == "message":
+                    raw = message["data"]
+            result = json.loads(raw)
+            return result["response"] if result.get("ok") else None
+        except Exception as e:
+            flight_errors.inc()
+            logger.warning(f"等待合併請求結果失敗: {e}")
+            return None
+        finally:
+            flight_wait.observe(time.perf_counter() - started)
+            try:
+                await pubsub.close()
+            except Exception:
+                pass
+
+
+# 所有提供者共用，鍵已包含提供者與模型
+single_flight = SingleFlight()
@@ -0,0 +1,97 @@
+import time
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Optional, TypeVar
+
+from app.utils.metrics import metrics
+
+# 配置日誌
+logger = logging.getLogger(__name__)
+
+# 閘道傳入的絕對截止時間(Unix時間，秒)
+DEADLINE_HEADER = "X-Request-Deadline"
+
+T = TypeVar("T")
+
+shed_before_start = metrics.counter("deadline_shed_before_start_total")
+shed_in_flight = metrics.counter("deadline_shed_in_flight_total")
+
+
+class DeadlineExceeded(Exception):
+    """請求已超過截止時間，結果無法送達用戶"""
+
+
+def parse_deadline(value: Optional[str]) -> Optional[float]:
+    """解析截止時間標頭，格式錯誤時視為沒有截止時間"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        logger.warning(f"無效的截止時間標頭: {value}")
+        return None
+
+
+def remaining(deadline: Optional[float]) -> Optional[float]:
+    """距離截止時間的秒數，沒有截止時間時回傳None"""
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def is_expired(deadline: Optional[float]) -> bool:
+    return deadline is not None and time.time() >= deadline
+
+
+def check_deadline(deadline: Optional[float], in_flight: bool = False):
+    """
+    檢查截止時間，已過期則放棄
+
+    in_flight: 為True表示工作已開始(例如LLM已回應但尚未寫入)，分開計數
+    """
+    if is_expired(deadline):
+        if in_flight:
+            shed_in_flight.inc()
+            raise DeadlineExceeded("處理中超過截止時間，放棄後續工作")
+        shed_before_start.inc()
+        raise DeadlineExceeded("截止時間已過，略過處理")
+
+
+async def run_with_deadline(awaitable: Awaitable[T], deadline: Optional[float]) -> T:
+    """在截止時間前執行，逾時則取消進行中的工作"""
+    if deadline is None:
+        return await awaitable
+    seconds = remaining(deadline)
+    if seconds <= 0:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        shed_before_start.inc()
+        raise DeadlineExceeded("截止時間已過，略過處理")
+    try:
+        return await asyncio.wait_for(awaitable, timeout=seconds)
+    except asyncio.TimeoutError:
+        shed_in_flight.inc()
+        raise DeadlineExceeded("處理中超過截止時間，已取消")
+
+
+async def iterate_with_deadline(iterator: AsyncIterator[T], deadline: Optional[float]) -> AsyncIterator[T]:
+    """逐項取出非同步迭代器的內容，截止時間到時停止並關閉來源"""
+    try:
+        while True:
+            seconds = remaining(deadline)
+            if seconds is not None and seconds <= 0:
+                shed_in_flight.inc()
+                raise DeadlineExceeded("串流中超過截止時間，已停止")
+            try:
+                if seconds is None:
+                    item = await iterator.__anext__()
+                else:
+                    item = await asyncio.wait_for(iterator.__anext__(), timeout=seconds)
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                shed_in_flight.inc()
+                raise DeadlineExceeded("串流中超過截止時間，已停止")
+            yield item
+    finally:
+        await iterator.aclose()
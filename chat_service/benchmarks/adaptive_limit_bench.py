@@ -0,0 +1,121 @@
+"""
+提供者限流下的自適應並行上限壓測
+
+以子程序啟動會回應429的模擬OpenAI伺服器，固定數量的用戶端不斷呼叫
+OpenAIService.create_completion；執行中透過 /control 調整模擬伺服器的並行上限
+(例如 60 -> 20 -> 60，模擬離峰與尖峰的配額)，比較固定上限與AIMD上限的
+成功數、429次數、延遲，以及並行上限隨時間的變化。
+
+執行方式 (於 chat_service 目錄):
+    python -m benchmarks.adaptive_limit_bench --clients 150 --capacities 60,20,60 --phase-seconds 10
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import subprocess
+
+import httpx
+
+from benchmarks.openai_concurrency_bench import _free_port, _wait_ready, percentile
+
+
+async def run_mode(mode: str, args, control_url: str):
+    from app.services import openai_service
+    from app.services.adaptive_limiter import AdaptiveLimiter, ProviderOverloaded
+
+    # 每種模式使用新的限制器，固定模式直接使用最大並行數
+    limiter = AdaptiveLimiter("openai", args.max_limit, enabled=(mode == "adaptive"))
+    openai_service.openai_limiter = limiter
+
+    phases = [int(capacity) for capacity in args.capacities.split(",")]
+    results = [{"ok": 0, "overloaded": 0, "errors": 0, "latencies": []} for _ in phases]
+    trajectory = []
+    phase = 0
+    stop = asyncio.Event()
+
+    async def client(index):
+        while not stop.is_set():
+            current = results[phase]
+            started = time.perf_counter()
+            try:
+                await openai_service.OpenAIService.create_completion([
+                    {"role": "user", "content": f"用戶端 {index}"},
+                ])
+                current["ok"] += 1
+                current["latencies"].append(time.perf_counter() - started)
+            except ProviderOverloaded:
+                current["overloaded"] += 1
+            except Exception:
+                current["errors"] += 1
+
+    async def sample():
+        while not stop.is_set():
+            trajectory.append((phase, int(limiter.limit)))
+            await asyncio.sleep(args.phase_seconds / 10)
+
+    async with httpx.AsyncClient() as control:
+        await control.post(control_url, json={"max_concurrency": phases[0]})
+        tasks = [asyncio.create_task(client(i)) for i in range(args.clients)]
+        sampler = asyncio.create_task(sample())
+        for index, capacity in enumerate(phases):
+            phase = index
+            await control.post(control_url, json={"max_concurrency": capacity})
+            await asyncio.sleep(args.phase_seconds)
+        stop.set()
+        await asyncio.gather(*tasks, sampler)
+
+    print(f"\n== {mode}")
+    for index, (capacity, result) in enumerate(zip(phases, results)):
+        latencies = result["latencies"]
+        limits = [limit for sample_phase, limit in trajectory if sample_phase == index]
+        print(
+            f"phase {index} capacity={capacity}: ok={result['ok']} "
+            f"({result['ok'] / args.phase_seconds:.1f}/s) 429={result['overloaded']} errors={result['errors']} "
+            f"p50={percentile(latencies, 0.5) * 1000:.0f}ms p95={percentile(latencies, 0.95) * 1000:.0f}ms "
+            f"limit={limits[:1] + limits[-1:]}"
+        )
+
+
+async def run(args, control_url: str):
+    from app.services.openai_service import OpenAIService
+
+    for mode in args.modes.split(","):
+        await run_mode(mode, args, control_url)
+        # 等待上一輪的retry-after結束
+        await asyncio.sleep(1)
+    await OpenAIService.aclose()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Adaptive concurrency limit benchmark")
+    arg_parser.add_argument("--clients", type=int, default=150)
+    arg_parser.add_argument("--capacities", default="60,20,60", help="各階段模擬伺服器的並行上限")
+    arg_parser.add_argument("--phase-seconds", type=float, default=10)
+    arg_parser.add_argument("--latency-ms", type=float, default=500)
+    arg_parser.add_argument("--max-limit", type=int, default=200, help="OPENAI_MAX_CONCURRENCY")
+    arg_parser.add_argument("--modes", default="static,adaptive")
+    args = arg_parser.parse_args()
+
+    port = _free_port()
+    mock = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.mock_openai", "--port", str(port), "--latency-ms", str(args.latency_ms)],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+    try:
+        _wait_ready(f"http://127.0.0.1:{port}/stats")
+        os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{port}/v1"
+        os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+        # 由限制器處理429，不使用SDK的自動重試
+        os.environ["OPENAI_MAX_RETRIES"] = "0"
+        os.environ["OPENAI_MAX_CONNECTIONS"] = str(args.max_limit)
+        asyncio.run(run(args, f"http://127.0.0.1:{port}/control"))
+        print(f"\nmock server: {httpx.get(f'http://127.0.0.1:{port}/stats').json()}")
+    finally:
+        mock.terminate()
+        mock.wait(timeout=10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+相容OpenAI Chat Completions API的本機模擬伺服器
+
+啟動方式 (於 chat_service 目錄):
+    python -m benchmarks.mock_openai --port 9300 --latency-ms 800
+
+模擬提供者限流(超過時回應429與retry-after):
+    python -m benchmarks.mock_openai --max-concurrency 30 --rate-limit 50
+
+執行中可調整限制，例如模擬尖峰時段配額下降:
+    curl -X POST http://127.0.0.1:9300/control -H 'Content-Type: application/json' \
+        -d '{"max_concurrency": 10}'
+
+chat_service設定:
+    OPENAI_BASE_URL=http://127.0.0.1:9300/v1
+"""
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# 模擬延遲(毫秒)與抖動比例
+MOCK_OPENAI_LATENCY_MS = float(os.getenv("MOCK_OPENAI_LATENCY_MS", "800"))
+MOCK_OPENAI_JITTER = float(os.getenv("MOCK_OPENAI_JITTER", "0.2"))
+# 串流模式：第一段的延遲比例與之後每段的間隔(毫秒)
+MOCK_OPENAI_TTFT_RATIO = float(os.getenv("MOCK_OPENAI_TTFT_RATIO", "0.2"))
+MOCK_OPENAI_CHUNK_INTERVAL_MS = float(os.getenv("MOCK_OPENAI_CHUNK_INTERVAL_MS", "20"))
+# 限流：同時處理的請求數與每秒請求數上限，0表示不限制
+MOCK_OPENAI_MAX_CONCURRENCY = int(os.getenv("MOCK_OPENAI_MAX_CONCURRENCY", "0"))
+MOCK_OPENAI_RATE_LIMIT = float(os.getenv("MOCK_OPENAI_RATE_LIMIT", "0"))
+# 429回應是否附上retry-after標頭
+MOCK_OPENAI_RETRY_AFTER = os.getenv("MOCK_OPENAI_RETRY_AFTER", "true").lower() == "true"
+# 超過此並行數後，每多一個請求增加的延遲(毫秒)，模擬過載時延遲上升
+MOCK_OPENAI_CONGESTION_KNEE = int(os.getenv("MOCK_OPENAI_CONGESTION_KNEE", "0"))
+MOCK_OPENAI_CONGESTION_MS = float(os.getenv("MOCK_OPENAI_CONGESTION_MS", "0"))
+
+app = FastAPI(title="Mock OpenAI API")
+app.state.stats = {"requests": 0, "in_flight": 0, "max_in_flight": 0, "rate_limited": 0}
+app.state.limits = {
+    "max_concurrency": MOCK_OPENAI_MAX_CONCURRENCY,
+    "rate_limit": MOCK_OPENAI_RATE_LIMIT,
+    "retry_after": MOCK_OPENAI_RETRY_AFTER,
+    "congestion_knee": MOCK_OPENAI_CONGESTION_KNEE,
+    "congestion_ms": MOCK_OPENAI_CONGESTION_MS,
+}
+# 每秒請求數的令牌桶，容量為一秒的配額
+app.state.bucket = {"tokens": MOCK_OPENAI_RATE_LIMIT, "updated_at": time.monotonic()}
+
+
+def _rate_limited(retry_after: float) -> JSONResponse:
+    """與OpenAI相同格式的429回應"""
+    app.state.stats["rate_limited"] += 1
+    headers = {}
+    if app.state.limits["retry_after"]:
+        headers["retry-after"] = f"{retry_after:.3f}"
+        headers["retry-after-ms"] = str(int(retry_after * 1000))
+    return JSONResponse(
+        status_code=429,
+        headers=headers,
+        content={"error": {
+            "message": "Rate limit reached for requests",
+            "type": "requests",
+            "param": None,
+            "code": "rate_limit_exceeded",
+        }}
+    )
+
+
+def _admit():
+    """依目前的限制決定是否受理，超過時回傳429回應"""
+    limits = app.state.limits
+    if limits["max_concurrency"] and app.state.stats["in_flight"] >= limits["max_concurrency"]:
+        return _rate_limited(MOCK_OPENAI_LATENCY_MS / 1000)
+    rate = limits["rate_limit"]
+    if rate:
+        bucket = app.state.bucket
+        now = time.monotonic()
+        bucket["tokens"] = min(rate, bucket["tokens"] + (now - bucket["updated_at"]) * rate)
+        bucket["updated_at"] = now
+        if bucket["tokens"] < 1:
+            return _rate_limited((1 - bucket["tokens"]) / rate)
+        bucket["tokens"] -= 1
+    return None
+
+
+def _latency_ms() -> float:
+    """基本延遲加上抖動，超過壅塞門檻後隨並行數增加"""
+    limits = app.state.limits
+    jitter = random.uniform(1 - MOCK_OPENAI_JITTER, 1 + MOCK_OPENAI_JITTER)
+    congestion = 0.0
+    if limits["congestion_knee"]:
+        congestion = max(0, app.state.stats["in_flight"] - limits["congestion_knee"]) * limits["congestion_ms"]
+    return MOCK_OPENAI_LATENCY_MS * jitter + congestion
+
+
+def _completion(model: str, content: str) -> dict:
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": 0, "completion_tokens": len(content), "total_tokens": len(content)},
+    }
+
+
+def _chunk(completion_id: str, model: str, delta: dict, finish_reason=None) -> str:
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+
+async def _stream(payload: dict):
+    stats = app.state.stats
+    stats["requests"] += 1
+    stats["in_flight"] += 1
+    stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+    try:
+        model = payload.get("model", "mock")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        await asyncio.sleep(_latency_ms() * MOCK_OPENAI_TTFT_RATIO / 1000)
+        yield _chunk(completion_id, model, {"role": "assistant", "content": ""})
+        last_message = payload["messages"][-1]["content"]
+        for piece in ["模擬", "回應", ": ", last_message[:50]]:
+            yield _chunk(completion_id, model, {"content": piece})
+            await asyncio.sleep(MOCK_OPENAI_CHUNK_INTERVAL_MS / 1000)
+        yield _chunk(completion_id, model, {}, "stop")
+        yield "data: [DONE]\n\n"
+    finally:
+        stats["in_flight"] -= 1
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    payload = await request.json()
+    rejected = _admit()
+    if rejected is not None:
+        return rejected
+    if payload.get("stream"):
+        return StreamingResponse(_stream(payload), media_type="text/event-stream")
+    stats = app.state.stats
+    stats["requests"] += 1
+    stats["in_flight"] += 1
+    stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+    try:
+        await asyncio.sleep(_latency_ms() / 1000)
+        last_message = payload["messages"][-1]["content"]
+        return _completion(payload.get("model", "mock"), f"模擬回應: {last_message[:50]}")
+    finally:
+        stats["in_flight"] -= 1
+
+
+@app.get("/stats")
+async def stats():
+    return app.state.stats
+
+
+@app.post("/control")
+async def control(request: Request):
+    """執行中調整限流設定，回傳調整後的設定"""
+    updates = await request.json()
+    for key, value in updates.items():
+        if key in app.state.limits:
+            app.state.limits[key] = value
+    return app.state.limits
+
+
+def main():
+    global MOCK_OPENAI_LATENCY_MS
+
+    arg_parser = argparse.ArgumentParser(description="Mock OpenAI-compatible server")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=9300)
+    arg_parser.add_argument("--latency-ms", type=float, default=MOCK_OPENAI_LATENCY_MS)
+    arg_parser.add_argument("--max-concurrency", type=int, default=MOCK_OPENAI_MAX_CONCURRENCY, help="超過時回應429")
+    arg_parser.add_argument("--rate-limit", type=float, default=MOCK_OPENAI_RATE_LIMIT, help="每秒請求數上限")
+    arg_parser.add_argument("--no-retry-after", action="store_true", help="429回應不附retry-after")
+    args = arg_parser.parse_args()
+
+    MOCK_OPENAI_LATENCY_MS = args.latency_ms
+    app.state.limits.update(
+        max_concurrency=args.max_concurrency,
+        rate_limit=args.rate_limit,
+        retry_after=not args.no_retry_after
+    )
+    app.state.bucket["tokens"] = args.rate_limit
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+OpenAI非同步路徑的並行壓測
+
+以子程序啟動模擬OpenAI伺服器，讓單一chat_service程序同時處理大量對話，
+回報吞吐量、延遲、伺服器端觀察到的最大並行數，以及事件迴圈的最大延遲
+(用來確認呼叫不會阻塞事件迴圈)。
+
+執行方式 (於 chat_service 目錄):
+    python -m benchmarks.openai_concurrency_bench --conversations 500 --latency-ms 800
+"""
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import subprocess
+
+import httpx
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_ready(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"服務未就緒: {url}")
+
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))]
+
+
+async def measure_loop_lag(stop: asyncio.Event, interval: float = 0.01) -> float:
+    """定期喚醒並記錄最大延遲，事件迴圈被阻塞時延遲會明顯上升"""
+    worst = 0.0
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - started - interval)
+    return worst
+
+
+async def run(conversations: int):
+    from app.services.openai_service import OpenAIService
+
+    latencies = []
+    errors = 0
+
+    async def one(index):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            await OpenAIService.create_completion([
+                {"role": "system", "content": "benchmark"},
+                {"role": "user", "content": f"第 {index} 個對話"},
+            ])
+            latencies.append(time.perf_counter() - started)
+        except Exception:
+            errors += 1
+
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_loop_lag(stop))
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(conversations)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    loop_lag = await lag_task
+    await OpenAIService.aclose()
+
+    print(
+        f"conversations={conversations} errors={errors} elapsed={elapsed:.2f}s "
+        f"throughput={conversations / elapsed:.1f}/s"
+    )
+    print(
+        f"latency p50={percentile(latencies, 0.5) * 1000:.1f}ms "
+        f"p95={percentile(latencies, 0.95) * 1000:.1f}ms "
+        f"p99={percentile(latencies, 0.99) * 1000:.1f}ms  "
+        f"max event-loop lag={loop_lag * 1000:.1f}ms"
+    )
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Async OpenAI path concurrency benchmark")
+    arg_parser.add_argument("--conversations", type=int, default=500)
+    arg_parser.add_argument("--latency-ms", type=float, default=800)
+    arg_parser.add_argument("--max-concurrency", type=int, default=None, help="覆寫OPENAI_MAX_CONCURRENCY")
+    args = arg_parser.parse_args()
+
+    port = _free_port()
+    mock = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.mock_openai", "--port", str(port), "--latency-ms", str(args.latency_ms)],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+    try:
+        _wait_ready(f"http://127.0.0.1:{port}/stats")
+        os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{port}/v1"
+        os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+        if args.max_concurrency:
+            os.environ["OPENAI_MAX_CONCURRENCY"] = str(args.max_concurrency)
+            os.environ["OPENAI_MAX_CONNECTIONS"] = str(args.max_concurrency)
+        asyncio.run(run(args.conversations))
+        print(f"mock server: {httpx.get(f'http://127.0.0.1:{port}/stats').json()}")
+    finally:
+        mock.terminate()
+        mock.wait(timeout=10)
+
+
+if __name__ == "__main__":
+    main()
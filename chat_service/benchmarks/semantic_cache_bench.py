@@ -0,0 +1,119 @@
+"""
+近似問題快取索引的查詢延遲壓測
+
+建立含大量合成問題的NgramIndex，量測命中(改寫過的問題)與未命中查詢的延遲，
+並確認索引重建時間與記憶體用量。不需要Redis。
+
+執行方式 (於 chat_service 目錄):
+    python -m benchmarks.semantic_cache_bench --entries 100000 --queries 5000
+"""
+import time
+import random
+import argparse
+import tracemalloc
+
+from app.services.semantic_cache import NgramIndex, canonicalize
+
+# 常用字範圍內隨機取樣，模擬中文問句
+COMMON_CHARS = [chr(code) for code in range(0x4E00, 0x4E00 + 3000)]
+PREFIXES = ["請問", "", "想知道", "可以告訴我"]
+SUFFIXES = ["如何", "怎麼樣", "是什麼", "嗎", "呢"]
+
+
+def make_question(rng: random.Random) -> str:
+    body = "".join(rng.choice(COMMON_CHARS) for _ in range(rng.randint(6, 18)))
+    return f"{rng.choice(PREFIXES)}{body}{rng.choice(SUFFIXES)}"
+
+
+def paraphrase(question: str, rng: random.Random) -> str:
+    """加入語助詞與替換疑問詞，模擬同一個問題的不同問法"""
+    text = question.replace("怎麼樣", "如何") if rng.random() < 0.5 else question.replace("如何", "怎樣")
+    position = rng.randint(1, len(text) - 1)
+    return f"{text[:position]}的{text[position:]}？"
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))]
+
+
+def report(name, samples, hits):
+    print(
+        f"{name:<10} n={len(samples)} hit_rate={hits / len(samples):.3f} "
+        f"p50={percentile(samples, 0.5) * 1e6:.0f}us p95={percentile(samples, 0.95) * 1e6:.0f}us "
+        f"p99={percentile(samples, 0.99) * 1e6:.0f}us max={max(samples) * 1e6:.0f}us"
+    )
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Semantic cache index benchmark")
+    arg_parser.add_argument("--entries", type=int, default=100000)
+    arg_parser.add_argument("--queries", type=int, default=5000)
+    arg_parser.add_argument("--namespaces", type=int, default=4)
+    arg_parser.add_argument("--threshold", type=float, default=0.9)
+    arg_parser.add_argument("--seed", type=int, default=7)
+    args = arg_parser.parse_args()
+
+    rng = random.Random(args.seed)
+    questions = [make_question(rng) for _ in range(args.entries)]
+    namespaces = [rng.randrange(args.namespaces) for _ in range(args.entries)]
+    expires_at = time.time() + 3600
+
+    index = NgramIndex(max_entries=args.entries)
+    started = time.perf_counter()
+    for i, (question, namespace) in enumerate(zip(questions, namespaces)):
+        index.add(f"k{i}", canonicalize(question), namespace, expires_at, index_delta=False)
+    load_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    index.rebuild()
+    rebuild_seconds = time.perf_counter() - started
+
+    # 以相同資料另建一份索引量測記憶體，避免tracemalloc影響上面的計時
+    tracemalloc.start()
+    measured = NgramIndex(max_entries=args.entries)
+    for i, (question, namespace) in enumerate(zip(questions, namespaces)):
+        measured.add(f"k{i}", canonicalize(question), namespace, expires_at, index_delta=False)
+    measured.rebuild()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del measured
+    print(
+        f"entries={len(index)} vectorize+add={load_seconds:.2f}s rebuild={rebuild_seconds:.2f}s "
+        f"memory={current / 2 ** 20:.1f}MB peak={peak / 2 ** 20:.1f}MB"
+    )
+
+    # 命中: 改寫過的既有問題
+    latencies, hits = [], 0
+    for _ in range(args.queries):
+        i = rng.randrange(args.entries)
+        query = canonicalize(paraphrase(questions[i], rng))
+        started = time.perf_counter()
+        match = index.search(query, namespaces[i], args.threshold)
+        latencies.append(time.perf_counter() - started)
+        hits += match is not None and match[0] == f"k{i}"
+    report("paraphrase", latencies, hits)
+
+    # 未命中: 全新的問題
+    latencies, hits = [], 0
+    for _ in range(args.queries):
+        query = canonicalize(make_question(rng))
+        started = time.perf_counter()
+        match = index.search(query, rng.randrange(args.namespaces), args.threshold)
+        latencies.append(time.perf_counter() - started)
+        hits += match is not None
+    report("novel", latencies, hits)
+
+    # delta中尚未合併的新項目也要能查到
+    for i in range(2000):
+        index.add(f"d{i}", canonicalize(make_question(rng)), 0, expires_at)
+    latencies = []
+    for _ in range(args.queries):
+        query = canonicalize(make_question(rng))
+        started = time.perf_counter()
+        index.search(query, 0, args.threshold)
+        latencies.append(time.perf_counter() - started)
+    report("with-delta", latencies, 0)
+
+
+if __name__ == "__main__":
+    main()
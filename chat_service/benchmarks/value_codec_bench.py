@@ -0,0 +1,154 @@
+"""
+Redis值編碼的大小與編解碼成本壓測
+
+以合成的中文對話(每位用戶CHAT_HISTORY_MAX_TURNS輪)與圖片分析結果，比較舊版JSON、
+msgpack、msgpack+zstd的每個值/每個鍵位元組數，以及編碼與解碼耗時。
+指定 --redis-host 時另外寫入Redis，以MEMORY USAGE量測每個鍵實際佔用的記憶體。
+
+執行方式 (於 chat_service 目錄):
+    python -m benchmarks.value_codec_bench --users 2000
+    python -m benchmarks.value_codec_bench --users 2000 --redis-host localhost
+"""
+import json
+import time
+import random
+import argparse
+
+from app.utils.value_codec import ValueCodec
+
+# 以常用詞組成句子，重複程度接近真實的中文回應
+WORDS = [
+    "我們", "可以", "這個", "問題", "如果", "您", "需要", "建議", "首先", "其次", "另外", "最後",
+    "方法", "步驟", "注意", "時間", "資料", "設定", "使用", "系統", "功能", "情況", "例如", "因為",
+    "所以", "但是", "以及", "或者", "相關", "內容", "圖片", "顏色", "背景", "人物", "表情", "左邊",
+    "右邊", "中間", "看起來", "應該", "非常", "比較", "簡單", "重要", "健康", "飲食", "運動", "睡眠",
+    "工作", "學習", "旅行", "天氣", "價格", "效果", "影響", "原因", "結果", "說明", "一些", "其他",
+]
+PUNCTUATION = ["，", "，", "。", "、", "；"]
+
+
+def make_text(rng: random.Random, min_chars: int, max_chars: int) -> str:
+    target = rng.randint(min_chars, max_chars)
+    parts = []
+    length = 0
+    while length < target:
+        word = rng.choice(WORDS)
+        parts.append(word)
+        length += len(word)
+        if rng.random() < 0.15:
+            parts.append(rng.choice(PUNCTUATION))
+            length += 1
+    return "".join(parts) + "。"
+
+
+def make_history(rng: random.Random, turns: int):
+    return [
+        {"user": make_text(rng, 6, 40), "assistant": make_text(rng, 60, 600)}
+        for _ in range(turns)
+    ]
+
+
+def make_image_result(rng: random.Random):
+    return {"analysis": make_text(rng, 150, 900), "model": "gemini-pro-vision"}
+
+
+class LegacyJson:
+    """改版前的寫法：對話使用ensure_ascii=False，圖片結果使用預設的ensure_ascii=True"""
+
+    def __init__(self, ensure_ascii: bool):
+        self.ensure_ascii = ensure_ascii
+
+    def encode(self, value):
+        return json.dumps(value, ensure_ascii=self.ensure_ascii).encode("utf-8")
+
+    def decode(self, raw):
+        return json.loads(raw)
+
+
+def measure(codec, values):
+    """回傳(總位元組數, 每個值的編碼微秒, 每個值的解碼微秒, 編碼後的值)"""
+    started = time.perf_counter()
+    encoded = [codec.encode(value) for value in values]
+    encode_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    for raw in encoded:
+        codec.decode(raw)
+    decode_seconds = time.perf_counter() - started
+    count = len(values)
+    return sum(len(raw) for raw in encoded), encode_seconds / count * 1e6, decode_seconds / count * 1e6, encoded
+
+
+def redis_memory(client, prefix: str, groups, as_list: bool) -> float:
+    """寫入Redis後以MEMORY USAGE量測每個鍵的平均位元組數"""
+    pipe = client.pipeline(transaction=False)
+    for index, group in enumerate(groups):
+        key = f"{prefix}{index}"
+        pipe.delete(key)
+        if as_list:
+            pipe.rpush(key, *group)
+        else:
+            pipe.set(key, group)
+    pipe.execute()
+    pipe = client.pipeline(transaction=False)
+    for index in range(len(groups)):
+        pipe.memory_usage(f"{prefix}{index}", samples=0)
+    usages = pipe.execute()
+    client.delete(*[f"{prefix}{index}" for index in range(len(groups))])
+    return sum(usages) / len(usages)
+
+
+def run(name, codecs, groups, as_list, client):
+    print(f"\n== {name}")
+    values = [value for group in groups for value in group] if as_list else groups
+    baseline = None
+    for label, codec in codecs:
+        total, encode_us, decode_us, encoded = measure(codec, values)
+        if baseline is None:
+            baseline = total
+        line = (
+            f"{label:<14} bytes/value={total / len(values):7.0f} bytes/key={total / len(groups):8.0f} "
+            f"({total / baseline:5.1%}) encode={encode_us:6.1f}us decode={decode_us:6.1f}us"
+        )
+        if client is not None:
+            if as_list:
+                per_key = len(groups[0])
+                stored = [encoded[i:i + per_key] for i in range(0, len(encoded), per_key)]
+            else:
+                stored = encoded
+            line += f" redis_memory/key={redis_memory(client, f'value_codec_bench:{label}:', stored, as_list):8.0f}"
+        print(line)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Redis value codec benchmark")
+    arg_parser.add_argument("--users", type=int, default=2000)
+    arg_parser.add_argument("--turns", type=int, default=10)
+    arg_parser.add_argument("--compress-min-bytes", type=int, default=512)
+    arg_parser.add_argument("--level", type=int, default=3)
+    arg_parser.add_argument("--redis-host", default=None)
+    arg_parser.add_argument("--redis-port", type=int, default=6379)
+    arg_parser.add_argument("--seed", type=int, default=7)
+    args = arg_parser.parse_args()
+
+    client = None
+    if args.redis_host:
+        import redis
+        client = redis.Redis(host=args.redis_host, port=args.redis_port)
+
+    rng = random.Random(args.seed)
+    histories = [make_history(rng, args.turns) for _ in range(args.users)]
+    image_results = [make_image_result(rng) for _ in range(args.users)]
+
+    def codecs(legacy_ascii: bool):
+        return [
+            ("json", LegacyJson(legacy_ascii)),
+            ("msgpack", ValueCodec("bench_msgpack", compress_min_bytes=0)),
+            ("msgpack+zstd", ValueCodec("bench_zstd", compress_min_bytes=args.compress_min_bytes, level=args.level)),
+        ]
+
+    run(f"conversation history ({args.turns} turns/key, list element per turn)", codecs(False), histories, True, client)
+    run("image analysis result (one value per key)", codecs(True), image_results, False, client)
+
+
+if __name__ == "__main__":
+    main()
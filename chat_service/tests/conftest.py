@@ -0,0 +1,8 @@
+import os
+import tempfile
+
+# 測試使用本機SQLite與不存在的Redis，不連線到容器內的服務
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.gettempdir(), "chat_service_test.log"))
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.gettempdir(), "chat_service_test.db"))
+os.environ.setdefault("REDIS_HOST", "127.0.0.1")
+os.environ.setdefault("REDIS_PORT", "1")
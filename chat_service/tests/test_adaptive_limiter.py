@@ -0,0 +1,231 @@
+import asyncio
+import time
+
+import httpx
+import openai
+import pytest
+from google.api_core import exceptions as google_exceptions
+from google.protobuf import duration_pb2
+from google.rpc import error_details_pb2
+
+from app.services import adaptive_limiter
+from app.services.adaptive_limiter import AdaptiveLimiter, ProviderOverloaded, as_overload
+from app.utils.metrics import metrics
+
+
+def openai_error(error_class, status, headers=None):
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    response = httpx.Response(status, headers=headers or {}, request=request)
+    return error_class("error", response=response, body=None)
+
+
+class FakeProvider:
+    """模擬提供者：同時進行的請求超過capacity時回應429"""
+
+    def __init__(self, capacity, retry_after=None, latency=0.005):
+        self.capacity = capacity
+        self.retry_after = retry_after
+        self.latency = latency
+        self.in_flight = 0
+        self.peak = 0
+        self.rejected = 0
+
+    async def __call__(self):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+            if self.in_flight > self.capacity:
+                self.rejected += 1
+                headers = {"retry-after": str(self.retry_after)} if self.retry_after is not None else None
+                raise openai_error(openai.RateLimitError, 429, headers)
+            return "ok"
+        finally:
+            self.in_flight -= 1
+
+
+async def call(limiter, provider, deadline=None):
+    """與openai_service.create_completion相同的取得/歸還流程"""
+    await limiter.acquire(deadline)
+    started = time.perf_counter()
+    latency = None
+    error = None
+    try:
+        await provider()
+        latency = time.perf_counter() - started
+    except Exception as e:
+        error = as_overload("fake", e)
+        raise (error or e)
+    finally:
+        limiter.release(success=latency is not None, latency=latency, error=error)
+
+
+@pytest.fixture(autouse=True)
+def no_cooldown(monkeypatch):
+    monkeypatch.setattr(adaptive_limiter, "ADAPTIVE_LIMIT_COOLDOWN", 0.0)
+    monkeypatch.setattr(adaptive_limiter, "ADAPTIVE_LIMIT_DEFAULT_BACKOFF", 0.0)
+
+
+def test_limit_grows_additively_while_saturated():
+    limiter = AdaptiveLimiter("test_increase", max_limit=10, initial=4, min_limit=1, enabled=True)
+
+    async def scenario():
+        for _ in range(4):
+            await limiter.acquire()
+        # 維持用滿上限時，一輪(約等於上限數量)成功呼叫約增加1
+        for _ in range(4):
+            limiter.release(success=True)
+            await limiter.acquire()
+
+    asyncio.run(scenario())
+    assert 4.9 < limiter.limit < 5.1
+    assert metrics.snapshot()["test_increase_concurrency_limit"] == 4
+
+
+def test_limit_does_not_grow_when_underused():
+    limiter = AdaptiveLimiter("test_idle", max_limit=10, initial=8, min_limit=1, enabled=True)
+
+    async def scenario():
+        for _ in range(20):
+            await limiter.acquire()
+            limiter.release(success=True)
+
+    asyncio.run(scenario())
+    assert limiter.limit == 8
+
+
+def test_overload_halves_the_limit_once_per_cooldown(monkeypatch):
+    monkeypatch.setattr(adaptive_limiter, "ADAPTIVE_LIMIT_COOLDOWN", 60.0)
+    limiter = AdaptiveLimiter("test_decrease", max_limit=40, initial=20, min_limit=2, enabled=True)
+
+    async def scenario():
+        for _ in range(3):
+            await limiter.acquire()
+        # 同一波過載的多個錯誤只調降一次
+        for status in (429, 503, 429):
+            limiter.release(error=ProviderOverloaded("fake", status))
+
+    asyncio.run(scenario())
+    assert limiter.limit == 10
+    assert metrics.snapshot()["test_decrease_concurrency_limit"] == 10
+    assert metrics.snapshot()["test_decrease_limit_decreases_total"] == 1
+
+
+def test_latency_spike_decreases_the_limit(monkeypatch):
+    monkeypatch.setattr(adaptive_limiter, "ADAPTIVE_LIMIT_MIN_SAMPLES", 5)
+    limiter = AdaptiveLimiter("test_spike", max_limit=40, initial=16, min_limit=2, enabled=True)
+
+    async def scenario():
+        for _ in range(5):
+            await limiter.acquire()
+            limiter.release(success=True, latency=0.1)
+        assert limiter.limit == 16
+        await limiter.acquire()
+        limiter.release(success=True, latency=1.0)
+
+    asyncio.run(scenario())
+    assert limiter.limit == 8
+
+
+def test_limit_never_drops_below_minimum():
+    limiter = AdaptiveLimiter("test_floor", max_limit=40, initial=4, min_limit=3, enabled=True)
+
+    async def scenario():
+        for _ in range(5):
+            await limiter.acquire()
+            limiter.release(error=ProviderOverloaded("fake", 429))
+
+    asyncio.run(scenario())
+    assert limiter.limit == 3
+
+
+def test_retry_after_pauses_new_requests():
+    limiter = AdaptiveLimiter("test_pause", max_limit=10, initial=4, min_limit=1, enabled=True)
+
+    async def scenario():
+        await limiter.acquire()
+        limiter.release(error=ProviderOverloaded("fake", 429, retry_after=0.2))
+        started = time.monotonic()
+        await limiter.acquire()
+        limiter.release(success=True)
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) >= 0.18
+
+
+def test_requests_that_cannot_wait_out_the_pause_are_shed():
+    limiter = AdaptiveLimiter("test_shed", max_limit=10, initial=4, min_limit=1, enabled=True)
+
+    async def scenario():
+        await limiter.acquire()
+        limiter.release(error=ProviderOverloaded("fake", 429, retry_after=5))
+        started = time.monotonic()
+        with pytest.raises(ProviderOverloaded) as error:
+            await limiter.acquire(deadline=time.time() + 1)
+        assert time.monotonic() - started < 0.1
+        assert error.value.retry_after > 4
+
+    asyncio.run(scenario())
+    assert metrics.snapshot()["test_shed_limiter_shed_total"] == 1
+
+
+def test_disabled_limiter_keeps_the_maximum():
+    limiter = AdaptiveLimiter("test_disabled", max_limit=30, initial=4, min_limit=1, enabled=False)
+
+    async def scenario():
+        await limiter.acquire()
+        limiter.release(error=ProviderOverloaded("fake", 429, retry_after=5))
+        started = time.monotonic()
+        await limiter.acquire()
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) < 0.1
+    assert limiter.limit == 30
+
+
+def test_limit_converges_below_a_rate_limited_provider():
+    provider = FakeProvider(capacity=6)
+    limiter = AdaptiveLimiter("test_converge", max_limit=40, initial=30, min_limit=1, enabled=True)
+
+    async def client(rounds):
+        for _ in range(rounds):
+            try:
+                await call(limiter, provider)
+            except ProviderOverloaded:
+                pass
+
+    async def scenario():
+        await asyncio.gather(*[client(15) for _ in range(30)])
+        rejected = provider.rejected
+        # 收斂後的一段時間內幾乎不再觸發限流
+        await asyncio.gather(*[client(10) for _ in range(30)])
+        return provider.rejected - rejected
+
+    late_rejections = asyncio.run(scenario())
+    assert limiter.limit <= 12
+    assert late_rejections < provider.rejected - late_rejections
+
+
+def test_openai_errors_map_to_provider_overloaded():
+    error = as_overload("openai", openai_error(openai.RateLimitError, 429, {"retry-after-ms": "1500"}))
+    assert isinstance(error, ProviderOverloaded)
+    assert (error.provider, error.status, error.retry_after) == ("openai", 429, 1.5)
+
+    error = as_overload("openai", openai_error(openai.InternalServerError, 503, {"retry-after": "2"}))
+    assert (error.status, error.retry_after) == (503, 2.0)
+
+    assert as_overload("openai", openai_error(openai.InternalServerError, 500)) is None
+    assert as_overload("openai", openai_error(openai.BadRequestError, 400)) is None
+    assert as_overload("openai", ValueError("not an api error")) is None
+
+
+def test_google_errors_map_to_provider_overloaded():
+    retry_info = error_details_pb2.RetryInfo(retry_delay=duration_pb2.Duration(seconds=3, nanos=500000000))
+    error = as_overload("gemini", google_exceptions.TooManyRequests("quota", details=[retry_info]))
+    assert isinstance(error, ProviderOverloaded)
+    assert (error.provider, error.status, error.retry_after) == ("gemini", 429, 3.5)
+
+    error = as_overload("gemini", google_exceptions.ServiceUnavailable("overloaded"))
+    assert (error.status, error.retry_after) == (503, None)
+
+    assert as_overload("gemini", google_exceptions.InvalidArgument("bad request")) is None
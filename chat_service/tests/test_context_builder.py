@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+
+from app.services import context_builder
+from app.services.context_builder import SUMMARY_BATCH_TURNS, build_context, schedule_summary, turn_digest
+
+MAX_TURNS = 10
+
+
+def history(count, start=0):
+    return [{"user": f"問題{i}", "assistant": f"回答{i}"} for i in range(start, start + count)]
+
+
+class Store:
+    key_prefix = "test:"
+
+    def __init__(self):
+        self.records = []
+
+    async def set_summary(self, line_user_id, record):
+        self.records.append(record)
+
+
+def run_summary(window):
+    """執行schedule_summary並回傳摘要呼叫收到的對話，未呼叫時回傳None"""
+    calls = []
+
+    async def summarize(previous_summary, turns):
+        calls.append(turns)
+        return "摘要"
+
+    async def scenario():
+        schedule_summary(Store(), "user", window, summarize)
+        await asyncio.gather(*context_builder._summary_tasks)
+
+    asyncio.run(scenario())
+    return calls[0] if calls else None
+
+
+def test_turns_about_to_be_trimmed_are_summarized_even_when_they_fit_the_budget():
+    turns = history(MAX_TURNS)
+    window = build_context("gemini", "", turns, "新問題", None, budget=100000, max_turns=MAX_TURNS)
+    assert window.turns == turns
+    # 之後SUMMARY_BATCH_TURNS次寫入會移出最舊的幾輪
+    assert window.unsummarized == turns[:SUMMARY_BATCH_TURNS]
+    assert run_summary(window) == turns[:SUMMARY_BATCH_TURNS]
+
+
+def test_short_history_within_budget_needs_no_summary():
+    turns = history(3)
+    window = build_context("gemini", "", turns, "新問題", None, budget=100000, max_turns=MAX_TURNS)
+    assert window.unsummarized == []
+    assert run_summary(window) is None
+
+
+def test_summary_waits_for_a_batch_instead_of_running_every_request():
+    turns = history(MAX_TURNS)
+    # 前一次摘要涵蓋到最舊的第SUMMARY_BATCH_TURNS輪，之後只新增了一輪
+    record = {"summary": "舊摘要", "last_turn": turn_digest(turns[SUMMARY_BATCH_TURNS - 1])}
+    shifted = turns[1:] + history(1, start=MAX_TURNS)
+    window = build_context("gemini", "", shifted, "新問題", record, budget=100000, max_turns=MAX_TURNS)
+    assert window.unsummarized == [turns[SUMMARY_BATCH_TURNS]]
+    assert not window.urgent
+    assert run_summary(window) is None
+
+
+def test_uncovered_oldest_turn_in_full_history_is_summarized_immediately():
+    turns = history(MAX_TURNS)
+    record = {"summary": "舊摘要", "last_turn": turn_digest({"user": "早已移出", "assistant": "的對話"})}
+    window = build_context("gemini", "", turns, "新問題", record, budget=100000, max_turns=1 + SUMMARY_BATCH_TURNS)
+    assert window.urgent
+    assert run_summary(window) == window.unsummarized
+
+
+@pytest.mark.parametrize("budget", [60, 130])
+def test_turns_outside_the_token_budget_are_summarized_in_batches(budget):
+    turns = history(MAX_TURNS)
+    window = build_context("gemini", "", turns, "新問題", None, budget=budget, max_turns=100)
+    dropped = turns[:MAX_TURNS - len(window.turns)]
+    assert window.unsummarized == dropped
+    expected = dropped if len(dropped) >= SUMMARY_BATCH_TURNS else None
+    assert run_summary(window) == expected
@@ -0,0 +1,89 @@
+import asyncio
+
+import fakeredis.aioredis
+import pytest
+
+from app.services import conversation_store as store_module
+from app.services.conversation_store import ConversationStore
+from app.services.history_writer import HistoryWriter
+
+
+@pytest.fixture
+def store(monkeypatch):
+    server = fakeredis.FakeServer()
+    binary = fakeredis.aioredis.FakeRedis(server=server)
+    monkeypatch.setattr(store_module, "binary_client", binary)
+    monkeypatch.setattr(store_module, "redis_client", fakeredis.aioredis.FakeRedis(server=server, decode_responses=True))
+    monkeypatch.setattr(store_module, "_backfill", binary.register_script(store_module.BACKFILL_SCRIPT))
+    writer = HistoryWriter()
+    monkeypatch.setattr("app.services.history_writer.history_writer", writer)
+
+    conversations = ConversationStore("openai", "test_history:", "test_summary:", max_turns=5)
+    conversations.writer = writer
+    conversations.rows = []
+    conversations.queries = 0
+
+    async def query_db(line_user_id):
+        conversations.queries += 1
+        return list(conversations.rows)
+
+    monkeypatch.setattr(conversations, "_query_db", query_db)
+    return conversations
+
+
+def test_empty_database_result_is_remembered(store):
+    async def scenario():
+        assert await store.get_context("user", 5) == ([], None)
+        assert await store.get_context("user", 5) == ([], None)
+        assert store.queries == 1
+
+        # 寫入新對話後標記失效，Redis歷史過期時會再查詢資料表
+        await store.append("user", "你好", "你好！")
+        await store_module.binary_client.delete("test_history:user")
+        await store.get_context("user", 5)
+        assert store.queries == 2
+
+    asyncio.run(scenario())
+
+
+def test_database_rows_are_backfilled_into_redis(store):
+    store.rows = [{"user": "你好", "assistant": "你好！"}]
+
+    async def scenario():
+        assert (await store.get_context("user", 5))[0] == store.rows
+        assert await store_module.binary_client.llen("test_history:user") == 1
+
+    asyncio.run(scenario())
+
+
+def test_backfill_is_skipped_while_writes_are_pending(store):
+    store.rows = [{"user": "第一題", "assistant": "第一個回答"}]
+    store.writer.submit(line_user_id="user", message="第二題", response="第二個回答", provider="gemini", history="openai")
+
+    async def scenario():
+        entries, _ = await store.get_context("user", 5)
+        # 資料表的結果仍用於本次請求，但不寫回Redis，也不記為沒有記錄
+        assert entries == store.rows
+        assert await store_module.binary_client.exists("test_history:user") == 0
+        store.rows = []
+        await store.get_context("user", 5)
+        assert await store_module.binary_client.exists("conversation_store:db_empty:openai:user") == 0
+
+    asyncio.run(scenario())
+
+
+def test_history_writer_tracks_pending_rows_per_user():
+    writer = HistoryWriter()
+    writer.submit(line_user_id="user", message="a", response="b", provider="openai", history="openai")
+    writer.submit(line_user_id="user", message="c", response="d", provider="openai", history="openai")
+    assert writer.pending("user", "openai")
+    assert not writer.pending("user", "gemini")
+    assert not writer.pending("other", "openai")
+
+    rows = []
+    while not writer._queue.empty():
+        rows.append(writer._queue.get_nowait())
+    writer._settle(rows[0])
+    assert writer.pending("user", "openai")
+    writer._settle(rows[1])
+    assert not writer.pending("user", "openai")
@@ -0,0 +1,45 @@
+import asyncio
+import sqlite3
+
+import pytest
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.util import greenlet_spawn
+
+from app.models import database
+from app.models.database import TimedQueuePool
+
+
+def make_pool(creator):
+    return TimedQueuePool(creator, pool_size=1, max_overflow=0, timeout=0.01)
+
+
+def checkout(fn):
+    # 非同步連線池的佇列需在greenlet內操作，與AsyncEngine的呼叫方式相同
+    return asyncio.run(greenlet_spawn(fn))
+
+
+def test_checkout_timeout_is_counted():
+    pool = make_pool(lambda: sqlite3.connect(":memory:"))
+    before = database.db_pool_timeouts.value
+
+    def exhaust():
+        held = pool.connect()
+        try:
+            with pytest.raises(PoolTimeoutError):
+                pool.connect()
+        finally:
+            held.close()
+
+    checkout(exhaust)
+    assert database.db_pool_timeouts.value == before + 1
+
+
+def test_connect_failure_is_not_counted_as_timeout():
+    def refuse():
+        raise sqlite3.OperationalError("connection refused")
+
+    pool = make_pool(refuse)
+    before = database.db_pool_timeouts.value
+    with pytest.raises(sqlite3.OperationalError):
+        checkout(pool.connect)
+    assert database.db_pool_timeouts.value == before
@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+
+from app.api import chat
+from app.services import provider_router as router_module
+from app.services.llm_scheduler import FairScheduler
+from app.services.provider_stats import ProviderStats
+from app.services.provider_router import FALLBACK_MESSAGE, ProviderRouter, ProvidersUnavailable
+
+
+class Store:
+    name = "test"
+
+    def __init__(self):
+        self.appended = []
+
+    async def append(self, line_user_id, message, response):
+        self.appended.append((line_user_id, message, response))
+
+
+class StubProvider:
+    def __init__(self, delay=0.0, error=None):
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+        self.history = Store()
+
+    async def complete(self, line_user_id, message, deadline=None, store=None):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return f"{message}的回應"
+
+
+@pytest.fixture
+def providers(monkeypatch):
+    stubs = {"openai": StubProvider(), "gemini": StubProvider()}
+    for name, stub in stubs.items():
+        monkeypatch.setitem(router_module.PROVIDERS, name, stub)
+    monkeypatch.setattr(router_module, "AUTO_HISTORY", Store())
+    return stubs
+
+
+def make_router(hedge_enabled=False):
+    router = ProviderRouter(providers=["openai", "gemini"], hedge_enabled=hedge_enabled)
+    router.rank = lambda streaming=False: ["openai", "gemini"]
+    router.hedge_delay = lambda name, streaming=False: 0.01
+    return router
+
+
+def test_rank_gives_untried_providers_the_average_latency(monkeypatch):
+    stats = {
+        "openai": ProviderStats("openai", "test"),
+        "gemini": ProviderStats("gemini", "test"),
+        "claude": ProviderStats("claude", "test"),
+    }
+    for name in stats:
+        monkeypatch.setitem(router_module.PROVIDERS, name, StubProvider())
+    monkeypatch.setattr(router_module, "_configured", lambda name: True)
+    router = ProviderRouter(providers=["openai", "gemini", "claude"])
+    router.stats = lambda name: stats[name]
+
+    # 都沒有樣本時依設定順序
+    assert router.rank() == ["openai", "gemini", "claude"]
+
+    # 未嘗試的claude以平均延遲(2秒)排序，不會排在較快的gemini前面
+    stats["openai"].record_success(3.0)
+    stats["gemini"].record_success(1.0)
+    assert router.rank() == ["gemini", "claude", "openai"]
+
+    # 錯誤率過高的提供者仍排在最後
+    for _ in range(10):
+        stats["gemini"].record_failure()
+    assert router.rank() == ["claude", "openai", "gemini"]
+
+
+def test_all_providers_failing_raises_instead_of_returning_fallback_text(providers):
+    providers["openai"].error = RuntimeError("openai down")
+    providers["gemini"].error = RuntimeError("gemini down")
+
+    with pytest.raises(ProvidersUnavailable) as error:
+        asyncio.run(make_router().generate("user", "你好"))
+    assert error.value.provider == "openai"
+    assert router_module.AUTO_HISTORY.appended == []
+
+
+def test_hedge_holds_its_own_scheduler_slot(providers, monkeypatch):
+    scheduler = FairScheduler(max_concurrency=2, provider_limits={"gemini": 1})
+    monkeypatch.setattr(router_module, "llm_scheduler", scheduler)
+    providers["openai"].delay = 0.5
+    providers["gemini"].delay = 0.05
+    observed = {}
+
+    async def scenario():
+        # 主要請求的名額由呼叫端取得
+        async with scheduler.slot("user", "openai"):
+            task = asyncio.create_task(make_router(hedge_enabled=True).generate("user", "你好"))
+            await asyncio.sleep(0.03)
+            observed["active"] = scheduler._active
+            return await task
+
+    assert asyncio.run(scenario()) == ("你好的回應", "gemini")
+    assert observed["active"] == 2
+    assert scheduler._active == 0
+
+
+def test_hedge_is_skipped_when_scheduler_has_no_free_slot(providers, monkeypatch):
+    scheduler = FairScheduler(max_concurrency=1)
+    monkeypatch.setattr(router_module, "llm_scheduler", scheduler)
+    providers["openai"].delay = 0.1
+
+    async def scenario():
+        async with scheduler.slot("user", "openai"):
+            return await make_router(hedge_enabled=True).generate("user", "你好")
+
+    assert asyncio.run(scenario()) == ("你好的回應", "openai")
+    assert providers["gemini"].calls == 0
+
+
+def test_process_chat_replies_with_fallback_without_persisting(monkeypatch):
+    submitted = []
+
+    async def unavailable(line_user_id, message, deadline=None, provider=None):
+        raise ProvidersUnavailable("openai", RuntimeError("down"))
+
+    monkeypatch.setattr(chat.provider_router, "generate", unavailable)
+    monkeypatch.setattr(chat.history_writer, "submit", lambda **row: submitted.append(row))
+
+    request = chat.ChatRequest(line_user_id="user", message="你好")
+    response = asyncio.run(chat.process_chat(request, None))
+    assert response.response == FALLBACK_MESSAGE
+    assert response.fallback is True
+    assert submitted == []
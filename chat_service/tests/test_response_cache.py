@@ -0,0 +1,151 @@
+import asyncio
+import time
+
+import fakeredis.aioredis
+import pytest
+
+from app.services import response_cache, semantic_cache
+from app.services.response_cache import ResponseCache, cache_corrupt
+from app.services.semantic_cache import SemanticCache, namespace_id, semantic_corrupt
+
+
+def turns(*pairs):
+    return [{"user": user, "assistant": assistant} for user, assistant in pairs]
+
+
+HISTORY = turns(("我叫小明", "你好小明"), ("我住台北", "台北很好"), ("今天天氣", "晴天"), ("謝謝", "不客氣"))
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(response_cache, "redis_client", client)
+    monkeypatch.setattr(semantic_cache, "redis_client", client)
+    return client
+
+
+def test_key_covers_every_context_turn_not_only_the_latest():
+    cache = ResponseCache("openai", 60, enabled=True)
+    key = cache.make_key("model", "system", "我叫什麼名字？", HISTORY)
+    # 只有最早的一輪不同
+    other = [{"user": "我叫小華", "assistant": "你好小華"}] + HISTORY[1:]
+    assert cache.make_key("model", "system", "我叫什麼名字？", other) != key
+    assert cache.make_key("model", "system", "我叫什麼名字", list(HISTORY)) == key
+
+
+def test_key_covers_rolling_summary():
+    cache = ResponseCache("openai", 60, enabled=True)
+    key = cache.make_key("model", "system", "我叫什麼名字", HISTORY, "用戶叫小明")
+    assert cache.make_key("model", "system", "我叫什麼名字", HISTORY, "用戶叫小華") != key
+    assert cache.make_key("model", "system", "我叫什麼名字", HISTORY) != key
+    assert namespace_id("openai", "m", "s", HISTORY, "問題", "用戶叫小明") != namespace_id(
+        "openai", "m", "s", HISTORY, "問題", "用戶叫小華"
+    )
+
+
+def test_round_trip_and_corrupt_value_is_a_miss_that_gets_deleted(fake_redis):
+    async def scenario():
+        cache = ResponseCache("openai", 60, enabled=True)
+        key = cache.make_key("model", "system", "round trip", HISTORY)
+        await cache.set(key, "回應", 1.0)
+        assert await cache.get(key) == "回應"
+
+        corrupt_key = cache.make_key("model", "system", "corrupt", HISTORY)
+        await fake_redis.set(corrupt_key, "{not json")
+        before = cache_corrupt.value
+        assert await cache.get(corrupt_key) is None
+        assert cache_corrupt.value == before + 1
+        assert await fake_redis.exists(corrupt_key) == 0
+
+        foreign_key = cache.make_key("model", "system", "foreign", HISTORY)
+        await fake_redis.set(foreign_key, "[1, 2]")
+        assert await cache.get(foreign_key) is None
+        assert await fake_redis.exists(foreign_key) == 0
+
+    asyncio.run(scenario())
+
+
+def test_semantic_cache_treats_corrupt_entries_as_misses(fake_redis):
+    async def scenario():
+        cache = SemanticCache(enabled=True)
+        await cache.set(1, "台北明天天氣如何", "晴天", 1.0)
+        assert await cache.get(1, "台北明天天氣如何？") == "晴天"
+
+        key = cache._entry_key(1, semantic_cache.canonicalize("台北明天天氣如何"))
+        await fake_redis.hset(semantic_cache.REDIS_ENTRIES_KEY, key, "garbage")
+        before = semantic_corrupt.value
+        assert await cache.get(1, "台北明天天氣如何") is None
+        assert semantic_corrupt.value == before + 1
+        assert await fake_redis.hexists(semantic_cache.REDIS_ENTRIES_KEY, key) == 0
+
+        # 載入時略過並刪除無法解析的項目
+        await fake_redis.hset(semantic_cache.REDIS_ENTRIES_KEY, "broken", "{")
+        await SemanticCache(enabled=True).load()
+        assert await fake_redis.hexists(semantic_cache.REDIS_ENTRIES_KEY, "broken") == 0
+
+    asyncio.run(scenario())
+
+
+def test_set_during_load_does_not_start_a_concurrent_rebuild(fake_redis, monkeypatch):
+    monkeypatch.setattr(semantic_cache, "LOAD_BATCH_SIZE", 10)
+    monkeypatch.setattr(semantic_cache, "SEMANTIC_CACHE_DELTA_LIMIT", 5)
+    rebuilds = {"running": 0, "overlap": False}
+    prepare = semantic_cache.NgramIndex.prepare_rebuild
+
+    def tracked_prepare(index):
+        rebuilds["overlap"] |= rebuilds["running"] > 0
+        rebuilds["running"] += 1
+        try:
+            time.sleep(0.01)
+            return prepare(index)
+        finally:
+            rebuilds["running"] -= 1
+
+    monkeypatch.setattr(semantic_cache.NgramIndex, "prepare_rebuild", tracked_prepare)
+
+    async def scenario():
+        writer = SemanticCache(enabled=True)
+        questions = [f"第{i}號房間的冷氣怎麼開" for i in range(200)]
+        for i, question in enumerate(questions):
+            await writer.set(i, question, f"回答{i}", 1.0)
+
+        cache = SemanticCache(enabled=True)
+        loading = asyncio.create_task(cache.load())
+        await asyncio.sleep(0)
+        # 載入進行中時寫入新項目
+        for i in range(200, 220):
+            await cache.set(i, f"第{i}號房間的冷氣怎麼開", f"回答{i}", 1.0)
+            await asyncio.sleep(0)
+        await loading
+        if cache._rebuild_task is not None:
+            await cache._rebuild_task
+
+        assert not rebuilds["overlap"]
+        for i in range(220):
+            assert await cache.get(i, f"第{i}號房間的冷氣怎麼開") == f"回答{i}"
+
+    asyncio.run(scenario())
+
+
+def test_response_size_limits_count_utf8_bytes(fake_redis, monkeypatch):
+    monkeypatch.setattr(response_cache, "RESPONSE_CACHE_MAX_RESPONSE_BYTES", 1024)
+    # 約400個中文字：字元數遠低於上限，UTF-8位元組數超過上限
+    too_large = "這是一段很長的中文回應。" * 34
+
+    async def scenario():
+        cache = ResponseCache("openai", 60, enabled=True)
+        key = cache.make_key("model", "system", "big", HISTORY)
+        await cache.set(key, too_large, 1.0)
+        assert await fake_redis.exists(key) == 0
+        assert await cache.get(key) is None
+
+        fits = too_large[:len(too_large) // 2]
+        key = cache.make_key("model", "system", "fits", HISTORY)
+        before = response_cache._local.size_bytes
+        await cache.set(key, fits, 1.0)
+        assert await cache.get(key) == fits
+        stored = await fake_redis.get(key)
+        assert response_cache._local.size_bytes - before == len(stored.encode("utf-8"))
+
+    assert len(too_large) < 1024 < len(too_large.encode("utf-8"))
+    asyncio.run(scenario())
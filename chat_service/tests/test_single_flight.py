@@ -0,0 +1,108 @@
+import asyncio
+import time
+
+import fakeredis.aioredis
+import pytest
+
+from app.services import single_flight as flight_module
+from app.services.single_flight import KEY_PREFIX, SingleFlight
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(flight_module, "redis_client", client)
+    monkeypatch.setattr(flight_module, "_acquire", client.register_script(flight_module.ACQUIRE_SCRIPT))
+    monkeypatch.setattr(flight_module, "_finish", client.register_script(flight_module.FINISH_SCRIPT))
+    monkeypatch.setattr(flight_module, "SINGLE_FLIGHT_WAIT_TIMEOUT", 5.0)
+    return client
+
+
+class Provider:
+    """記錄呼叫次數，第一次呼叫依設定失敗或等待"""
+
+    def __init__(self, error=None, delay=0.05):
+        self.calls = 0
+        self.error = error
+        self.delay = delay
+        self.started = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        self.started.set()
+        await asyncio.sleep(self.delay)
+        if self.error is not None and self.calls == 1:
+            raise self.error
+        return f"回應{self.calls}"
+
+
+def test_local_followers_share_the_leader_result(fake_redis):
+    async def scenario():
+        flight = SingleFlight(enabled=True)
+        provider = Provider()
+        results = await asyncio.gather(*[flight.do("key", provider) for _ in range(5)])
+        assert results == ["回應1"] * 5
+        assert provider.calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_local_followers_receive_the_leader_error_instead_of_retrying(fake_redis):
+    async def scenario():
+        flight = SingleFlight(enabled=True)
+        provider = Provider(error=RuntimeError("upstream failed"))
+        results = await asyncio.gather(*[flight.do("key", provider) for _ in range(5)], return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert provider.calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_only_one_follower_takes_over_when_the_leader_is_cancelled(fake_redis):
+    async def scenario():
+        flight = SingleFlight(enabled=True)
+        provider = Provider()
+        leader = asyncio.create_task(flight.do("key", provider))
+        await provider.started.wait()
+        followers = [asyncio.create_task(flight.do("key", provider)) for _ in range(4)]
+        await asyncio.sleep(0)
+        leader.cancel()
+        results = await asyncio.gather(*followers)
+        assert results == ["回應2"] * 4
+        assert provider.calls == 2
+
+    asyncio.run(scenario())
+
+
+def test_remote_follower_sees_failure_marker_left_before_it_subscribed(fake_redis):
+    async def scenario():
+        lock_key = f"{KEY_PREFIX}lock:key"
+        # 另一個副本的領導者仍持有鎖，但已經失敗並留下失敗標記
+        await fake_redis.set(lock_key, "other-replica", px=30000)
+        await SingleFlight(enabled=True)._publish("key", lock_key, "stale-token", None)
+        assert await fake_redis.ttl(f"{KEY_PREFIX}result:key") > 0
+
+        provider = Provider(delay=0)
+        started = time.monotonic()
+        assert await SingleFlight(enabled=True).do("key", provider) == "回應1"
+        assert time.monotonic() - started < 1
+        assert provider.calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_remote_follower_shares_result_and_new_leader_clears_stale_marker(fake_redis):
+    async def scenario():
+        leader_replica, follower_replica = SingleFlight(enabled=True), SingleFlight(enabled=True)
+        provider = Provider(delay=0.2)
+        leader = asyncio.create_task(leader_replica.do("key", provider))
+        await provider.started.wait()
+        assert await follower_replica.do("key", provider) == "回應1"
+        assert await leader == "回應1"
+        assert provider.calls == 1
+
+        # 上一輪的結果在新的領導者取得鎖時清除
+        await fake_redis.set(f"{KEY_PREFIX}result:key", '{"ok": false, "response": null}', ex=10)
+        assert await leader_replica.do("key", provider) == "回應2"
+
+    asyncio.run(scenario())
@@ -0,0 +1,60 @@
+import json
+
+import msgpack
+import pytest
+
+from app.utils.value_codec import FLAG_ZSTD, MAGIC, VERSION, ValueCodec
+
+TURN = {"user": "今天台北天氣如何？", "assistant": "今天台北晴時多雲，氣溫約28度。"}
+LONG_TURN = {"user": "請詳細說明", "assistant": "重複的說明內容。" * 200}
+
+
+@pytest.mark.parametrize("raw", [
+    json.dumps(TURN, ensure_ascii=False),
+    json.dumps(TURN, ensure_ascii=False).encode("utf-8"),
+    json.dumps(TURN).encode("utf-8"),
+])
+def test_legacy_json_values_are_still_readable(raw):
+    assert ValueCodec("test_legacy").decode(raw) == TURN
+
+
+def test_json_format_writes_plain_json_readable_by_old_replicas():
+    encoded = ValueCodec("test_json", format="json").encode(TURN)
+    assert json.loads(encoded) == TURN
+    assert ValueCodec("test_json_reader").decode(encoded) == TURN
+
+
+def test_msgpack_round_trip_without_compression_for_small_values():
+    codec = ValueCodec("test_msgpack", compress_min_bytes=512)
+    encoded = codec.encode(TURN)
+    assert encoded[:3] == bytes((MAGIC, VERSION, 0))
+    assert msgpack.unpackb(encoded[3:], raw=False) == TURN
+    assert codec.decode(encoded) == TURN
+
+
+def test_msgpack_values_above_threshold_are_zstd_compressed():
+    codec = ValueCodec("test_zstd", compress_min_bytes=512)
+    encoded = codec.encode(LONG_TURN)
+    assert encoded[2] & FLAG_ZSTD
+    assert len(encoded) < len(msgpack.packb(LONG_TURN, use_bin_type=True))
+    assert codec.decode(encoded) == LONG_TURN
+    # 讀取端不需相同的壓縮設定
+    assert ValueCodec("test_zstd_reader", format="json", compress_min_bytes=0).decode(encoded) == LONG_TURN
+
+
+def test_compression_disabled_with_zero_threshold():
+    encoded = ValueCodec("test_no_zstd", compress_min_bytes=0).encode(LONG_TURN)
+    assert encoded[2] == 0
+
+
+def test_unknown_version_and_truncated_header_are_rejected():
+    codec = ValueCodec("test_invalid")
+    with pytest.raises(ValueError):
+        codec.decode(bytes((MAGIC, VERSION + 1, 0)) + msgpack.packb(TURN))
+    with pytest.raises(ValueError):
+        codec.decode(bytes((MAGIC, VERSION)))
+
+
+def test_unknown_format_is_rejected():
+    with pytest.raises(ValueError):
+        ValueCodec("test_format", format="pickle")
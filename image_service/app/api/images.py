@@ -1,14 +1,17 @@
 import os
 import logging
-from fastapi import APIRouter, Depends, HTTPException, Form, UploadFile, File, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, Form, UploadFile, File, BackgroundTasks, Header
 from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
+from sqlalchemy import literal, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional
 import json
 
-from app.models.database import get_db, ImageHistory
+from app.models.database import get_db, AsyncSessionLocal, ImageHistory
 from app.services.gemini_service import GeminiService
-from app.utils.image_utils import save_temp_image, get_image_info
+from app.utils.image_utils import save_temp_image, get_image_info, ImageDigestMismatch
+from app.utils.deadline import DeadlineExceeded, parse_deadline, check_deadline, run_with_deadline
+from app.utils.pagination import InvalidCursor, decode_cursor, encode_cursor, clamp_page_size
 
 # 配置日誌
 logger = logging.getLogger(__name__)
@@ -21,17 +24,23 @@ async def analyze_image(
     image: UploadFile = File(...),
     line_user_id: str = Form(...),
     description: Optional[str] = Form(None),
-    db: Session = Depends(get_db)
+    image_sha256: Optional[str] = Form(None),
+    x_request_deadline: Optional[str] = Header(None)
 ):
     """分析圖片並返回結果"""
+    deadline = parse_deadline(x_request_deadline)
     try:
+        # 截止時間已過則不再分析
+        check_deadline(deadline)
+        
         # 確認圖片副檔名
         file_extension = os.path.splitext(image.filename)[1]
         if not GeminiService.is_valid_image(file_extension):
             raise HTTPException(status_code=400, detail="不支持的圖片格式")
         
         # 保存臨時圖片
-        image_data, image_hash = await save_temp_image(image)
+        # 閘道串流上傳時會附上SHA-256，用來核對收到的內容是否完整
+        image_data, image_hash = await save_temp_image(image, image_sha256)
         
         # 檢查緩存中是否有分析結果
         cached_result = GeminiService.get_cached_result(line_user_id, image_hash)
@@ -39,7 +48,6 @@ async def analyze_image(
             # 在背景保存分析歷史
             background_tasks.add_task(
                 save_image_history,
-                db=db,
                 line_user_id=line_user_id,
                 image_url=f"local:{image_hash}{file_extension}",
                 description=description,
@@ -47,8 +55,11 @@ async def analyze_image(
             )
             return cached_result
         
-        # 分析圖片
-        result = await GeminiService.analyze_image(image_data, description)
+        # 分析圖片，超過截止時間時取消進行中的Gemini呼叫
+        result = await run_with_deadline(
+            GeminiService.analyze_image(image_data, description),
+            deadline
+        )
         
         # 緩存分析結果
         GeminiService.cache_result(line_user_id, image_hash, result)
@@ -56,7 +67,6 @@ async def analyze_image(
         # 在背景保存分析歷史
         background_tasks.add_task(
             save_image_history,
-            db=db,
             line_user_id=line_user_id,
             image_url=f"local:{image_hash}{file_extension}",
             description=description,
@@ -66,52 +76,90 @@ async def analyze_image(
         return result
     except HTTPException as e:
         raise e
+    except ImageDigestMismatch as e:
+        logger.warning(f"圖片上傳內容不完整，用戶ID: {line_user_id}: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    except DeadlineExceeded as e:
+        logger.warning(f"放棄圖片分析，用戶ID: {line_user_id}: {e}")
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         logger.error(f"分析圖片時出錯: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-def save_image_history(
-    db: Session,
+async def save_image_history(
     line_user_id: str,
     image_url: str,
     description: Optional[str],
     analysis_result: dict
 ):
-    """將圖片分析歷史保存到數據庫"""
+    """將圖片分析歷史保存到數據庫；在回應送出後執行，使用自己的會話"""
     try:
-        image_history = ImageHistory(
-            line_user_id=line_user_id,
-            image_url=image_url,
-            description=description,
-            analysis_result=analysis_result
-        )
-        db.add(image_history)
-        db.commit()
+        async with AsyncSessionLocal() as db:
+            db.add(ImageHistory(
+                line_user_id=line_user_id,
+                image_url=image_url,
+                description=description,
+                analysis_result=analysis_result
+            ))
+            await db.commit()
         logger.info(f"已保存圖片分析記錄，用戶ID: {line_user_id}")
     except Exception as e:
-        db.rollback()
         logger.error(f"保存圖片分析記錄時出錯: {e}")
 
 @router.get("/history/{line_user_id}")
-async def get_image_history(line_user_id: str, limit: int = 10, db: Session = Depends(get_db)):
-    """獲取用戶的圖片分析歷史"""
+async def get_image_history(
+    line_user_id: str,
+    limit: int = 10,
+    before: Optional[str] = None,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    由新到舊分頁獲取用戶的圖片分析歷史
+
+    before為上一頁回傳的next_cursor，依(created_at, id)定位；
+    只讀取分析結果中的analysis欄位，不載入整份analysis_result。
+    """
+    try:
+        cursor = decode_cursor(before)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    limit = clamp_page_size(limit)
+    
     try:
-        history = db.query(ImageHistory).filter(
-            ImageHistory.line_user_id == line_user_id
-        ).order_by(ImageHistory.created_at.desc()).limit(limit).all()
+        query = select(
+            ImageHistory.id,
+            ImageHistory.image_url,
+            ImageHistory.description,
+            ImageHistory.analysis_result["analysis"].as_string().label("analysis"),
+            ImageHistory.created_at
+        ).where(ImageHistory.line_user_id == line_user_id)
+        if cursor:
+            created_at, row_id = cursor
+            query = query.where(
+                tuple_(ImageHistory.created_at, ImageHistory.id) < tuple_(literal(created_at, ImageHistory.created_at.type), literal(row_id))
+            )
+        # 多取一筆判斷是否還有下一頁
+        query = query.order_by(ImageHistory.created_at.desc(), ImageHistory.id.desc()).limit(limit + 1)
+        rows = (await db.execute(query)).all()
+        
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
         
         return {
             "line_user_id": line_user_id,
             "history": [
                 {
-                    "id": item.id,
-                    "image_url": item.image_url,
-                    "description": item.description,
-                    "analysis": item.analysis_result.get("analysis"),
-                    "created_at": item.created_at
-                } for item in history
-            ]
+                    "id": row.id,
+                    "image_url": row.image_url,
+                    "description": row.description,
+                    "analysis": row.analysis,
+                    "created_at": row.created_at
+                } for row in rows
+            ],
+            "next_cursor": next_cursor
         }
     except Exception as e:
         logger.error(f"獲取圖片分析歷史時出錯: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
@@ -5,7 +5,8 @@ from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 
 from app.api import images
-from app.models.database import engine, Base
+from app.models.database import engine, init_db
+from app.utils.metrics import metrics
 
 # 加載環境變數
 load_dotenv()
@@ -28,9 +29,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# 創建表格
-Base.metadata.create_all(bind=engine)
-
 app = FastAPI(title="Image Analysis Service")
 
 # 設置CORS
@@ -49,10 +47,17 @@ app.include_router(images.router, prefix="/images", tags=["images"])
 async def health_check():
     return {"status": "ok", "service": "image_service"}
 
+@app.get("/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
 @app.on_event("startup")
 async def startup_event():
     logger.info("Image Service starting up")
+    # 創建表格
+    await init_db()
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    await engine.dispose()
     logger.info("Image Service shutting down") 
\ No newline at end of file
@@ -1,12 +1,13 @@
 import os
 import io
-import json
 import logging
 import redis
 import google.generativeai as genai
 from PIL import Image
 from dotenv import load_dotenv
 
+from app.utils.value_codec import ValueCodec
+
 # 加載環境變數
 load_dotenv()
 
@@ -25,10 +26,21 @@ ALLOWED_EXTENSIONS = os.getenv("ALLOWED_EXTENSIONS", "jpg,jpeg,png,gif").split("
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
 REDIS_CACHE_EXPIRY = int(os.getenv("REDIS_CACHE_EXPIRY", "3600"))  # 1小時
+# 分析結果的編碼：msgpack(超過門檻時以zstd壓縮)或與舊版相同的json，兩種格式都能讀取
+REDIS_VALUE_CODEC = os.getenv("REDIS_VALUE_CODEC", "msgpack")
+REDIS_VALUE_COMPRESS_MIN_BYTES = int(os.getenv("REDIS_VALUE_COMPRESS_MIN_BYTES", "512"))
+REDIS_VALUE_ZSTD_LEVEL = int(os.getenv("REDIS_VALUE_ZSTD_LEVEL", "3"))
+
+result_codec = ValueCodec(
+    "image_cache",
+    format=REDIS_VALUE_CODEC,
+    compress_min_bytes=REDIS_VALUE_COMPRESS_MIN_BYTES,
+    level=REDIS_VALUE_ZSTD_LEVEL
+)
 
-# 初始化Redis連接
+# 初始化Redis連接(分析結果為二進位值，不解碼回應)
 try:
-    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
     redis_client.ping()  # 測試連接
     logger.info("Redis連接成功")
 except redis.ConnectionError as e:
@@ -68,7 +80,7 @@ class GeminiService:
             cache_key = f"image_analysis:{line_user_id}:{image_hash}"
             redis_client.set(
                 cache_key, 
-                json.dumps(result), 
+                result_codec.encode(result), 
                 ex=REDIS_CACHE_EXPIRY
             )
             logger.info(f"已緩存圖片分析結果: {cache_key}")
@@ -86,7 +98,7 @@ class GeminiService:
             cached = redis_client.get(cache_key)
             if cached:
                 logger.info(f"從緩存獲取分析結果: {cache_key}")
-                return json.loads(cached)
+                return result_codec.decode(cached)
             return None
         except Exception as e:
             logger.error(f"從緩存獲取結果時出錯: {e}")
@@ -108,8 +120,8 @@ class GeminiService:
             # 獲取Gemini模型
             model = genai.GenerativeModel(GEMINI_MODEL)
             
-            # 發送請求
-            response = model.generate_content([
+            # 發送請求 (非同步API，截止時間到時可被取消)
+            response = await model.generate_content_async([
                 prompt,
                 image,
             ])
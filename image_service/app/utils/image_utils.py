@@ -2,24 +2,49 @@ import os
 import hashlib
 import io
 import logging
+from typing import Optional
 from fastapi import UploadFile
 from PIL import Image
 
+from app.utils.metrics import metrics
+
 # 配置日誌
 logger = logging.getLogger(__name__)
 
-async def save_temp_image(upload_file: UploadFile) -> tuple:
+READ_CHUNK_SIZE = 64 * 1024
+
+digest_mismatches = metrics.counter("image_digest_mismatch_total")
+
+
+class ImageDigestMismatch(ValueError):
+    """上游附上的SHA-256與實際收到的圖片不符"""
+
+
+async def save_temp_image(upload_file: UploadFile, image_sha256: Optional[str] = None) -> tuple:
     """
     保存上傳的圖片到臨時目錄
     
+    image_sha256: 上游計算的SHA-256雜湊值(選填)，只用於核對，
+        快取鍵一律使用讀取時計算的雜湊，不符時拋出ImageDigestMismatch
+    
     返回: (圖片資料, 圖片雜湊值)
     """
     try:
-        # 讀取圖片數據
-        image_data = await upload_file.read()
+        # 讀取圖片數據，同時計算雜湊值用於緩存
+        digest = hashlib.sha256()
+        chunks = []
+        while True:
+            chunk = await upload_file.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            chunks.append(chunk)
+        image_data = b"".join(chunks)
+        image_hash = digest.hexdigest()
         
-        # 計算圖片雜湊值用於緩存
-        image_hash = hashlib.md5(image_data).hexdigest()
+        if image_sha256 and image_sha256.lower() != image_hash:
+            digest_mismatches.inc()
+            raise ImageDigestMismatch("圖片雜湊值與內容不符")
         
         return image_data, image_hash
     except Exception as e:
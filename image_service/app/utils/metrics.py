@@ -0,0 +1,140 @@
+import time
+import threading
+from collections import deque
+from typing import Callable, Dict, Optional
+
+# 百分位數計算保留的最近樣本數
+HISTOGRAM_WINDOW = 2048
+
+
+class Counter:
+    """單調遞增計數器"""
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def snapshot(self):
+        return self._value
+
+
+class Gauge:
+    """即時數值，可直接設定或由回呼函式提供"""
+
+    def __init__(self, func: Optional[Callable[[], float]] = None):
+        self._value = 0
+        self._func = func
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, amount=1):
+        self._value += amount
+
+    def dec(self, amount=1):
+        self._value -= amount
+
+    @property
+    def value(self):
+        if self._func is not None:
+            return self._func()
+        return self._value
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    """保留最近樣本的直方圖，用於計算延遲百分位數"""
+
+    def __init__(self, window: int = HISTOGRAM_WINDOW):
+        self._samples = deque(maxlen=window)
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self._samples.append(value)
+            self._count += 1
+            self._sum += value
+            if value > self._max:
+                self._max = value
+
+    def time(self):
+        """以context manager方式量測耗時(秒)"""
+        return _Timer(self)
+
+    def percentile(self, q: float) -> float:
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return 0.0
+        index = min(len(samples) - 1, int(round(q * (len(samples) - 1))))
+        return samples[index]
+
+    def snapshot(self):
+        return {
+            "count": self._count,
+            "sum": round(self._sum, 6),
+            "max": round(self._max, 6),
+            "p50": round(self.percentile(0.50), 6),
+            "p95": round(self.percentile(0.95), 6),
+            "p99": round(self.percentile(0.99), 6),
+        }
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram):
+        self._histogram = histogram
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._histogram.observe(time.perf_counter() - self._start)
+        return False
+
+
+class MetricsRegistry:
+    """服務內的指標登記表，透過 /metrics 端點輸出"""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def counter(self, name: str) -> Counter:
+        return self._get_or_create(name, Counter)
+
+    def gauge(self, name: str, func: Optional[Callable[[], float]] = None) -> Gauge:
+        gauge = self._get_or_create(name, lambda: Gauge(func))
+        if func is not None:
+            gauge._func = func
+        return gauge
+
+    def histogram(self, name: str) -> Histogram:
+        return self._get_or_create(name, Histogram)
+
+    def _get_or_create(self, name, factory):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = factory()
+            self._metrics[name] = metric
+        return metric
+
+    def snapshot(self) -> Dict[str, object]:
+        return {name: metric.snapshot() for name, metric in sorted(self._metrics.items())}
+
+
+# 全域指標登記表
+metrics = MetricsRegistry()
@@ -0,0 +1,34 @@
+import json
+import base64
+import binascii
+from datetime import datetime
+from typing import Optional, Tuple
+
+# 歷史列表每頁筆數上限
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    """無法解析的分頁游標"""
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    """將最後一筆的(created_at, id)編碼成不透明的游標"""
+    raw = json.dumps([created_at.isoformat(), row_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Tuple[datetime, int]]:
+    """解析游標，沒有游標時回傳None，格式錯誤時拋出InvalidCursor"""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, TypeError, binascii.Error) as e:
+        raise InvalidCursor(f"無效的分頁游標: {cursor}") from e
+
+
+def clamp_page_size(limit: int) -> int:
+    return max(1, min(limit, MAX_PAGE_SIZE))
@@ -0,0 +1,76 @@
+import json
+from typing import Any, Union
+
+import msgpack
+import zstandard
+
+from app.utils.metrics import metrics
+
+# 二進位格式的開頭：0xC1在msgpack中未使用，也不是合法的UTF-8開頭，不會與JSON文字混淆
+MAGIC = 0xC1
+VERSION = 1
+HEADER_SIZE = 3
+
+# 旗標位元
+FLAG_ZSTD = 0x01
+
+FORMATS = ("msgpack", "json")
+
+
+class ValueCodec:
+    """
+    Redis值的編碼
+
+    msgpack格式為 [MAGIC, VERSION, 旗標] + msgpack內容，超過compress_min_bytes時以zstd壓縮；
+    json格式寫入與舊版相同的JSON文字，可用於回復或與尚未升級的副本共存。
+    解碼時依開頭判斷，沒有標頭的值一律視為舊的JSON。
+    """
+
+    def __init__(self, name: str, format: str = "msgpack", compress_min_bytes: int = 512, level: int = 3):
+        if format not in FORMATS:
+            raise ValueError(f"不支援的編碼格式: {format}")
+        self.name = name
+        self.format = format
+        self.compress_min_bytes = compress_min_bytes
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+        self._encoded_bytes = metrics.counter(f"{name}_codec_encoded_bytes_total")
+        self._raw_bytes = metrics.counter(f"{name}_codec_raw_bytes_total")
+        self._compressed = metrics.counter(f"{name}_codec_compressed_total")
+        self._legacy = metrics.counter(f"{name}_codec_legacy_json_total")
+
+    def encode(self, value: Any) -> bytes:
+        if self.format == "json":
+            data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+            self._raw_bytes.inc(len(data))
+            self._encoded_bytes.inc(len(data))
+            return data
+
+        data = msgpack.packb(value, use_bin_type=True)
+        self._raw_bytes.inc(len(data))
+        flags = 0
+        if 0 < self.compress_min_bytes <= len(data):
+            compressed = self._compressor.compress(data)
+            # 短或重複少的內容壓縮後可能反而變大
+            if len(compressed) < len(data):
+                data = compressed
+                flags |= FLAG_ZSTD
+                self._compressed.inc()
+        encoded = bytes((MAGIC, VERSION, flags)) + data
+        self._encoded_bytes.inc(len(encoded))
+        return encoded
+
+    def decode(self, raw: Union[bytes, str]) -> Any:
+        if isinstance(raw, str) or not raw or raw[0] != MAGIC:
+            self._legacy.inc()
+            return json.loads(raw)
+        if len(raw) < HEADER_SIZE:
+            raise ValueError("編碼值的標頭不完整")
+        version, flags = raw[1], raw[2]
+        if version != VERSION:
+            raise ValueError(f"不支援的編碼版本: {version}")
+        data = raw[HEADER_SIZE:]
+        if flags & FLAG_ZSTD:
+            data = self._decompressor.decompress(data)
+        return msgpack.unpackb(data, raw=False)
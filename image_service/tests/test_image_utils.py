@@ -0,0 +1,32 @@
+import io
+import asyncio
+import hashlib
+
+import pytest
+from fastapi import UploadFile
+
+from app.utils.image_utils import ImageDigestMismatch, READ_CHUNK_SIZE, save_temp_image
+
+IMAGE = b"\x89PNG" + bytes(range(256)) * (READ_CHUNK_SIZE // 128)
+
+
+def upload(data: bytes) -> UploadFile:
+    return UploadFile(file=io.BytesIO(data), filename="image.png")
+
+
+def test_hash_is_computed_from_the_uploaded_bytes():
+    data, image_hash = asyncio.run(save_temp_image(upload(IMAGE)))
+    assert data == IMAGE
+    assert image_hash == hashlib.sha256(IMAGE).hexdigest()
+
+
+def test_matching_upstream_digest_is_accepted_case_insensitively():
+    expected = hashlib.sha256(IMAGE).hexdigest()
+    _, image_hash = asyncio.run(save_temp_image(upload(IMAGE), expected.upper()))
+    assert image_hash == expected
+
+
+def test_mismatched_digest_cannot_choose_the_cache_key():
+    other = hashlib.sha256(b"another image").hexdigest()
+    with pytest.raises(ImageDigestMismatch):
+        asyncio.run(save_temp_image(upload(IMAGE), other))
@@ -0,0 +1,60 @@
+import json
+
+import msgpack
+import pytest
+
+from app.utils.value_codec import FLAG_ZSTD, MAGIC, VERSION, ValueCodec
+
+RESULT = {"analysis": "圖片中有一隻貓坐在窗台上，背景是藍天。", "model": "gemini-pro-vision"}
+LONG_RESULT = {"analysis": "畫面左邊有一棵樹，右邊有一棟房子。" * 100, "model": "gemini-pro-vision"}
+
+
+@pytest.mark.parametrize("raw", [
+    json.dumps(RESULT, ensure_ascii=False),
+    json.dumps(RESULT, ensure_ascii=False).encode("utf-8"),
+    json.dumps(RESULT).encode("utf-8"),
+])
+def test_legacy_json_values_are_still_readable(raw):
+    assert ValueCodec("test_legacy").decode(raw) == RESULT
+
+
+def test_json_format_writes_plain_json_readable_by_old_replicas():
+    encoded = ValueCodec("test_json", format="json").encode(RESULT)
+    assert json.loads(encoded) == RESULT
+    assert ValueCodec("test_json_reader").decode(encoded) == RESULT
+
+
+def test_msgpack_round_trip_without_compression_for_small_values():
+    codec = ValueCodec("test_msgpack", compress_min_bytes=512)
+    encoded = codec.encode(RESULT)
+    assert encoded[:3] == bytes((MAGIC, VERSION, 0))
+    assert msgpack.unpackb(encoded[3:], raw=False) == RESULT
+    assert codec.decode(encoded) == RESULT
+
+
+def test_msgpack_values_above_threshold_are_zstd_compressed():
+    codec = ValueCodec("test_zstd", compress_min_bytes=512)
+    encoded = codec.encode(LONG_RESULT)
+    assert encoded[2] & FLAG_ZSTD
+    assert len(encoded) < len(msgpack.packb(LONG_RESULT, use_bin_type=True))
+    assert codec.decode(encoded) == LONG_RESULT
+    # 讀取端不需相同的壓縮設定
+    assert ValueCodec("test_zstd_reader", format="json", compress_min_bytes=0).decode(encoded) == LONG_RESULT
+
+
+def test_compression_disabled_with_zero_threshold():
+    encoded = ValueCodec("test_no_zstd", compress_min_bytes=0).encode(LONG_RESULT)
+    assert encoded[2] == 0
+
+
+def test_unknown_version_and_truncated_header_are_rejected():
+    codec = ValueCodec("test_invalid")
+    with pytest.raises(ValueError):
+        codec.decode(bytes((MAGIC, VERSION + 1, 0)) + msgpack.packb(RESULT))
+    with pytest.raises(ValueError):
+        codec.decode(bytes((MAGIC, VERSION)))
+
+
+def test_unknown_format_is_rejected():
+    with pytest.raises(ValueError):
+        ValueCodec("test_format", format="pickle")
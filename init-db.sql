@@ -29,7 +29,8 @@ CREATE TABLE chat_history (
     context JSONB DEFAULT '{}'::jsonb
 );
 
-CREATE INDEX chat_history_user_id_idx ON chat_history(line_user_id);
+-- 依用戶由新到舊分頁列出歷史(游標為 created_at, id)
+CREATE INDEX chat_history_user_created_idx ON chat_history(line_user_id, created_at DESC, id DESC);
 
 -- 連接到圖片資料庫
 \c image_db;
@@ -44,4 +45,5 @@ CREATE TABLE image_history (
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
-CREATE INDEX image_history_user_id_idx ON image_history(line_user_id); 
\ No newline at end of file
+-- 依用戶由新到舊分頁列出歷史(游標為 created_at, id)
+CREATE INDEX image_history_user_created_idx ON image_history(line_user_id, created_at DESC, id DESC); 
\ No newline at end of file
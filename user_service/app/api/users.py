@@ -1,7 +1,7 @@
 import logging
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime
 from pydantic import BaseModel
 from typing import Optional, Dict, Any
@@ -26,11 +26,11 @@ class UserActivityUpdate(BaseModel):
     line_user_id: str
 
 @router.post("/create")
-async def create_user(user_data: UserCreate, db: Session = Depends(get_db)):
+async def create_user(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
     """創建新用戶"""
     try:
         # 檢查用戶是否已存在
-        existing_user = db.query(User).filter(User.line_user_id == user_data.line_user_id).first()
+        existing_user = await db.scalar(select(User).where(User.line_user_id == user_data.line_user_id))
         if existing_user:
             return existing_user.to_dict()
         
@@ -41,21 +41,21 @@ async def create_user(user_data: UserCreate, db: Session = Depends(get_db)):
             preferences=user_data.preferences or {}
         )
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        await db.commit()
+        await db.refresh(new_user)
         
         logger.info(f"已創建新用戶: {user_data.line_user_id}")
         return new_user.to_dict()
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"創建用戶時出錯: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/{line_user_id}")
-async def get_user(line_user_id: str, db: Session = Depends(get_db)):
+async def get_user(line_user_id: str, db: AsyncSession = Depends(get_db)):
     """獲取用戶信息"""
     try:
-        user = db.query(User).filter(User.line_user_id == line_user_id).first()
+        user = await db.scalar(select(User).where(User.line_user_id == line_user_id))
         if not user:
             raise HTTPException(status_code=404, detail="用戶不存在")
         
@@ -67,10 +67,10 @@ async def get_user(line_user_id: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.put("/{line_user_id}")
-async def update_user(line_user_id: str, user_data: UserUpdate, db: Session = Depends(get_db)):
+async def update_user(line_user_id: str, user_data: UserUpdate, db: AsyncSession = Depends(get_db)):
     """更新用戶信息"""
     try:
-        user = db.query(User).filter(User.line_user_id == line_user_id).first()
+        user = await db.scalar(select(User).where(User.line_user_id == line_user_id))
         if not user:
             raise HTTPException(status_code=404, detail="用戶不存在")
         
@@ -79,32 +79,29 @@ async def update_user(line_user_id: str, user_data: UserUpdate, db: Session = De
             user.username = user_data.username
         
         if user_data.preferences is not None:
-            # 合併現有偏好設定和新的偏好設定
-            if user.preferences:
-                user.preferences.update(user_data.preferences)
-            else:
-                user.preferences = user_data.preferences
+            # 合併現有偏好設定和新的偏好設定，重新指派才會被視為變更
+            user.preferences = {**(user.preferences or {}), **user_data.preferences}
         
-        db.commit()
-        db.refresh(user)
+        await db.commit()
+        await db.refresh(user)
         
         logger.info(f"已更新用戶信息: {line_user_id}")
         return user.to_dict()
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"更新用戶信息時出錯: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/update_activity")
-async def update_user_activity(activity_data: UserActivityUpdate, db: Session = Depends(get_db)):
+async def update_user_activity(activity_data: UserActivityUpdate, db: AsyncSession = Depends(get_db)):
     """更新用戶活躍狀態"""
     try:
         line_user_id = activity_data.line_user_id
         
         # 查詢用戶
-        user = db.query(User).filter(User.line_user_id == line_user_id).first()
+        user = await db.scalar(select(User).where(User.line_user_id == line_user_id))
         
         # 如果用戶不存在，則創建
         if not user:
@@ -114,11 +111,11 @@ async def update_user_activity(activity_data: UserActivityUpdate, db: Session =
         # 更新last_active時間
         user.last_active = func.now()
         
-        db.commit()
+        await db.commit()
         
         logger.info(f"已更新用戶活躍狀態: {line_user_id}")
         return {"status": "success", "line_user_id": line_user_id}
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"更新用戶活躍狀態時出錯: {e}")
         raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file